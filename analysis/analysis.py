@@ -2,11 +2,29 @@
 """
 
 import matplotlib.pyplot as plt
+from matplotlib.colors import LinearSegmentedColormap
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
 import os
+import json
 import numpy as np
 import dill as pickle
 import brian2 as brian
-import dpath.util
+from brian2.units.fundamentalunits import get_or_create_dimension
+import time
+import traceback
+
+from simulation.make_run_settings import get_param, parse_monitor_spec
+
+
+# size bound (bytes) of the analysis cache of a simulation directory
+analysis_cache_bytes = 2 * 1024 ** 3
+
+# part of every analysis cache key. Bump it whenever a cached analysis
+# (summarize_run and everything it calls) changes its results, so results
+# cached by the older code are not returned any more
+analysis_cache_version = 1
 
 
 def unpickle(pickle_file):
@@ -19,6 +37,93 @@ def unpickle(pickle_file):
     return net
 
 
+def settings_from_json(settings):
+    """Reverse hvasim's settings_to_json (restores the tuple keys)"""
+
+    if isinstance(settings, dict):
+        if "__tuple_keys__" in settings:
+            return {tuple(k): settings_from_json(v)
+                    for k, v in settings["__tuple_keys__"]}
+        return {k: settings_from_json(v) for k, v in settings.items()}
+    elif isinstance(settings, list):
+        return [settings_from_json(v) for v in settings]
+    return settings
+
+
+def is_columnar_run(path):
+    """Check if path is a (complete) columnar run directory"""
+
+    return os.path.isfile(os.path.join(path, "manifest.json"))
+
+
+def read_manifest(run_dir):
+    with open(os.path.join(run_dir, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    return manifest
+
+
+def load_column(run_dir, entry, mmap_mode=None):
+    """
+    Load one variable of a columnar run, with its units restored.
+    mmap_mode="r" memory-maps the array instead of reading it.
+    """
+
+    if "value" in entry:
+        arr = np.asarray(entry["value"])
+    else:
+        arr = np.load(os.path.join(run_dir, entry["file"]),
+                      mmap_mode=mmap_mode)
+
+    if any(entry["dims"]):
+        return brian.Quantity(arr,
+                              dim=get_or_create_dimension(entry["dims"]),
+                              copy=False)
+    return arr
+
+
+def load_monitor(run_dir, mon_name, mmap_mode="r"):
+    """Load the states of a single monitor (or group) of a columnar run"""
+
+    entries = read_manifest(run_dir)["objects"][mon_name]
+    return {var: load_column(run_dir, entry, mmap_mode)
+            for var, entry in entries.items()}
+
+
+def load_columnar(run_dir, mmap_mode=None):
+    """
+    Load a columnar run directory (see hvasim.save_columnar_data) into the
+    same {"net", "settings", "description"} dict that unpickle returns
+    """
+
+    manifest = read_manifest(run_dir)
+    net = {}
+    for obj_name, entries in manifest["objects"].items():
+        net[obj_name] = {var: load_column(run_dir, entry, mmap_mode)
+                         for var, entry in entries.items()}
+
+    out = {"net": net,
+           "settings": settings_from_json(manifest["settings"]),
+           "description": manifest["description"]
+           }
+    if "profile" in manifest:
+        out["profile"] = manifest["profile"]
+    return out
+
+
+def list_simulation_files(simulations_directory):
+    """
+    Names of the saved runs in a simulation directory: pickled runs (.p)
+    and columnar run directories
+    """
+
+    file_names = []
+    for fname in sorted(os.listdir(simulations_directory)):
+        fpath = os.path.join(simulations_directory, fname)
+        if fname.endswith('.p') or is_columnar_run(fpath):
+            file_names.append(fname)
+    return file_names
+
+
 def load_all_files(file_names, simulations_directory):
     """
     Plot a summary figure of the simmulation (all the files).
@@ -28,14 +133,440 @@ def load_all_files(file_names, simulations_directory):
 
     alldata = {}
     for fname in file_names:
-        tmpdat = unpickle(simulations_directory + os.sep + fname)
+        fpath = simulations_directory + os.sep + fname
+        if is_columnar_run(fpath):
+            tmpdat = load_columnar(fpath)
+        else:
+            tmpdat = unpickle(fpath)
         alldata[fname] = {"net": tmpdat["net"],
                           "settings": tmpdat["settings"],
                           "description": tmpdat["description"]
                           }
+        if "profile" in tmpdat:
+            alldata[fname]["profile"] = tmpdat["profile"]
     return alldata
 
 
+class LazyNet(Mapping):
+    """
+    The "net" of a columnar run. An object's states are only loaded (and
+    memory-mapped, see load_column) the first time the object is accessed.
+    """
+
+    def __init__(self, run_dir, objects, mmap_mode="r"):
+        self.run_dir = run_dir
+        self.objects = objects
+        self.mmap_mode = mmap_mode
+        self._loaded = {}
+
+    def __getitem__(self, obj_name):
+        if obj_name not in self._loaded:
+            self._loaded[obj_name] = {
+                var: load_column(self.run_dir, entry, self.mmap_mode)
+                for var, entry in self.objects[obj_name].items()
+            }
+        return self._loaded[obj_name]
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
+
+
+class LazyRun(Mapping):
+    """
+    One saved run, with the same "net", "settings" and "description" keys
+    as the dicts of load_all_files.
+
+    Columnar runs read only their manifest up front; monitors are loaded
+    on first access (see LazyNet). Pickled runs can only be loaded whole,
+    which happens the first time any key is accessed.
+    """
+
+    keys_of_run = ("net", "settings", "description")
+
+    def __init__(self, fpath, mmap_mode="r"):
+        self.fpath = fpath
+        self._data = None
+        if is_columnar_run(fpath):
+            manifest = read_manifest(fpath)
+            self._data = {
+                "net": LazyNet(fpath, manifest["objects"], mmap_mode),
+                "settings": settings_from_json(manifest["settings"]),
+                "description": manifest["description"]
+            }
+
+    def __getitem__(self, key):
+        if self._data is None:
+            tmpdat = unpickle(self.fpath)
+            self._data = {k: tmpdat[k] for k in self.keys_of_run}
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self.keys_of_run)
+
+    def __len__(self):
+        return len(self.keys_of_run)
+
+
+def open_simulation_directory(simulations_directory, file_names=None,
+                              mmap_mode="r"):
+    """
+    Lazy version of load_all_files: {fname: LazyRun} for the runs of a
+    simulation directory (all of them if file_names is None). Can be passed
+    to the extract_* functions and get_looped_param_list in place of the
+    load_all_files dict.
+    """
+
+    if file_names is None:
+        file_names = list_simulation_files(simulations_directory)
+
+    return {fname: LazyRun(simulations_directory + os.sep + fname, mmap_mode)
+            for fname in file_names}
+
+
+def analyse_sweep(simulations_directory, file_names=None, workers=None,
+                  mon_type="v", binsize=0.025, kernel=None, kernel_width=None,
+                  dict_addr="afferents/modulation_rate", use_cache=True,
+                  cache_bytes=analysis_cache_bytes):
+    """
+    Analyse every run of a simulation directory in a process pool.
+
+    Each worker opens one run lazily, extracts its monitors and computes
+    the PSTHs and the DOM at the run's modulation frequency (the setting at
+    dict_addr), then sends back only the compact summary (see
+    summarize_run), so the wall time scales with files / workers.
+
+    With use_cache, summaries are kept in the analysis cache of the
+    directory (see load_cached) and only new or changed runs are analysed.
+
+    Returns ({fname: summary}, {fname: traceback string} for failed files).
+    """
+
+    if file_names is None:
+        file_names = list_simulation_files(simulations_directory)
+
+    params = {"mon_type": mon_type,
+              "binsize": binsize,
+              "kernel": kernel,
+              "kernel_width": kernel_width,
+              "dict_addr": dict_addr}
+    summaries = {}
+    if use_cache:
+        summaries, keys = load_cached(simulations_directory,
+                                      file_names,
+                                      "summarize_run",
+                                      params)
+
+    new_summaries = {}
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(analyse_run_file,
+                               simulations_directory + os.sep + fname,
+                               mon_type,
+                               binsize,
+                               kernel,
+                               kernel_width,
+                               dict_addr
+                               ): fname
+                   for fname in file_names if fname not in summaries}
+
+        for future in as_completed(futures):
+            fname = futures[future]
+            try:
+                summary, error = future.result()
+            except Exception as err:  # e.g. the worker process died
+                summary, error = None, repr(err)
+
+            if error is None:
+                summaries[fname] = summary
+                new_summaries[fname] = summary
+            else:
+                failures[fname] = error
+                print("  Analysis of {} failed:\n{}".format(fname, error))
+
+    if use_cache:
+        store_cached(simulations_directory, new_summaries, keys, cache_bytes)
+
+    return summaries, failures
+
+
+def load_profile(run_path):
+    """
+    The profile stored with a run (settings["run"]["profile"]), or None.
+    Columnar runs only read their manifest.
+    """
+
+    if is_columnar_run(run_path):
+        return read_manifest(run_path).get("profile")
+    return unpickle(run_path).get("profile")
+
+
+def aggregate_profiles(simulations_directory, file_names=None):
+    """
+    Combine the profiles of the runs of a sweep directory.
+
+    Returns a dict with "runs" ({fname: profile} of the profiled runs),
+    "code_objects" ({name: {"total", "mean", "fraction"}}, seconds, the
+    fraction of all the time spent in code objects) and "wall_clock"
+    ({stage: {"total", "mean"}} for build/compile/run/save).
+    """
+
+    if file_names is None:
+        file_names = list_simulation_files(simulations_directory)
+
+    runs = {}
+    for fname in file_names:
+        profile = load_profile(simulations_directory + os.sep + fname)
+        if profile is not None:
+            runs[fname] = profile
+
+    code_totals = {}
+    wall_totals = {}
+    for profile in runs.values():
+        for name, spent in profile["code_objects"].items():
+            code_totals[name] = code_totals.get(name, 0) + spent
+        for stage, spent in profile["wall_clock"].items():
+            wall_totals.setdefault(stage, []).append(spent)
+
+    n_runs = max(len(runs), 1)
+    all_code = max(sum(code_totals.values()), np.finfo(float).tiny)
+    code_objects = {
+        name: {"total": total,
+               "mean": total / n_runs,
+               "fraction": total / all_code}
+        for name, total in sorted(code_totals.items(),
+                                  key=lambda item: item[1],
+                                  reverse=True)
+    }
+    wall_clock = {stage: {"total": np.sum(vals), "mean": np.mean(vals)}
+                  for stage, vals in wall_totals.items()}
+
+    return {"runs": runs,
+            "code_objects": code_objects,
+            "wall_clock": wall_clock}
+
+
+def analysis_cache_dir(simulations_directory):
+    """The analysis cache lives next to the runs it was computed from"""
+
+    return os.path.join(simulations_directory, ".analysis_cache")
+
+
+def read_cache_index(cache_dir):
+    """
+    The cache index: the content hash of every run (with the stat of the
+    file it was computed from, so unchanged runs are not hashed again) and
+    the size and last use of every cached result.
+    """
+
+    fpath = os.path.join(cache_dir, "index.json")
+    if not os.path.isfile(fpath):
+        return {"hashes": {}, "entries": {}}
+    with open(fpath, "r") as f:
+        index = json.load(f)
+    return index
+
+
+def write_cache_index(cache_dir, index):
+    """Replace the index atomically, readers never see a partial file"""
+
+    tmp_path = os.path.join(cache_dir, "index.json.{}.tmp".format(os.getpid()))
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, os.path.join(cache_dir, "index.json"))
+
+
+def run_content_hash(simulations_directory, fname, index):
+    """
+    sha1 of every byte of a saved run (all the arrays of a columnar run).
+    Reused from the index while the run file (columnar: its manifest, which
+    is written last) keeps the same size and modification time.
+    """
+
+    fpath = os.path.join(simulations_directory, fname)
+    columnar = is_columnar_run(fpath)
+    stat = os.stat(os.path.join(fpath, "manifest.json") if columnar
+                   else fpath)
+    stat_key = [stat.st_size, stat.st_mtime_ns]
+    known = index["hashes"].get(fname)
+    if known is not None and known["stat"] == stat_key:
+        return known["hash"]
+
+    if columnar:
+        rel_paths = sorted(os.path.relpath(os.path.join(root, name), fpath)
+                           for root, _, names in os.walk(fpath)
+                           for name in names)
+    else:
+        rel_paths = [""]
+
+    sha = hashlib.sha1()
+    for rel_path in rel_paths:
+        sha.update(rel_path.encode())
+        with open(os.path.join(fpath, rel_path) if rel_path else fpath,
+                  "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+
+    index["hashes"][fname] = {"stat": stat_key, "hash": sha.hexdigest()}
+    return index["hashes"][fname]["hash"]
+
+
+def load_cached(simulations_directory, file_names, func_name, params):
+    """
+    Look up the results of func_name(run, **params) for the runs in the
+    analysis cache. The key is the run's content hash plus func_name,
+    params and analysis_cache_version, so rerunning a sweep into the same
+    files, changing binsize etc. or changing the analysis code never
+    returns a stale result. The content hashes are saved in the index
+    right away, so a later session does not hash the runs again.
+
+    Returns ({fname: result} for the cached runs, {fname: key} for all of
+    them, to be passed on to store_cached).
+    """
+
+    cache_dir = analysis_cache_dir(simulations_directory)
+    os.makedirs(cache_dir, exist_ok=True)
+    index = read_cache_index(cache_dir)
+
+    hits = {}
+    keys = {}
+    for fname in file_names:
+        content_hash = run_content_hash(simulations_directory, fname, index)
+        key_src = json.dumps([content_hash, func_name, params,
+                              analysis_cache_version],
+                             sort_keys=True,
+                             default=repr)
+        keys[fname] = hashlib.sha1(key_src.encode()).hexdigest()
+
+        entry_path = os.path.join(cache_dir, keys[fname] + ".p")
+        if keys[fname] in index["entries"] and os.path.isfile(entry_path):
+            hits[fname] = unpickle(entry_path)
+            index["entries"][keys[fname]]["last_used"] = time.time()
+        else:
+            index["entries"].pop(keys[fname], None)
+
+    write_cache_index(cache_dir, index)
+    return hits, keys
+
+
+def store_cached(simulations_directory, results, keys,
+                 max_bytes=analysis_cache_bytes):
+    """
+    Add {fname: result} to the analysis cache under the keys from
+    load_cached, then evict the least recently used results until the
+    cache fits in max_bytes.
+    """
+
+    cache_dir = analysis_cache_dir(simulations_directory)
+    os.makedirs(cache_dir, exist_ok=True)
+    index = read_cache_index(cache_dir)
+
+    for fname, result in results.items():
+        entry_path = os.path.join(cache_dir, keys[fname] + ".p")
+        tmp_path = "{}.{}.tmp".format(entry_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(result, f, -1)
+        os.replace(tmp_path, entry_path)
+        index["entries"][keys[fname]] = {"size": os.path.getsize(entry_path),
+                                         "last_used": time.time()}
+
+    by_age = sorted(index["entries"].items(),
+                    key=lambda item: item[1]["last_used"])
+    total = sum(entry["size"] for _, entry in by_age)
+    for key, entry in by_age:
+        if total <= max_bytes:
+            break
+        entry_path = os.path.join(cache_dir, key + ".p")
+        if os.path.isfile(entry_path):
+            os.remove(entry_path)
+        del index["entries"][key]
+        total -= entry["size"]
+
+    write_cache_index(cache_dir, index)
+    return
+
+
+def cached_analysis(simulations_directory, fname, func, params,
+                    max_bytes=analysis_cache_bytes):
+    """
+    func(run, **params) for a single run (a LazyRun), memoized in the
+    analysis cache of the directory. eg.
+    cached_analysis(sim_path, fname, summarize_run, {"binsize": 0.01})
+    """
+
+    hits, keys = load_cached(simulations_directory, [fname], func.__name__,
+                             params)
+    if fname in hits:
+        return hits[fname]
+
+    result = func(LazyRun(simulations_directory + os.sep + fname), **params)
+    store_cached(simulations_directory, {fname: result}, keys, max_bytes)
+    return result
+
+
+def analyse_run_file(fpath, mon_type, binsize, kernel, kernel_width,
+                     dict_addr):
+    """
+    Worker entry point of analyse_sweep. Returns (summary, None), or
+    (None, traceback string) so one bad file does not abort the rest.
+    """
+
+    try:
+        summary = summarize_run(LazyRun(fpath),
+                                mon_type,
+                                binsize,
+                                kernel,
+                                kernel_width,
+                                dict_addr)
+    except Exception:
+        return None, traceback.format_exc()
+    return summary, None
+
+
+def summarize_run(run, mon_type="v", binsize=0.025, kernel=None,
+                  kernel_width=None, dict_addr="afferents/modulation_rate"):
+    """
+    Compact summary of one run: per neuron group the population PSTH
+    (mean over the spiking units), the number of spiking units and the
+    per-unit DOM (see batched_depth_of_mod) of the analog monitor.
+    """
+
+    data_dict = {"run": run}
+    anlg_mon, neuron_names = extract_anlg_monitors(data_dict, mon_type)
+    spk_mon, _ = extract_spk_monitors(data_dict, binsize, kernel,
+                                      kernel_width)
+    tf = get_param(run["settings"], dict_addr)
+
+    summary = {"description": run["description"],
+               "param": tf,
+               "neurons": {}}
+    for neuron in neuron_names:
+        out = {}
+
+        psth = spk_mon["run"][neuron]["psth"]
+        if psth:
+            rates = psth["rates"]
+            out["psth_edges"] = psth["edges"]
+            out["psth_mean"] = np.mean(rates, axis=0) if len(rates) else \
+                np.zeros(len(psth["edges"]) - 1)
+            out["n_spiking"] = len(psth["unit_idx"])
+
+        anlg = anlg_mon["run"][neuron]
+        if len(anlg["dat"]) > 0:
+            dom = batched_depth_of_mod([anlg["dat"]], [tf],
+                                       [anlg["samp_freq"]])
+            n_units = dom["n_units"][0]
+            out["dom"] = dom["amplitude"][0, :n_units]
+            out["dom_phase"] = dom["phase"][0, :n_units]
+            out["mean_dom"] = dom["mean_amplitude"][0]
+
+        summary["neurons"][neuron] = out
+
+    return summary
+
+
 def extract_anlg_monitors(data_dict, mon_type="v"):
     # define key names for dynamic indexing
     if mon_type.lower() == "v":
@@ -63,7 +594,9 @@ def extract_anlg_monitors(data_dict, mon_type="v"):
             if mon_name in net.keys():
                 monitors[fname][neuron] = {"dat": net[mon_name][key_to_data],
                                            "time": net[mon_name]["t"],
-                                           "mon": net[mon_name]
+                                           "mon": net[mon_name],
+                                           "samp_freq": samp_freq_of(
+                                               net[mon_name]["t"])
                                            }
             else:
                 monitors[fname][neuron] = {"dat": np.array([]),
@@ -73,7 +606,19 @@ def extract_anlg_monitors(data_dict, mon_type="v"):
     return monitors, list(set(neuron_names))
 
 
-def extract_spk_monitors(data_dict, binsize=0.025):
+def samp_freq_of(time_arr):
+    """
+    Sampling rate (samps/sec) of a state monitor from its recorded times.
+    Monitors may record at a coarser dt than the simulation.
+    """
+
+    if len(time_arr) < 2:
+        return np.nan
+    return 1 / float((time_arr[1] - time_arr[0]) / brian.second)
+
+
+def extract_spk_monitors(data_dict, binsize=0.025, kernel=None,
+                         kernel_width=None):
 
     # define key names for dynamic indexing
     mon_suffix = "_spike_mon"
@@ -85,6 +630,7 @@ def extract_spk_monitors(data_dict, binsize=0.025):
         neuron_groups = data_dict[fname]["settings"]["neurons"].keys()
         neuron_names.extend(list(neuron_groups))
         sim_time = data_dict[fname]['settings']['afferents']['sim_time']
+        tf = data_dict[fname]['settings']['afferents']['modulation_rate']
         for neuron in neuron_groups:
             mon_name = neuron + mon_suffix
             net = data_dict[fname]["net"]
@@ -94,17 +640,23 @@ def extract_spk_monitors(data_dict, binsize=0.025):
                                            }
                 psths = spk_mon_to_psth(monitors[fname][neuron],
                                         binsize,
-                                        sim_time)
+                                        sim_time,
+                                        kernel=kernel,
+                                        kernel_width=kernel_width)
                 monitors[fname][neuron]["psth"] = psths
+                monitors[fname][neuron]["phase_locking"] = \
+                    spk_mon_phase_locking(monitors[fname][neuron], tf)
             else:
                 monitors[fname][neuron] = {"dat": np.array([]),
                                            "time": np.array([]),
-                                           "psth": {}}
+                                           "psth": {},
+                                           "phase_locking": {}}
 
     return monitors, list(set(neuron_names))
 
 
-def extract_afferent_monitors(data_dict, binsize=0.100):
+def extract_afferent_monitors(data_dict, binsize=0.100, kernel=None,
+                              kernel_width=None):
 
     # store data in dictionary, one for each file
     monitors = {fname: {} for fname in data_dict.keys()}  # init empty dicts
@@ -127,45 +679,257 @@ def extract_afferent_monitors(data_dict, binsize=0.100):
             print("hack for sim_time: ", sim_time)
             psths = spk_mon_to_psth(monitors[fname]["afferents"],
                                     binsize,
-                                    sim_time)
+                                    sim_time,
+                                    kernel=kernel,
+                                    kernel_width=kernel_width)
             monitors[fname]["afferents"]["psth"] = psths
 
     return monitors
 
 
-def spk_mon_to_psth(spk_dict, binsize, total_time):
+def spk_mon_to_psth(spk_dict, binsize, total_time, n_units=None,
+                    kernel=None, kernel_width=None):
+    """
+    PSTHs of all units of a spike monitor, binned in one pass.
+
+    Every spike gets a combined unit/bin index and the indices are counted
+    with np.bincount, so the cost is linear in the number of spikes instead
+    of units x spikes. 'rates' is a dense units x bins ndarray (spk/sec)
+    and 'unit_idx' an ndarray, where both used to be lists with one entry
+    per unit (iterating over them still gives the same per unit rows).
+    The units are the ones that spiked, or 0..n_units-1 if n_units is given.
+
+    kernel ("gaussian" or "boxcar") smooths the rates along time, with
+    kernel_width the gaussian sigma or the boxcar width (sec).
+    """
 
     # define the binedges
     edges = np.arange(0, total_time + binsize, binsize)
+    n_bins = len(edges) - 1
+
+    # unit (row) of every spike
+    units, rows = spike_rows(spk_dict["unit_idx"], n_units)
+
+    # bin (column) of every spike, same bins as np.histogram
+    spk_t = np.asarray(spk_dict["spk_t"], dtype=float)
+    cols = np.searchsorted(edges, spk_t, side="right") - 1
+    cols[spk_t == edges[-1]] = n_bins - 1
+    valid = (cols >= 0) & (cols < n_bins)
+
+    counts = np.bincount(rows[valid] * n_bins + cols[valid],
+                         minlength=len(units) * n_bins)
+    rates = counts.reshape(len(units), n_bins) / binsize
+    if kernel is not None:
+        rates = smooth_rates(rates, binsize, kernel, kernel_width)
 
-    # get the outputs ready
-    out_psth = {'rates': [],
-                'unit_idx': [],
+    out_psth = {'rates': rates,
+                'unit_idx': units,
                 'edges': edges,
                 'binsize': binsize}
 
-    # compute the psths
-    unit_idxs = set(spk_dict["unit_idx"])
-    for idx in unit_idxs:
-        l_idx = spk_dict["unit_idx"] == idx  # logical array
-        spk_times = spk_dict["spk_t"][l_idx]
-        counts_per_bin, _ = np.histogram(spk_times, edges)
-        rate_per_bin = np.array(counts_per_bin) / binsize
-        out_psth['rates'].append(rate_per_bin)
-        out_psth['unit_idx'].append(idx)
-
     return out_psth
 
 
-def plot_anlg_summary(monitors, neuron_names, plot_type="overlay"):
+def spike_rows(unit_idx, n_units=None):
+    """
+    The units and the row (into the units) of every spike: the units that
+    spiked, or 0..n_units-1 if n_units is given
+    """
+
+    unit_idx = np.asarray(unit_idx, dtype=int)
+    if n_units is None:
+        return np.unique(unit_idx, return_inverse=True)
+    assert np.all((unit_idx >= 0) & (unit_idx < n_units)), \
+        "ERROR: spike unit_idx outside 0..n_units-1"
+    return np.arange(n_units), unit_idx
+
+
+def spk_mon_phase_locking(spk_dict, frequency, n_units=None):
+    """
+    Phase locking of every unit of a spike monitor to the afferent
+    sinusoid at frequency (Hz), all units in one pass: the unit vectors of
+    the spike phases are summed per unit with np.bincount.
+
+    Phases are in radians of sin(2*pi*frequency*t), so the afferent rate
+    peaks at pi/2. Units as in spk_mon_to_psth. Returns per unit arrays of
+    "n_spikes", "vector_strength", "preferred_phase", "rayleigh_z" and
+    "rayleigh_p", and the same statistics of all spikes pooled under
+    "population". Empty ({}) at a frequency of 0.
+    """
+
+    if frequency == 0:
+        return {}
+
+    units, rows = spike_rows(spk_dict["unit_idx"], n_units)
+
+    phases = 2 * np.pi * frequency * np.asarray(spk_dict["spk_t"], dtype=float)
+    n_spikes = np.bincount(rows, minlength=len(units))
+    cos_sum = np.bincount(rows, weights=np.cos(phases), minlength=len(units))
+    sin_sum = np.bincount(rows, weights=np.sin(phases), minlength=len(units))
+
+    out = phase_locking_stats(n_spikes, cos_sum, sin_sum)
+    out["unit_idx"] = units
+    out["population"] = phase_locking_stats(np.sum(n_spikes),
+                                            np.sum(cos_sum),
+                                            np.sum(sin_sum))
+    return out
+
+
+def phase_locking_stats(n_spikes, cos_sum, sin_sum):
+    """
+    Vector strength, preferred phase and the Rayleigh test of uniformity
+    from the summed unit vectors of n_spikes spike phases. The p-value uses
+    Zar's approximation (Biostatistical Analysis, eq. 27.4),
+    p = exp(sqrt(1 + 4n + 4(n^2 - R^2)) - (1 + 2n)) with R = n * r, which
+    stays in (0, 1] for strong locking and few spikes. nan where there are
+    no spikes.
+    """
+
+    n_spikes = np.asarray(n_spikes, dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        resultant = np.hypot(cos_sum, sin_sum)
+        vector_strength = resultant / n_spikes
+        z = n_spikes * vector_strength ** 2
+        p = np.exp(np.sqrt(1 + 4 * n_spikes +
+                           4 * (n_spikes ** 2 - resultant ** 2)) -
+                   (1 + 2 * n_spikes))
+        p = np.where(n_spikes > 0, p, np.nan)
+
+    return {"n_spikes": n_spikes,
+            "vector_strength": vector_strength,
+            "preferred_phase": np.where(n_spikes > 0,
+                                        np.arctan2(sin_sum, cos_sum),
+                                        np.nan),
+            "rayleigh_z": z,
+            "rayleigh_p": p}
+
+
+def smooth_rates(rates, binsize, kernel="gaussian", kernel_width=0.050):
+    """
+    Smooth rates (units x bins) along time with a normalized kernel. The
+    first/last bin is repeated at the edges so the rates are not pulled
+    towards zero there.
+    """
+
+    if kernel == "gaussian":
+        sigma = kernel_width / binsize
+        half = int(np.ceil(3 * sigma))
+        taps = np.exp(-0.5 * (np.arange(-half, half + 1) / sigma) ** 2)
+    elif kernel == "boxcar":
+        half = int(np.round(kernel_width / binsize / 2))
+        taps = np.ones(2 * half + 1)
+    else:
+        raise ValueError("Unknown kernel: {}".format(kernel))
+    taps = taps / np.sum(taps)
+
+    n_bins = rates.shape[1]
+    padded = np.pad(rates, ((0, 0), (half, half)), mode="edge")
+    smoothed = np.zeros(rates.shape)
+    for offset, tap in enumerate(taps):
+        smoothed += tap * padded[:, offset:offset + n_bins]
+
+    return smoothed
+
+
+def pixel_columns(ax):
+    """Width of an axes in pixels"""
+
+    return int(np.ceil(ax.get_window_extent().width))
+
+
+def minmax_decimate(tt, yy, n_columns):
+    """
+    Decimate a trace to n_columns for plotting, keeping the min and the max
+    sample of every column (in time order), so the plotted envelope looks
+    the same as the full trace at that width.
+
+    yy may be samples x units, every unit is decimated on its own and tt is
+    returned with the same (2D) shape. Units are kept.
+    """
+
+    n = len(tt)
+    if n <= 2 * n_columns:
+        return tt, yy
+
+    vals = np.asarray(yy, dtype=float)
+    one_d = vals.ndim == 1
+    if one_d:
+        vals = vals.reshape(-1, 1)
+    n_units = vals.shape[1]
+
+    # equal blocks of samples per column, the last one padded with its edge
+    per_col = int(np.ceil(n / n_columns))
+    n_columns = int(np.ceil(n / per_col))
+    padded = np.pad(vals, ((0, per_col * n_columns - n), (0, 0)), mode="edge")
+    blocks = padded.reshape(n_columns, per_col, n_units)
+    starts = (np.arange(n_columns) * per_col)[:, None]
+    i_min = np.minimum(blocks.argmin(axis=1) + starts, n - 1)
+    i_max = np.minimum(blocks.argmax(axis=1) + starts, n - 1)
+    idx = np.sort(np.concatenate([i_min, i_max], axis=0), axis=0)
+
+    if one_d:
+        return tt[idx[:, 0]], yy[idx[:, 0]]
+    return tt[idx], yy[idx, np.arange(n_units)]
+
+
+def raster_image(spk_t, unit_idx, t_max, n_units, n_time_bins, n_unit_bins):
+    """
+    Spike counts of a raster binned into an n_unit_bins x n_time_bins image
+    (rows are units, from unit 0 up), counted in one pass with np.bincount.
+    """
+
+    t_bin = np.asarray(spk_t, dtype=float) / t_max * n_time_bins
+    t_bin = np.clip(t_bin.astype(int), 0, n_time_bins - 1)
+    u_bin = np.asarray(unit_idx, dtype=float) / n_units * n_unit_bins
+    u_bin = np.clip(u_bin.astype(int), 0, n_unit_bins - 1)
+    counts = np.bincount(u_bin * n_time_bins + t_bin,
+                         minlength=n_unit_bins * n_time_bins)
+    return counts.reshape(n_unit_bins, n_time_bins)
+
+
+def plot_raster(ax, spk_t, unit_idx, color="k", max_markers=20000):
+    """
+    Raster plot of spike times vs unit. Up to max_markers spikes are
+    plotted as markers, denser rasters are binned to the pixel size of
+    the axes (see raster_image) and drawn as one image.
+    """
+
+    if len(unit_idx) <= max_markers:
+        ax.plot(spk_t, unit_idx, '|', c=color)
+        return
+
+    t_max = float(np.max(np.asarray(spk_t, dtype=float)))
+    n_units = int(np.max(unit_idx)) + 1
+    bbox = ax.get_window_extent()
+    n_time_bins = pixel_columns(ax)
+    n_unit_bins = int(min(n_units, np.ceil(bbox.height)))
+    image = raster_image(spk_t, unit_idx, t_max, n_units, n_time_bins,
+                         n_unit_bins)
+
+    cmap = LinearSegmentedColormap.from_list("raster", ["white", color])
+    ax.imshow(image,
+              aspect="auto",
+              origin="lower",
+              interpolation="nearest",
+              cmap=cmap,
+              extent=(0, t_max, -0.5, n_units - 0.5)
+              )
+    return
+
+
+def plot_anlg_summary(monitors, neuron_names, plot_type="overlay",
+                      decimate=True):
     """
     Plot a summary figure of the simmulation for the monitors supplied.
+
+    With decimate, traces are reduced to their min/max envelope at the
+    pixel width of each axes (see minmax_decimate) before plotting.
     """
 
     fnt_sz = 12
     N_sim_conds = len(monitors)
     N_neuron_groups = len(neuron_names)
-    cm = plt.cm.get_cmap('Dark2')
+    cm = plt.get_cmap('Dark2')
 
     if plot_type.lower() == "overlay":
         fig, axs = plt.subplots(N_sim_conds, 1, figsize=(10, 25))
@@ -183,8 +947,8 @@ def plot_anlg_summary(monitors, neuron_names, plot_type="overlay"):
         for col_idx, neuron_group in enumerate(neuron_names):
             tt = monitors[sim_type][neuron_group]['time']
             yy = monitors[sim_type][neuron_group]['dat']
-            y_units = brian.get_unit(yy)
-            yy * y_units  # backout the units
+            y_units = brian.get_unit(brian.get_dimensions(yy))
+            yy = np.asarray(yy, dtype=float)  # SI values, in y_units
 
             if plot_type.lower() == "overlay":
                 if N_sim_conds == 1:
@@ -198,6 +962,8 @@ def plot_anlg_summary(monitors, neuron_names, plot_type="overlay"):
                     ax = axs[row_idx, col_idx]
 
             # plot
+            if decimate:
+                tt, yy = minmax_decimate(tt, yy, pixel_columns(ax))
             ax.plot(tt, yy, c=cm.colors[col_idx], label=neuron_group)
             ax.set_ylabel("monitor ({})".format(y_units), fontsize=fnt_sz)
             ax.set_xlabel("time (sec)", fontsize=fnt_sz)
@@ -229,7 +995,7 @@ def plot_spk_summary(monitors, neuron_names, plot_type="overlay", average=True):
     fnt_sz = 12
     N_sim_conds = len(monitors)
     N_neuron_groups = len(neuron_names)
-    cm = plt.cm.get_cmap('Dark2')
+    cm = plt.get_cmap('Dark2')
 
     if plot_type.lower() == "overlay":
         fig, axs = plt.subplots(N_sim_conds, 1, figsize=(10, 25))
@@ -293,7 +1059,7 @@ def plot_hva_rasters(monitors, neuron_names):
     fnt_sz = 12
     N_sim_conds = len(monitors)
     N_neuron_groups = len(neuron_names)
-    cm = plt.cm.get_cmap('Dark2')
+    cm = plt.get_cmap('Dark2')
 
     # set up the figure
     width = 25
@@ -315,7 +1081,7 @@ def plot_hva_rasters(monitors, neuron_names):
 
             # plot (if there are data)
             if len(yy) > 0:
-                ax.plot(tt, yy, '|', c=cm.colors[col_idx])
+                plot_raster(ax, tt, yy, cm.colors[col_idx])
 
             # add x/y labels
             ax.set_ylabel("unit number", fontsize=fnt_sz)
@@ -341,7 +1107,7 @@ def plot_afferent_rasters(monitors):
 
             # plot (if there are data)
             if len(yy) > 0:
-                axs[row_idx].plot(tt, yy, 'k|')
+                plot_raster(axs[row_idx], tt, yy, "k")
 
             # add x/y labels
             axs[row_idx].set_ylabel("afferent idx", fontsize=fnt_sz)
@@ -364,7 +1130,7 @@ def calculate_depth_of_mod(time_series, baseline=0, freq=0, samp_freq=1000):
     time_series = time_series.reshape(1, n)
 
     # ditch the units
-    time_series = time_series / brian.get_unit(time_series)
+    time_series = np.asarray(time_series, dtype=float)  # SI values
 
     # need to baseline subtract so that DOM is wrt pre-stim condition
     time_series = time_series - baseline
@@ -389,7 +1155,7 @@ def get_all_dat_dom(monitors, neuron_names, samp_freqs, tf_dict):
     for i_tf, fid in enumerate(monitors.keys()):
         for neuron in neuron_names:
             yy = monitors[fid][neuron]['dat']
-            baseline = yy[0] / brian.get_unit(yy[0])
+            baseline = np.asarray(yy[0], dtype=float)
             tf = tf_dict[fid]
             dom = calculate_depth_of_mod(yy,
                                          baseline=baseline,
@@ -401,11 +1167,207 @@ def get_all_dat_dom(monitors, neuron_names, samp_freqs, tf_dict):
     return out
 
 
+def batched_depth_of_mod(traces, freqs, samp_freqs, baselines=None):
+    """
+    Depth of modulation of every unit of every file.
+
+    Same measure as calculate_depth_of_mod: for freq > 0, twice the
+    magnitude of the single DFT bin at freq of the zero-mean trace; for
+    freq == 0, |mean - baseline|. Only that one bin is computed, one file
+    at a time as a single (samples) x (samples x units) product, so no
+    file is padded or copied and memory stays at one complex exponential
+    of the longest file.
+
+    traces: list of (samples x units) arrays as state monitors record them
+        (1-D arrays are a single unit, units are stripped, values in SI)
+    freqs, samp_freqs: one modulation frequency/sampling rate per file
+    baselines: one value per file (or per file and unit) for freq == 0,
+        defaults to the first sample of every unit
+
+    Returns a dict of files x units arrays ("amplitude", "phase" in
+    radians, nan for missing units) and per file population summaries
+    ("mean_amplitude", "median_amplitude", "std_amplitude",
+    "population_phase" the circular mean phase, "phase_locking" the length
+    of the mean phase vector).
+    """
+
+    arrs = []
+    for trace in traces:
+        arr = np.asarray(trace, dtype=float)
+        arrs.append(arr.reshape(-1, 1) if arr.ndim == 1 else arr)
+    n_files = len(arrs)
+    n_units = np.array([arr.shape[1] for arr in arrs], dtype=int)
+    max_units = np.max(n_units, initial=0)
+    is_unit = np.arange(max_units)[None, :] < n_units[:, None]  # files x units
+    freqs = np.asarray(freqs, dtype=float).reshape(n_files)
+    samp_freqs = np.asarray(samp_freqs, dtype=float).reshape(n_files)
+    if baselines is not None:
+        baselines = np.broadcast_to(np.asarray(baselines, dtype=float)
+                                    .reshape((n_files, -1)),
+                                    (n_files, max_units))
+
+    amplitude = np.full((n_files, max_units), np.nan)
+    phase = np.full((n_files, max_units), np.nan)
+    for i_file, arr in enumerate(arrs):
+        n_samp, n_unit = arr.shape
+        means = arr.mean(axis=0) if n_samp else np.zeros(n_unit)
+        if freqs[i_file] == 0:
+            base = arr[0] if baselines is None \
+                else baselines[i_file, :n_unit]
+            amplitude[i_file, :n_unit] = np.abs(means - base)
+            phase[i_file, :n_unit] = 0.0
+            continue
+
+        # single DFT bin of the zero-mean traces, without centering a copy
+        tt = np.arange(n_samp) / samp_freqs[i_file]
+        basis = np.exp(-2j * np.pi * freqs[i_file] * tt)
+        coeffs = basis @ arr - means * basis.sum()
+        amplitude[i_file, :n_unit] = 2 * np.abs(coeffs) / max(n_samp, 1)
+        phase[i_file, :n_unit] = np.angle(coeffs)
+
+    # population summaries over the units of every file
+    phasors = np.where(is_unit, np.exp(1j * np.nan_to_num(phase)), 0)
+    mean_phasor = phasors.sum(axis=1) / np.maximum(n_units, 1)
+    with np.errstate(invalid="ignore"):
+        out = {
+            "freqs": freqs,
+            "amplitude": amplitude,
+            "phase": phase,
+            "n_units": n_units,
+            "mean_amplitude": np.nanmean(amplitude, axis=1),
+            "median_amplitude": np.nanmedian(amplitude, axis=1),
+            "std_amplitude": np.nanstd(amplitude, axis=1),
+            "population_phase": np.angle(mean_phasor),
+            "phase_locking": np.abs(mean_phasor)
+        }
+
+    return out
+
+
+def extract_fourier_accumulators(data_dict, mon_type="v"):
+    """
+    Depth of modulation from the online Fourier accumulators (the
+    "fourier" monitor option), for runs recorded without state monitors.
+
+    The coefficient of the zero-mean trace is recovered from the running
+    integrals: X = (x_cos - mean*cos_sum) - i*(x_sin - mean*sin_sum), and
+    the DOM is 2|X|/T as in calculate_depth_of_mod. At a modulation_rate of
+    0 the DOM is |mean| (no baseline is recorded).
+
+    Returns {fname: {neuron: {"amplitude", "phase", "mean", "f_mod"}}}
+    (per unit arrays) and the neuron names.
+    """
+
+    var = {"v": "V", "ge_total": "Ge_total", "gi_total": "Gi_total"}
+    if mon_type.lower() not in var:
+        raise Exception("plot type {} not recognized".format(mon_type))
+    mon_suffix = "_{}_fourier_mon".format(var[mon_type.lower()])
+
+    monitors = {fname: {} for fname in data_dict.keys()}
+    neuron_names = []
+    for fname in data_dict.keys():
+        neuron_groups = data_dict[fname]["settings"]["neurons"].keys()
+        neuron_names.extend(list(neuron_groups))
+        net = data_dict[fname]["net"]
+        for neuron in neuron_groups:
+            mon_name = neuron + mon_suffix
+            if mon_name not in net.keys():
+                continue
+            acc = {k: np.asarray(v, dtype=float)
+                   for k, v in net[mon_name].items()}
+            duration = np.maximum(acc["t_sum"], np.finfo(float).tiny)
+            mean = acc["x_sum"] / duration
+            coeffs = (acc["x_cos"] - mean * acc["cos_sum"]) - \
+                1j * (acc["x_sin"] - mean * acc["sin_sum"])
+            is_dc = acc["f_mod"] == 0
+            monitors[fname][neuron] = {
+                "amplitude": np.where(is_dc, np.abs(mean),
+                                      2 * np.abs(coeffs) / duration),
+                "phase": np.where(is_dc, 0.0, np.angle(coeffs)),
+                "mean": mean,
+                "f_mod": acc["f_mod"]
+            }
+
+    return monitors, list(set(neuron_names))
+
+
+def extract_phase_histograms(data_dict):
+    """
+    Phase-binned spike counts of each population (the "phase_bins" monitor
+    option). "rate" is the mean rate per neuron (spk/sec) in each bin,
+    taking every bin as 1/n_bins of the time that was counted: the
+    recording window of the monitor (its start/stop), up to t_until.
+
+    Returns {fname: {neuron: {"counts", "rate", "edges"}}}, edges in
+    cycles (0 to 1) of the modulation.
+    """
+
+    monitors = {fname: {} for fname in data_dict.keys()}
+    for fname in data_dict.keys():
+        settings = data_dict[fname]["settings"]
+        net = data_dict[fname]["net"]
+        for neuron in settings["monitors"].keys():
+            mon_name = neuron + "_phase_mon"
+            if mon_name not in net.keys():
+                continue
+            states = net[mon_name]
+            n_bins = len([var for var in states.keys()
+                          if var.startswith("count_")])
+            counts = np.array([float(np.asarray(states["count_{}".format(k)])
+                                     .ravel()[0]) for k in range(n_bins)])
+            t_until = float(np.asarray(states["t_until"]).ravel()[0])
+            opts = parse_monitor_spec(settings["monitors"][neuron])
+            stop = t_until if opts["stop"] is None \
+                else min(opts["stop"], t_until)
+            duration = max(stop - (opts["start"] or 0), 0)
+            n_units = settings["afferents"]["N"] if neuron == "afferents" \
+                else settings["neurons"][neuron]["N"]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                rate = counts / (n_units * duration / n_bins)
+            monitors[fname][neuron] = {
+                "counts": counts,
+                "rate": rate,
+                "edges": np.linspace(0, 1, n_bins + 1)
+            }
+
+    return monitors
+
+
+def get_population_dom(monitors, neuron_names, tf_dict):
+    """
+    Batched version of get_all_dat_dom: the DOM of every recorded unit
+    (not just the first) of every neuron group, see batched_depth_of_mod.
+    Returns {neuron: batched_depth_of_mod output + "fids"}.
+    """
+
+    out = {}
+    for neuron in neuron_names:
+        fids = [fid for fid in monitors.keys()
+                if len(monitors[fid][neuron]['dat']) > 0]
+        traces = [monitors[fid][neuron]['dat'] for fid in fids]
+        out[neuron] = batched_depth_of_mod(
+            traces,
+            [tf_dict[fid] for fid in fids],
+            [monitors[fid][neuron]['samp_freq'] for fid in fids]
+        )
+        out[neuron]["fids"] = fids
+
+    return out
+
+
+def population_frequency_response(pop_dom, summary="mean_amplitude"):
+    """
+    [[tf, dom], ...] per neuron from get_population_dom, in the format
+    plot_frequency_response takes.
+    """
+
+    return {neuron: [[tf, dom] for tf, dom in zip(res["freqs"], res[summary])]
+            for neuron, res in pop_dom.items()}
+
+
 def get_looped_param_list(dat_dict, dict_addr):
-    glob_prefix = '{}/settings/{}'
-    globs = [glob_prefix.format(x, dict_addr) for x in dat_dict.keys()]
-    params = [dpath.util.get(dat_dict, x) for x in globs]
-    out_dict = {fid: val for fid, val in zip(dat_dict.keys(), params)}
+    out_dict = {fid: get_param(dat_dict[fid]["settings"], dict_addr)
+                for fid in dat_dict.keys()}
     return out_dict
 
 
@@ -413,7 +1375,7 @@ def plot_frequency_response(dom_dict, plot_type="overlay"):
 
     fnt_sz = 12
     N_neuron_groups = len(dom_dict)
-    cm = plt.cm.get_cmap('Dark2')
+    cm = plt.get_cmap('Dark2')
 
     if plot_type.lower() == "overlay":
         fig, axs = plt.subplots(1, 1, figsize=(10, 10))
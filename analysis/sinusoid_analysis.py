@@ -1,28 +1,62 @@
 import numpy as np
-import math
 import matplotlib.pyplot as plt
 
-    
-def onset_offset(frequency, runtime, threshold):
+
+# Brian's default clock, the dt every simulation runs (and records) at
+# unless a monitor sets a coarser one
+default_dt = 0.0001
+
+
+def onset_offset(frequency, runtime, threshold, dt=default_dt):
 
     '''
-    Returns an array of onset and offset times
+    Returns an array of onset and offset times, one entry per dt sample
     1's indicate a time of pulse onset
     -1's indicate a time of pulse offset
-    0's indicate no change in activity 
-    '''
-    # match firing_rate_array to time array assuming dt=0.1*ms
-    firing_rate_array = list(range(0, runtime*10000))
-    # translate into seconds
-    # turn into array of sine values ranging from 0 to 1
-    firing_rate_array = [math.sin(2*math.pi*t*frequency) for t in firing_rate_array]
-    thresh_arr = [0 if v<threshold else 1 for v in firing_rate_array]
-    on_off_arr = np.diff(thresh_arr)
-    # account for lost first term by appending a 0
-    on_off_arr = np.insert(on_off_arr, 0, 0, axis=0)
+    0's indicate no change in activity
+    A pulse is where sin(2*pi*frequency*t) is at or above threshold, t in
+    seconds (the afferent rate, see equations.sinusoid_rate)
+    '''
+
+    n_samples = int(np.round(runtime / dt))
+    tt = np.arange(n_samples) * dt
+    above = np.sin(2 * np.pi * frequency * tt) >= threshold
+
+    # the first sample has no previous one to change from
+    on_off_arr = np.zeros(n_samples, dtype=np.int8)
+    on_off_arr[1:] = np.diff(above.astype(np.int8))
 
     return on_off_arr
 
+
+def settings_onset_offset(settings, threshold, dt=default_dt):
+
+    '''
+    onset_offset for the stimulus of a simulation: the afferent
+    modulation_rate over the sim_time of its settings dict. dt should be
+    the dt of the recording the indices are used on
+    '''
+
+    afferents = settings["afferents"]
+    return onset_offset(afferents["modulation_rate"],
+                        afferents["sim_time"],
+                        threshold,
+                        dt)
+
+
+def pulse_indices(onsets_offsets):
+
+    '''
+    Returns dict with the indices of the beginnings ("on") and ends ("off")
+    of all the pulses given an array of onsets and offsets
+    '''
+
+    onsets_offsets = np.asarray(onsets_offsets)
+    ret = {"on": np.flatnonzero(onsets_offsets == 1),
+           "off": np.flatnonzero(onsets_offsets == -1)}
+    return ret
+
+
 def first_pulse(onsets_offsets):
 
     '''
@@ -30,25 +64,149 @@ def first_pulse(onsets_offsets):
     array of onsets and offsets
     '''
 
-    onsets_offsets = onsets_offsets.tolist()
-    on = onsets_offsets.index(1)
-    off = onsets_offsets.index(-1)
-    ret = {"on":on, "off":off}
+    pulses = pulse_indices(onsets_offsets)
+    ret = {"on": pulses["on"][0], "off": pulses["off"][0]}
     return ret
 
+
 def last_pulse(onsets_offsets):
 
     '''
     Returns dict with indices of beginning and end of last pulse given an
     array of onsets and offsets
     '''
-    
-    on = rindex(onsets_offsets, 1)
-    off = rindex(onsets_offsets, -1)
-    ret = {"on":on, "off":off}
+
+    pulses = pulse_indices(onsets_offsets)
+    ret = {"on": pulses["on"][-1], "off": pulses["off"][-1]}
     return ret
 
 
 def rindex(lst, val):
-    lst = lst.tolist()
-    return len(lst) - lst[::-1].index(val) - 1
+    return np.flatnonzero(np.asarray(lst) == val)[-1]
+
+
+def cycle_index(tt, frequency, n_phase_bins):
+
+    '''
+    Returns the stimulus cycle and the phase bin of every time in tt
+    (seconds). Cycles start where sin(2*pi*frequency*t) crosses 0 upwards,
+    ie. at the same phase as onset_offset and the afferent rate
+    '''
+
+    # count bins from t=0, a tiny offset keeps samples that fall exactly on
+    # a bin edge from being rounded into the previous bin
+    bins_elapsed = np.asarray(tt, dtype=float) * frequency * n_phase_bins
+    total_bin = np.floor(bins_elapsed + 1e-6).astype(np.int64)
+    return total_bin // n_phase_bins, total_bin % n_phase_bins
+
+
+def cycle_dom(waveforms):
+
+    '''
+    Returns the depth of modulation (as in analysis.calculate_depth_of_mod)
+    of every cycle: 2*|DFT at the stimulus frequency| / n of the zero-mean
+    waveform, for waveforms of shape cycles x phase bins (x units)
+    '''
+
+    n_bins = waveforms.shape[1]
+    phases = (np.arange(n_bins) + 0.5) / n_bins
+    basis = np.exp(-2j * np.pi * phases)
+    centered = waveforms - np.mean(waveforms, axis=1, keepdims=True)
+    coeffs = np.tensordot(centered, basis, axes=([1], [0]))
+    return 2 * np.abs(coeffs) / n_bins
+
+
+def cycle_average(per_cycle, frequency, settle_cycles=1):
+
+    '''
+    Returns the common outputs of cycle_average_trace/spikes given the
+    cycles x phase bins (x units) waveforms
+    '''
+
+    n_cycles, n_bins = per_cycle.shape[:2]
+    ret = {"phase_edges": np.linspace(0, 1, n_bins + 1),
+           "bin_times": (np.arange(n_bins) + 0.5) / n_bins / frequency,
+           "per_cycle": per_cycle,
+           "cycle_average": np.mean(per_cycle, axis=0),
+           "steady_state": np.mean(per_cycle[settle_cycles:], axis=0),
+           "cycle_amplitude": cycle_dom(per_cycle),
+           "n_cycles": n_cycles}
+    return ret
+
+
+def cycle_average_trace(trace, frequency, dt=default_dt, n_phase_bins=None,
+                        settle_cycles=1):
+
+    '''
+    Returns the cycle-averaged waveform of a recorded trace (samples, or
+    samples x units as state monitors record it) sampled every dt seconds
+    from t=0, for a stimulus modulated at frequency
+
+    Every sample is assigned its cycle and phase bin (see cycle_index) and
+    all of them are summed in one bincount. Only complete cycles are used.
+    n_phase_bins defaults to the number of samples per cycle (more bins
+    than that leaves some of them empty, nan).
+
+    Dict entries: "per_cycle" (cycles x bins x units), "cycle_average"
+    over all cycles, "steady_state" over the cycles after settle_cycles,
+    "cycle_amplitude" the DOM of every cycle (adaptation across cycles),
+    "phase_edges" in cycles and "bin_times" in seconds
+    '''
+
+    assert frequency > 0, "ERROR: no stimulus cycles at a frequency of 0"
+    vals = np.asarray(trace, dtype=float)
+    one_d = vals.ndim == 1
+    if one_d:
+        vals = vals.reshape(-1, 1)
+    n_samples, n_units = vals.shape
+    if n_phase_bins is None:
+        n_phase_bins = max(int(np.round(1 / (frequency * dt))), 1)
+
+    cycle, phase_bin = cycle_index(np.arange(n_samples) * dt, frequency,
+                                   n_phase_bins)
+    n_cycles = int(np.floor(n_samples * dt * frequency))
+    complete = cycle < n_cycles
+
+    # one combined (cycle, phase bin, unit) index for every value
+    cell = (cycle * n_phase_bins + phase_bin)[complete]
+    flat_idx = (cell[:, None] * n_units + np.arange(n_units)[None, :]).ravel()
+    n_cells = n_cycles * n_phase_bins * n_units
+    sums = np.bincount(flat_idx, weights=vals[complete].ravel(),
+                       minlength=n_cells)
+    counts = np.bincount(flat_idx, minlength=n_cells)
+    with np.errstate(invalid="ignore"):
+        per_cycle = (sums / counts).reshape(n_cycles, n_phase_bins, n_units)
+
+    ret = cycle_average(per_cycle, frequency, settle_cycles)
+    if one_d:
+        for key in ("per_cycle", "cycle_average", "steady_state",
+                    "cycle_amplitude"):
+            ret[key] = ret[key][..., 0]
+    return ret
+
+
+def cycle_average_spikes(spk_t, frequency, runtime, n_phase_bins=20,
+                         n_units=1, settle_cycles=1):
+
+    '''
+    Returns the cycle-averaged firing rate (spk/sec per unit) of a spike
+    train, eg. all the spike times of a spike monitor with n_units
+    neurons, over runtime seconds of a stimulus modulated at frequency
+
+    Spikes are counted per (cycle, phase bin) in one bincount, only
+    complete cycles are used. Same dict entries as cycle_average_trace
+    (per_cycle is cycles x bins)
+    '''
+
+    assert frequency > 0, "ERROR: no stimulus cycles at a frequency of 0"
+    n_cycles = int(np.floor(runtime * frequency))
+    cycle, phase_bin = cycle_index(spk_t, frequency, n_phase_bins)
+    complete = (cycle >= 0) & (cycle < n_cycles)
+
+    cell = cycle[complete] * n_phase_bins + phase_bin[complete]
+    counts = np.bincount(cell, minlength=n_cycles * n_phase_bins)
+    bin_duration = 1 / (frequency * n_phase_bins)
+    per_cycle = counts.reshape(n_cycles, n_phase_bins) / \
+        (bin_duration * n_units)
+
+    return cycle_average(per_cycle, frequency, settle_cycles)
@@ -0,0 +1,190 @@
+"""
+Offline spike trains for the afferents.
+
+Regular (clock-like) trains are built here as well, see regular_train.
+
+Instead of evaluating the rate of every afferent on every timestep during
+the simulation (the NeuronGroup afferents in hvasim.create_afferents), the
+whole spike train is generated up front with numpy and played back through
+a SpikeGeneratorGroup.
+
+Seeded trains are cached on disk, keyed by every parameter that determines
+the train, so repeated sweeps and reruns skip the generation entirely.
+"""
+
+import hashlib
+import numpy as np
+import os
+
+
+# version of the generated trains, part of every cache key. Bump it when a
+# change to the generation (eg. how spikes_on_grid puts spikes on the dt
+# grid) makes trains cached before it stale
+train_format_version = 2
+
+
+def sinusoid_poisson_train(N, peak_rate, modulation_rate, sim_time, dt,
+                           seed=None):
+    """
+    Sinusoidally modulated Poisson spike trains for N afferents.
+
+    The rate follows the NeuronGroup afferents (equations.sinusoid_rate):
+    peak_rate * sin(2*pi*modulation_rate*t), silent while the sine is
+    negative, and a constant peak_rate for a modulation_rate of 0.
+
+    Generated by thinning: draw a homogeneous Poisson train at peak_rate
+    for all afferents at once, then keep each spike with probability
+    rate(t) / peak_rate.
+
+    Returns (indices, times), times in seconds on the dt grid.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    # homogeneous train at the peak rate, pooled over all afferents
+    n_spikes = rng.poisson(peak_rate * sim_time * N)
+    times = rng.uniform(0, sim_time, n_spikes)
+    indices = rng.randint(0, N, n_spikes)
+
+    # thinning
+    if modulation_rate != 0:
+        rel_rate = np.sin(2 * np.pi * modulation_rate * times)
+        keep = rng.uniform(0, 1, n_spikes) < rel_rate
+        times = times[keep]
+        indices = indices[keep]
+
+    return spikes_on_grid(indices, times, dt, sim_time)
+
+
+def spikes_on_grid(indices, times, dt, sim_time):
+    """
+    Move spike times onto the dt grid and drop duplicates, since a
+    SpikeGeneratorGroup allows at most one spike per neuron per timestep.
+    Returns (indices, times) sorted by time.
+    """
+
+    n_steps = int(np.ceil(sim_time / dt))
+    steps = np.round(np.asarray(times) / dt).astype(np.int64)
+    in_range = (steps >= 0) & (steps < n_steps)
+    keys = np.asarray(indices, dtype=np.int64)[in_range] * n_steps + \
+        steps[in_range]
+
+    keys = np.unique(keys)
+    indices = keys // n_steps
+    steps = keys % n_steps
+    order = np.argsort(steps, kind="mergesort")
+    return indices[order], steps[order] * dt
+
+
+def regular_train(N, spikes_per_second, sim_time, dt, jitter=0,
+                  phase_offset=None, seed=None):
+    """
+    Regular spike trains for N afferents, built with numpy repeat/tile.
+
+    phase_offset shifts the trains: None (first spike at t=0), a number of
+    seconds (same shift for every afferent) or "random" (uniform in one
+    inter-spike interval, drawn per afferent). jitter is the standard
+    deviation (seconds) of gaussian noise added to every spike time.
+
+    Returns (indices, times), times in seconds on the dt grid.
+    """
+
+    rng = np.random.RandomState(seed)
+    isi = 1 / spikes_per_second
+    spike_arr = np.arange(0, sim_time, isi)
+    n_per_afferent = len(spike_arr)
+
+    indices = np.repeat(np.arange(N), n_per_afferent)
+    times = np.tile(spike_arr, N)
+
+    if phase_offset == "random":
+        offsets = rng.uniform(0, isi, N)
+        times += np.repeat(offsets, n_per_afferent)
+    elif phase_offset is not None:
+        times += phase_offset
+
+    if jitter:
+        times += rng.normal(0, jitter, times.size)
+
+    return spikes_on_grid(indices, times, dt, sim_time)
+
+
+def train_cache_key(N, peak_rate, modulation_rate, sim_time, dt, seed):
+    """Stable file name for a cached spike train."""
+
+    params = (train_format_version, int(N), float(peak_rate),
+              float(modulation_rate), float(sim_time), float(dt), int(seed))
+    return hashlib.sha1(repr(params).encode()).hexdigest()
+
+
+def cached_sinusoid_poisson_train(cache_dir, N, peak_rate, modulation_rate,
+                                  sim_time, dt, seed=None):
+    """
+    Same as sinusoid_poisson_train, but seeded trains are loaded from (or
+    saved to) cache_dir. Unseeded trains are never cached.
+    """
+
+    if seed is None or cache_dir is None:
+        return sinusoid_poisson_train(N, peak_rate, modulation_rate,
+                                      sim_time, dt, seed)
+
+    key = train_cache_key(N, peak_rate, modulation_rate, sim_time, dt, seed)
+    fpath = os.path.join(cache_dir, key + ".npz")
+    if os.path.exists(fpath):
+        with np.load(fpath) as cached:
+            return cached["indices"], cached["times"]
+
+    indices, times = sinusoid_poisson_train(N, peak_rate, modulation_rate,
+                                            sim_time, dt, seed)
+
+    # write to a temporary file first so a crash never leaves a partial
+    # train behind under the real key
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = "{}.{}.tmp.npz".format(os.path.join(cache_dir, key),
+                                      os.getpid())
+    np.savez(tmp_path, indices=indices, times=times)
+    os.replace(tmp_path, fpath)
+    return indices, times
+
+
+def poisson_afferent_spikes(afferent_params, dt, n_replicas=1, seed=None,
+                            cache_dir=None, sim_times=None):
+    """
+    Spike trains for settings["afferents"] with the offline engine.
+
+    For packed sweeps (n_replicas > 1) modulation_rate/peak_rate and seed
+    may be a list with one value per replica, and sim_times has the
+    sim_time of every replica (default: afferents["sim_time"] for all).
+    Each replica is a contiguous block of afferents with the same train a
+    serial run of that sweep point gets.
+
+    Returns (indices, times), times in seconds.
+    """
+
+    n_rep = afferent_params["N"] // n_replicas
+    sim_times = sim_times or [afferent_params["sim_time"]] * n_replicas
+    peak_rates = afferent_params["peak_rate"]
+    if not isinstance(peak_rates, list):
+        peak_rates = [peak_rates] * n_replicas
+    mod_rates = afferent_params["modulation_rate"]
+    if not isinstance(mod_rates, list):
+        mod_rates = [mod_rates] * n_replicas
+    seeds = seed
+    if not isinstance(seeds, list):
+        seeds = [seeds] * n_replicas
+
+    all_indices = []
+    all_times = []
+    for replica in range(n_replicas):
+        indices, times = cached_sinusoid_poisson_train(cache_dir,
+                                                       n_rep,
+                                                       peak_rates[replica],
+                                                       mod_rates[replica],
+                                                       sim_times[replica],
+                                                       dt,
+                                                       seeds[replica]
+                                                       )
+        all_indices.append(indices + replica * n_rep)
+        all_times.append(times)
+
+    return np.concatenate(all_indices), np.concatenate(all_times)
@@ -55,6 +55,27 @@ synapse_eqs = '''
     w_i : siemens
      '''
 
+# Event-driven STP (see stp_equations). D and F only matter when a
+# presynaptic spike arrives, so instead of integrating them every timestep
+# Brian2 applies the closed-form recovery (exponential relaxation to 1 over
+# the time elapsed since the last presynaptic spike) at the start of on_pre.
+# The cost then scales with the number of spikes rather than with the
+# number of synapses x timesteps. Note that monitored D/F values are only
+# updated when a spike arrives.
+
+
+def stp_equations(eqs, stp_mode='clock-driven'):
+    """
+    Return synapse equations with the STP variables integrated either every
+    timestep ('clock-driven') or only on presynaptic spikes ('event-driven')
+    """
+    assert stp_mode in ('clock-driven', 'event-driven'), \
+        "ERROR: stp_mode must be 'clock-driven' or 'event-driven'"
+    if stp_mode == 'event-driven':
+        return eqs.replace('(clock-driven)', '(event-driven)')
+    return eqs.replace('(event-driven)', '(clock-driven)')
+
+
 # On spikes the excitatory and inhibitory conductance from each
 # synapse get added to the total excitatory and inhibitory
 # conductance of the model cell
@@ -74,3 +95,41 @@ sinusoid_rate = '''
         modulation_rate : 1
         peak_rate : 1
         '''
+
+# Online analysis accumulators (see hvasim.create_monitors). A state
+# variable x of a neuron group is linked in and its running Fourier
+# coefficients at the modulation frequency f_mod are integrated every
+# timestep, along with the integrals needed to remove the mean afterwards.
+# Nothing is accumulated after t_until (shorter replicas of a packed sweep).
+fourier_accumulator_eqs = '''
+    x : {unit} (linked)
+    f_mod : Hz (constant)
+    t_until : second (constant)
+    dx_cos/dt = x*cos(2*pi*f_mod*t)*int(t < t_until) : {unit}*second
+    dx_sin/dt = x*sin(2*pi*f_mod*t)*int(t < t_until) : {unit}*second
+    dx_sum/dt = x*int(t < t_until) : {unit}*second
+    dcos_sum/dt = cos(2*pi*f_mod*t)*int(t < t_until) : second
+    dsin_sum/dt = sin(2*pi*f_mod*t)*int(t < t_until) : second
+    dt_sum/dt = int(t < t_until) : second
+    '''
+
+
+# Phase-binned spike counts: one counter element per replica with a
+# count_k variable per phase bin of the modulation cycle (bin k covers
+# phases k/n_bins to (k+1)/n_bins of a cycle). Every neuron has a single
+# synapse onto the counter of its replica; a spike computes its bin once
+# and adds 1 to that bin's count.
+def phase_bin_equations(n_bins):
+    """
+    Return the (model, on_pre) equations of a phase bin counter with
+    n_bins bins
+    """
+    model = "".join("    count_{} : 1\n".format(k) for k in range(n_bins))
+    model += """    f_mod : Hz (constant)
+    t_until : second (constant)
+    """
+    on_pre = "    phase_bin = int({}*((f_mod_post*t) % 1))\n".format(n_bins)
+    on_pre += "".join(
+        "    count_{0}_post += int(phase_bin == {0})*int(t < t_until_post)\n"
+        .format(k) for k in range(n_bins))
+    return model, on_pre
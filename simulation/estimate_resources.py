@@ -0,0 +1,28 @@
+"""
+Wrapper function to estimate the resources of a sweep before running it.
+
+Prints the simulation length, synapse count, monitor samples, memory, disk
+space and approximate runtime of every sweep point, without building or
+running anything (see hvasim.estimate_resources).
+
+1) Define the settings module (same as in run_simulation.py)
+2) Call "python3 estimate_resources.py" from terminal
+
+"""
+
+###################################
+# IMPORT THE NECESSARY MODULES    #
+###################################
+from hvasim import print_resource_estimate
+
+
+#######################################
+# USER-DEFINE: THE SIMULATION SETTINGS
+# import YYYYYY as sim_settings (YYYYY = sim_settings module name)
+import settings_sim_for_allen as sim_settings
+
+
+###################################
+# DON'T MESS WITH THE STUFF BELOW #
+###################################
+print_resource_estimate(sim_settings.settings)
@@ -1,13 +1,89 @@
 
 # import standard stuff
 import brian2 as brian
-import dpath.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import copy
 import dill as pickle
+import hashlib
+import inspect
+import json
+import numpy as np
 import os
+import re
+import shutil
 import time
+import traceback
 
 # import from within this codebase
-from make_run_settings import create_run_settings_no_enforce
+from make_run_settings import create_run_settings_no_enforce, get_run_option
+from make_run_settings import get_param, set_param, settings_to_json
+from make_run_settings import parse_monitor_spec
+from equations import stp_equations, fourier_accumulator_eqs
+from equations import phase_bin_equations
+from afferent_trains import poisson_afferent_spikes, regular_train
+
+
+# settings that are per-element variables of the model: the model variables
+# they set and the unit they are given in. Changing these does not change the
+# generated code, so they can differ between the replicas of a packed sweep
+# (see run_packed_net_and_save) or be passed to a cpp_standalone build as
+# run_args (see run_standalone_sweep)
+param_variables = {
+    "neurons": {
+        "tau_m": (["tau_m"], brian.second),
+        "R_in": (["R_in"], brian.Mohm),
+        "tau_e": (["tau_e_model"], brian.second),
+        "tau_i": (["tau_i_model"], brian.second),
+        "V_rest": (["V", "V0"], brian.volt)
+    },
+    "synapses": {
+        "d1": (["d1"], 1),
+        "d2": (["d2"], 1),
+        "f1": (["f1"], 1),
+        "f2": (["f2"], 1),
+        "tau_D1": (["tau_D1"], brian.second),
+        "tau_D2": (["tau_D2"], brian.second),
+        "tau_F1": (["tau_F1"], brian.second),
+        "tau_F2": (["tau_F2"], brian.second),
+        "w_e": (["w_e"], brian.psiemens),
+        "w_i": (["w_i"], brian.psiemens),
+        "delay": (["delay"], brian.second)
+    },
+    "afferents": {
+        "modulation_rate": (["modulation_rate"], 1),
+        "peak_rate": (["peak_rate"], 1)
+    }
+}
+
+
+# run options that change what a run saves, and so go into its run_id.
+# The others only change how it is run. Backends draw different random
+# numbers from the same seed
+result_run_options = ("result_format", "seed", "common_random_numbers",
+                      "trial", "backend")
+
+# partial runs left in the result store are removed after this long
+# (seconds) where the pid of their process can not be checked
+stale_partial_age = 24 * 3600
+
+# bytes per recorded value and per index, and the model variables Brian
+# keeps for every neuron/synapse on top of those of its equations
+value_bytes = 8
+index_bytes = 4
+internal_variables = 3
+
+# peak memory of a monitor relative to its recorded data: Brian's arrays
+# grow by doubling and net.get_states copies them once more
+monitor_overhead = 3
+
+# rough cost (sec) of one timestep of a code object, of one element
+# updated in a timestep and of one synaptic event. Order of magnitude
+# only, "auto" is taken as numpy
+runtime_costs = {
+    "numpy": {"code_object": 3e-5, "element": 1e-8, "event": 5e-8},
+    "cython": {"code_object": 3e-6, "element": 3e-9, "event": 1e-8},
+    "cpp_standalone": {"code_object": 1e-7, "element": 2e-9, "event": 5e-9}
+}
 
 
 def run_simulations(sim_settings, description, dat_path):
@@ -15,50 +91,675 @@ def run_simulations(sim_settings, description, dat_path):
     Run several simulations based on sim_settings passed containing a list
     of values as the key for the parameter you want to modify per simulation
 
-    Each simulation will be pickled and saved to networks directory
+    Each simulation is saved as network_data_run_<n> in a new directory of
+    dat_path. settings["run"]["result_format"] selects how: "columnar"
+    (default) is a directory with one .npy file per recorded variable and
+    a manifest.json (see save_columnar_data), "pickle" a single pickle of
+    the whole run (network_data_run_<n>.p, see save_simulation_data)
 
     Pass in string description for distinguishing purpose of simulation
+
+    settings["run"]["sweep_mode"] selects how the sweep points are run:
+    "serial" runs them one after another, "process" farms them out to a
+    pool of settings["run"]["workers"] processes (default: one per core),
+    "packed" runs every sweep point as a replica inside a single network
+    (only for sweeps over per-neuron/per-synapse params, see can_pack_sweep)
+    and "reuse" builds the network once and restores/patches it for every
+    sweep point (see can_reuse_network)
+
+    settings["run"]["backend"] selects the code generation target: "auto",
+    "numpy", "cython" or "cpp_standalone". Compiled code is kept in
+    settings["run"]["code_cache_dir"] so it is reused across sweep points
+    and across sweeps (see warm_code_cache).
+
+    Every finished seeded sweep point is kept in a result store (see
+    run_id) and linked into the new data directory. Points already in the
+    store are not run again (settings["run"]["skip_completed"]), so an
+    interrupted sweep restarts where it stopped and identical points of
+    different sweeps are only run once. This needs settings["run"]["seed"]:
+    unseeded points can not be reproduced, they are always run and saved
+    in the data directory only (see is_stored_run), and an interrupted
+    unseeded sweep restarts from its first point.
+
+    With settings["run"]["memory_budget"] (GB) the memory of the sweep is
+    estimated first (see estimate_resources) and a sweep over budget is
+    refused or its state monitors decimated (see enforce_memory_budget).
     """
 
+    # load default settings, override with the sim_settings where present
+    (list_path, run_settings) = create_run_settings_no_enforce(sim_settings)
+    sweep_settings = make_sweep_settings(run_settings, list_path)
+    sweep_mode = resolve_sweep_mode(run_settings, list_path)
+    enforce_memory_budget(run_settings, sweep_settings, sweep_mode)
+
+    backend = get_run_option(run_settings, "backend")
+    if get_run_option(run_settings, "profile") and \
+            (sweep_mode == "packed" or backend == "cpp_standalone"):
+        raise RuntimeError(
+            "profile is only supported for serial, process and reuse sweeps "
+            "on the numpy and cython backends")
+    select_backend(run_settings)
+
     # generate a new directory for saved data in the dat_path location
     sim_data_path = make_data_directory(dat_path)
     print("Saving to: {}".format(sim_data_path))
 
+    # sweep points already in the result store are only linked in
+    remove_stale_partial_runs(get_result_store(run_settings, sim_data_path))
+    sweep_settings = link_completed_runs(sweep_settings, sim_data_path)
+    if len(sweep_settings) == 0:
+        print("Every sweep point was already completed")
+        return
+    if sweep_mode == "packed" and len(sweep_settings) == 1:
+        sweep_mode = "serial"
+
+    if sweep_mode == "process":
+        workers = get_run_option(run_settings, "workers") or os.cpu_count()
+        failures = run_sweep_in_pool(sweep_settings,
+                                     description,
+                                     sim_data_path,
+                                     workers
+                                     )
+        if len(failures) == len(sweep_settings):
+            if len(os.listdir(sim_data_path)) == 0:
+                os.rmdir(sim_data_path)
+            raise RuntimeError("Simulation failed at every sweep point")
+        elif len(failures) > 0:
+            print("Simulation finished. Failed runs: {}".format(
+                sorted(failures.keys())))
+        else:
+            print("Simulation successful")
+        return
+
     # loop over params in the list and run the simulation
     try:
-        # load default settings, override with the sim_settings where present
-        (list_path, run_settings) = create_run_settings_no_enforce(sim_settings)
-        if len(list_path) == 0:
-            loop_settings = run_settings.copy()
-            run_net_and_save(loop_settings, description, sim_data_path, 1)
+        if sweep_mode == "packed":
+            if backend == "cpp_standalone":
+                packed_dir = os.path.join(get_code_cache_dir(run_settings),
+                                          "standalone",
+                                          "packed_" + code_structure_hash(
+                                              run_settings, ""))
+                brian.set_device("cpp_standalone",
+                                 directory=packed_dir,
+                                 build_on_run=True
+                                 )
+            run_packed_net_and_save(run_settings,
+                                    list_path,
+                                    sweep_settings,
+                                    description,
+                                    sim_data_path
+                                    )
+        elif sweep_mode == "reuse":
+            run_reused_net_and_save(sweep_settings,
+                                    list_path,
+                                    description,
+                                    sim_data_path
+                                    )
+        elif backend == "cpp_standalone":
+            run_standalone_sweep(sweep_settings,
+                                 list_path,
+                                 description,
+                                 sim_data_path
+                                 )
         else:
-            param_list_vals = dpath.util.get(run_settings, list_path)
-            for i_run in range(len(param_list_vals)):
-                loop_settings = run_settings.copy()
-                dpath.util.set(loop_settings,
-                               list_path,
-                               param_list_vals[i_run]
-                               )
+            for file_num, loop_settings in sweep_settings:
                 run_net_and_save(loop_settings,
                                  description,
                                  sim_data_path,
-                                 i_run
+                                 file_num
                                  )
         print("Simulation successful")
 
     except Exception:
         os.chdir(dat_path)
-        os.rmdir(sim_data_path)
-        print("Simulation failed. Delete empty directories")
+        if len(os.listdir(sim_data_path)) == 0:
+            os.rmdir(sim_data_path)
+            print("Simulation failed. Delete empty directories")
         raise
 
     return
 
 
+def resolve_sweep_mode(run_settings, list_path):
+    """
+    The sweep mode a sweep actually runs in: settings["run"]["sweep_mode"],
+    or "serial" when the sweep or the backend does not allow it
+    """
+
+    sweep_mode = get_run_option(run_settings, "sweep_mode")
+    if sweep_mode == "packed" and not can_pack_sweep(run_settings, list_path):
+        print("Cannot pack a sweep over '{}'. Running serially".format(
+            list_path))
+        sweep_mode = "serial"
+    if sweep_mode == "reuse" and not can_reuse_network(run_settings,
+                                                       list_path):
+        print("Cannot reuse the network for a sweep over '{}'. "
+              "Running serially".format(list_path))
+        sweep_mode = "serial"
+
+    if sweep_mode == "reuse" and \
+            get_run_option(run_settings, "seed") is not None and \
+            not get_run_option(run_settings, "common_random_numbers"):
+        print("Seeded sweep points have their own connectivity. "
+              "Running serially")
+        sweep_mode = "serial"
+    if sweep_mode == "packed" and \
+            get_run_option(run_settings, "seed") is not None:
+        print("Packed replicas share the random numbers of the run. "
+              "Running a seeded sweep serially")
+        sweep_mode = "serial"
+
+    backend = get_run_option(run_settings, "backend")
+    if backend == "cpp_standalone" and sweep_mode in ("process", "reuse"):
+        print("cpp_standalone builds are reused in-process. Running serially")
+        sweep_mode = "serial"
+    return sweep_mode
+
+
+def make_sweep_settings(run_settings, list_path):
+    """
+    Return a list of (file_num, settings) pairs, one per sweep point.
+
+    Each settings dict is an independent deep copy with the swept parameter
+    set to a single value. With settings["run"]["trials"] > 1 every value
+    is run that many times, settings["run"]["trial"] numbers the repeats
+    (see derive_seed).
+    """
+
+    trials = get_run_option(run_settings, "trials")
+    if len(list_path) == 0:
+        return [(trial + 1, set_trial(copy.deepcopy(run_settings), trial))
+                for trial in range(trials)]
+
+    sweep_settings = []
+    param_list_vals = get_param(run_settings, list_path)
+    for i_run in range(len(param_list_vals)):
+        for trial in range(trials):
+            loop_settings = copy.deepcopy(run_settings)
+            set_param(loop_settings, list_path, param_list_vals[i_run])
+            set_trial(loop_settings, trial)
+            sweep_settings.append((i_run * trials + trial, loop_settings))
+    return sweep_settings
+
+
+def set_trial(settings_dict, trial):
+    """Set the trial number of a sweep point, returns the settings"""
+
+    settings_dict["run"] = dict(settings_dict.get("run") or {}, trial=trial)
+    return settings_dict
+
+
+def derive_seed(settings_dict, stream, name=""):
+    """
+    Seed of one random stream of a sweep point, derived from
+    settings["run"]["seed"] (None, ie. unseeded, when that is None).
+
+    The streams are "connectivity" (one per synapse name), "afferents"
+    (the spike trains made before the run) and "run" (rand() during the
+    run, eg. the Poisson afferents). Afferent and run seeds change with
+    the trial, connectivity seeds do not. Every sweep point gets its own
+    seeds, unless settings["run"]["common_random_numbers"] is set: then
+    all values of a sweep share them and differ only by the swept param.
+    What is recorded (settings["monitors"]) does not change the seeds, so
+    eg. decimating monitors (see enforce_memory_budget) runs the same
+    network.
+    """
+
+    seed = get_run_option(settings_dict, "seed")
+    if seed is None:
+        return None
+    parts = [str(seed), stream, name]
+    if stream != "connectivity":
+        parts.append(str(get_run_option(settings_dict, "trial")))
+    if not get_run_option(settings_dict, "common_random_numbers"):
+        model = {key: val for key, val in settings_dict.items()
+                 if key != "monitors"}
+        parts.append(run_id(model, ()))
+    digest = hashlib.sha1("/".join(parts).encode()).hexdigest()
+    return int(digest[:8], 16)
+
+
+def run_sweep_in_pool(sweep_settings, description, sim_data_path, workers):
+    """
+    Run each sweep point in its own worker process.
+
+    Every worker builds, runs and saves its own network into sim_data_path.
+    Returns a dict of {file_num: traceback string} for the failed points.
+
+    Forked workers start with a copy of the random state of this process,
+    so every point also gets a fresh seed of its own, used where the point
+    is unseeded (see derive_seed).
+    """
+
+    worker_seeds = np.random.SeedSequence().spawn(len(sweep_settings))
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_sweep_point,
+                               loop_settings,
+                               description,
+                               sim_data_path,
+                               file_num,
+                               int(worker_seed.generate_state(1)[0])
+                               ): file_num
+                   for (file_num, loop_settings), worker_seed in zip(
+                       sweep_settings, worker_seeds)}
+
+        for future in as_completed(futures):
+            file_num = futures[future]
+            try:
+                error = future.result()
+            except Exception as err:  # e.g. the worker process died
+                error = repr(err)
+
+            if error is None:
+                print("  Finished network {}".format(file_num))
+            else:
+                failures[file_num] = error
+                print("  Network {} failed:\n{}".format(file_num, error))
+
+    return failures
+
+
+def run_sweep_point(settings_dict, description, sim_data_path, file_num,
+                    worker_seed=None):
+    """
+    Worker entry point. Returns None on success, or the formatted traceback
+    so that one bad point does not abort the rest of the sweep.
+
+    worker_seed seeds the random numbers of the worker, the seeds derived
+    from settings["run"]["seed"] (if any) are applied over it.
+    """
+
+    try:
+        seed_random(worker_seed)
+        select_backend(settings_dict)
+        run_net_and_save(settings_dict, description, sim_data_path, file_num)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def get_code_cache_dir(settings_dict):
+    """Return the directory holding compiled code for all sweeps."""
+
+    cache_dir = get_run_option(settings_dict, "code_cache_dir")
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser("~"), ".hvasim_code_cache")
+    return cache_dir
+
+
+def get_train_cache_dir(settings_dict):
+    """Return the directory holding cached offline afferent spike trains."""
+
+    cache_dir = get_run_option(settings_dict, "train_cache_dir")
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser("~"),
+                                 ".hvasim_train_cache")
+    return cache_dir
+
+
+def select_backend(settings_dict):
+    """
+    Set Brian2's code generation target from settings["run"]["backend"].
+
+    The cython cache is pointed at the persistent code cache directory, so
+    sweep points (and later sweeps) with identical equations only compile
+    once. cpp_standalone devices are set up per build, see
+    run_standalone_sweep.
+    """
+
+    backend = get_run_option(settings_dict, "backend")
+    assert backend in ("auto", "numpy", "cython", "cpp_standalone"), \
+        "ERROR: unknown backend {}".format(backend)
+
+    if backend == "cpp_standalone":
+        return
+    brian.prefs.codegen.target = backend
+    if backend == "cython":
+        cython_dir = os.path.join(get_code_cache_dir(settings_dict), "cython")
+        brian.prefs.codegen.runtime.cython.cache_dir = cython_dir
+    return
+
+
+def code_structure_hash(settings_dict, list_path):
+    """
+    Hash of everything that goes into the generated code of a sweep point.
+
+    A swept param that is a model variable (see param_variables) is left out,
+    so sweep points that only differ in that value share a standalone build.
+    So is the sim_time it sets (see predicted_sim_length): a build runs for
+    the longest point and the rest are cut, see run_standalone_sweep.
+    A modulation_rate of 0 switches the afferent model, so it is kept apart.
+
+    A build keeps the random seeds it was made with, so the seeds of the
+    point (see derive_seed) go in instead of the trial number.
+    """
+
+    structure = copy.deepcopy(settings_dict)
+    if is_param_variable(list_path, settings_dict):
+        value = get_param(structure, list_path)
+        set_param(structure, list_path, "zero" if value == 0 else "swept")
+        structure["afferents"]["sim_time"] = "run_args"
+    structure["run"] = {key: val
+                        for key, val in (structure.get("run") or {}).items()
+                        if key != "trial"}
+    structure["seeds"] = [derive_seed(settings_dict, "run"),
+                          derive_seed(settings_dict, "afferents")]
+    structure["seeds"] += [derive_seed(settings_dict, "connectivity", str(syn))
+                           for syn in settings_dict["synapses"]]
+    return hashlib.sha1(repr(structure).encode()).hexdigest()[:16]
+
+
+def is_param_variable(list_path, settings_dict):
+    """
+    Check if a param path points at a model variable (param_variables).
+    Offline afferents have their rates baked into the spike train, so their
+    params are not model variables.
+    """
+
+    if len(list_path) == 0:
+        return False
+    section = list_path.strip("/").split("/")[0]
+    key = list_path.strip("/").split("/")[-1]
+    if section == "afferents" and is_offline_afferents(settings_dict):
+        return False
+    return key in param_variables.get(section, {})
+
+
+def is_offline_afferents(settings_dict):
+    """Check if the afferents are generated offline (see create_afferents)"""
+
+    afferent_params = settings_dict["afferents"]
+    return (afferent_params["use_poisson"] and
+            afferent_params.get("engine") == "offline")
+
+
+def locate_param_variables(net, settings_dict, list_path):
+    """
+    Find the model variables that the swept param of a sweep point sets.
+    Returns a list of (object, variable name, value with units).
+    """
+
+    if not is_param_variable(list_path, settings_dict):
+        return []
+
+    keys = list_path.strip("/").split("/")
+    section = keys[0]
+    if section == "neurons":
+        obj_name = keys[1]
+    elif section == "synapses":
+        syn_key = [k for k in settings_dict["synapses"] if str(k) == keys[1]]
+        obj_name = "{}_{}_synapse".format(*syn_key[0])
+    else:
+        obj_name = "afferents"
+
+    var_names, unit = param_variables[section][keys[-1]]
+    value = get_param(settings_dict, list_path) * unit
+    obj = net[obj_name]
+    if keys[-1] == "delay":
+        obj = obj.pre  # synaptic delays live on the pathway
+    located = [(obj, var, value) for var in var_names]
+
+    # online accumulators follow the stimulus (see create_monitors)
+    if keys[-1] == "modulation_rate":
+        sim_time = settings_dict["afferents"]["sim_time"] * brian.second
+        for acc in net.objects:
+            if "f_mod" in getattr(acc, "variables", {}):
+                located.append((acc, "f_mod", value * brian.Hz))
+                located.append((acc, "t_until", sim_time))
+    return located
+
+
+def make_run_args(net, settings_dict, list_path):
+    """
+    The swept param of a sweep point in the {variable: value} form used by
+    cpp_standalone run_args.
+    """
+
+    located = locate_param_variables(net, settings_dict, list_path)
+    return {getattr(obj, var): value for obj, var, value in located}
+
+
+def standalone_supports_run_args():
+    """run_args (rerun a build with new values) needs Brian2 >= 2.6"""
+
+    device_run = brian.devices.all_devices["cpp_standalone"].run
+    return "run_args" in inspect.signature(device_run).parameters
+
+
+def run_standalone_sweep(sweep_settings, list_path, description,
+                         sim_data_path):
+    """
+    Run a sweep on the cpp_standalone device.
+
+    Each distinct code structure (see code_structure_hash) is built once in
+    its own directory of the code cache, for the longest sim_length of its
+    sweep points. Sweep points that only differ in a model variable rerun
+    the same binary with new run_args, so they pay only for the simulation
+    and not for code generation and compilation. Their recordings are cut
+    at their own sim_length.
+    """
+
+    for structure_hash, points in group_by_structure(sweep_settings,
+                                                     list_path).items():
+        directory = os.path.join(get_code_cache_dir(points[0][1]),
+                                 "standalone",
+                                 structure_hash
+                                 )
+        if standalone_supports_run_args():
+            builds = [points]
+        else:
+            builds = [[point] for point in points]
+
+        for build_points in builds:
+            build_settings = longest_sweep_point(build_points)
+            build_length = build_settings["afferents"]["sim_time"]
+            print("  Building network {} in {}".format(build_points[0][0],
+                                                       directory))
+            net = build_standalone(build_settings, build_length, directory)
+
+            for file_num, loop_settings in build_points:
+                sim_length = loop_settings["afferents"]["sim_time"]
+                print("  Running network {}".format(file_num))
+                print("    Total simulation time: ", sim_length)
+                if standalone_supports_run_args():
+                    brian.device.run(directory=directory,
+                                     with_output=False,
+                                     run_args=make_run_args(net,
+                                                            loop_settings,
+                                                            list_path)
+                                     )
+                else:
+                    brian.device.run(directory=directory, with_output=False)
+
+                save_run(split_packed_states(net.get_states(),
+                                             1,
+                                             0,
+                                             sim_length),
+                         loop_settings,
+                         description,
+                         sim_data_path,
+                         file_num
+                         )
+
+    return
+
+
+def group_by_structure(sweep_settings, list_path):
+    """
+    Group the (file_num, settings) pairs of a sweep by their code structure
+    (see code_structure_hash), in sweep order. The sim_length of every
+    point is resolved on the way.
+    """
+
+    groups = {}
+    for file_num, loop_settings in sweep_settings:
+        resolve_sim_length(loop_settings)
+        structure_hash = code_structure_hash(loop_settings, list_path)
+        groups.setdefault(structure_hash, []).append((file_num,
+                                                      loop_settings))
+    return groups
+
+
+def longest_sweep_point(points):
+    """
+    Settings to build a group of sweep points with: the first point, run
+    for the longest sim_length of the group
+    """
+
+    build_settings = copy.deepcopy(points[0][1])
+    build_settings["afferents"]["sim_time"] = max(
+        s["afferents"]["sim_time"] for _, s in points)
+    return build_settings
+
+
+def build_standalone(settings_dict, sim_length, directory):
+    """
+    Generate and compile (but do not run) a cpp_standalone project for a
+    sweep point. make only recompiles files that changed, so a directory
+    prepared by warm_code_cache is ready to run immediately.
+    """
+
+    brian.device.reinit()
+    brian.set_device("cpp_standalone", directory=directory, build_on_run=False)
+    net = create_network(settings_dict)
+    seed_random(derive_seed(settings_dict, "run"))
+    run_network(net, settings_dict, sim_length)
+    brian.device.build(directory=directory, compile=True, run=False)
+    return net
+
+
+def warm_code_cache(sim_settings):
+    """
+    Pre-build the code cache for every distinct code structure of a sweep,
+    so that the sweep itself only pays for running the simulations.
+
+    cython: run each structure for one timestep, which compiles every code
+    object into the cache. cpp_standalone: generate and compile the project.
+    """
+
+    (list_path, run_settings) = create_run_settings_no_enforce(sim_settings)
+    backend = get_run_option(run_settings, "backend")
+    if backend not in ("cython", "cpp_standalone"):
+        print("Backend {} has no code cache to warm up".format(backend))
+        return
+
+    select_backend(run_settings)
+    groups = group_by_structure(make_sweep_settings(run_settings, list_path),
+                                list_path)
+    for structure_hash, points in groups.items():
+        print("  Building code for network {}".format(points[0][0]))
+        build_settings = longest_sweep_point(points)
+        if backend == "cython":
+            net = create_network(build_settings)
+            net.run(brian.defaultclock.dt)
+        else:
+            directory = os.path.join(get_code_cache_dir(build_settings),
+                                     "standalone",
+                                     structure_hash
+                                     )
+            build_standalone(build_settings,
+                             build_settings["afferents"]["sim_time"],
+                             directory
+                             )
+
+    print("Code cache ready for {} network(s)".format(len(groups)))
+    return
+
+
 def run_net_and_save(settings_dict, description, sim_data_path, file_num):
 
     # run the simulation
+    sim_length = resolve_sim_length(settings_dict)
+    wall_clock = {}
+    start = time.time()
     net = create_network(settings_dict)
+    wall_clock["build"] = time.time() - start
+
+    print("  Running network {}".format(file_num))
+    print("    Total simulation time: ", sim_length)
+    profile, code_objects = start_profile(net, settings_dict, wall_clock)
+    stream_path = get_stream_path(settings_dict, sim_data_path, file_num)
+    seed_random(derive_seed(settings_dict, "run"))
+    start = time.time()
+    streamed = run_network(net, settings_dict, sim_length, stream_path,
+                           code_objects)
+    wall_clock["run"] = time.time() - start
+
+    # save the simulation
+    save_run(net.get_states(),
+             settings_dict,
+             description,
+             sim_data_path,
+             file_num,
+             streamed,
+             profile
+             )
+
+    return
+
+
+def start_profile(net, settings_dict, wall_clock):
+    """
+    With settings["run"]["profile"] set, compile the network and start its
+    profile. Returns the profile to save with the run and the dict that
+    run_network fills with the time of every code object, both None
+    without profiling.
+    """
+
+    if not get_run_option(settings_dict, "profile"):
+        return None, None
+
+    # a run of length 0 generates and compiles the code of every object
+    start = time.time()
+    net.run(0 * brian.second)
+    wall_clock["compile"] = time.time() - start
+    code_objects = {}
+    return {"code_objects": code_objects, "wall_clock": wall_clock}, \
+        code_objects
+
+
+def record_save_time(data_to_save, fpath, save_time):
+    """
+    Add the time it took to save a profiled run (in fpath) to its profile.
+    Columnar runs get it in their manifest (rewritten atomically), pickled
+    runs are written again with it.
+    """
+
+    print("    Saved in {:.2f} s".format(save_time))
+    data_to_save["profile"]["wall_clock"]["save"] = save_time
+    if get_run_option(data_to_save["settings"],
+                      "result_format") != "columnar":
+        save_simulation_data(data_to_save, fpath)
+        return
+
+    with open(os.path.join(fpath, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    manifest["profile"]["wall_clock"]["save"] = save_time
+    tmp_path = os.path.join(fpath, "manifest.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(fpath, "manifest.json"))
+    return
+
+
+def resolve_sim_length(settings_dict):
+    """
+    Return the simulation length (in seconds) for a single sweep point.
+    The value is also written back to settings["afferents"]["sim_time"]
+    """
+
+    sim_length = predicted_sim_length(settings_dict)
+    settings_dict["afferents"]["sim_time"] = sim_length
+    return sim_length
+
+
+def predicted_sim_length(settings_dict):
+    """
+    The simulation length (in seconds) resolve_sim_length gives a sweep
+    point, without changing its settings
+    """
+
     sim_length = settings_dict["afferents"]["sim_time"]
 
     # a quick hack to make the simulations run faster for high freq afferents
@@ -66,25 +767,790 @@ def run_net_and_save(settings_dict, description, sim_data_path, file_num):
         tf = settings_dict["afferents"]["modulation_rate"]
         sim_length = brian.np.ceil(1 / tf * 5)  # seconds for 5 temp periods
         sim_length = brian.np.max([sim_length, 2])  # min sim_length is 2 sec
-        settings_dict["afferents"]["sim_time"] = sim_length
 
-    print("  Running network {}".format(file_num))
-    print("    Total simulation time: ", sim_length)
-    net.run(sim_length * brian.second)
+    return sim_length
+
+
+def estimate_resources(settings_dict):
+    """
+    Predict what the run of one sweep point needs, without building it.
+
+    Counts synapses (N_pre * N_post * p_connect), timesteps, spikes and
+    monitor samples, and from those the peak memory and the disk space
+    (bytes) and a rough runtime (seconds, see runtime_costs). Afferents
+    fire at the mean of their rate (peak_rate/pi for sinusoids), neurons
+    are assumed to fire at the mean afferent rate, at most 1/refract.
+
+    Returns a dict with "sim_length", "n_steps", "n_synapses",
+    "synaptic_events", "spikes" and "monitor_samples" (per group/monitor),
+    "monitor_bytes" (per monitor), "memory", "disk" and "runtime"
+    """
+
+    dt = brian.defaultclock.dt / brian.second
+    sim_length = float(predicted_sim_length(settings_dict))
+    n_steps = int(np.ceil(sim_length / dt))
+
+    # group sizes, firing rates and the bytes of their state
+    afferent_params = settings_dict["afferents"]
+    afferent_rate = mean_afferent_rate(afferent_params)
+    sizes = {"afferents": afferent_params["N"]}
+    spikes = {"afferents": afferent_rate * afferent_params["N"] * sim_length}
+    state_bytes = 0
+    per_step = 0  # elements updated every timestep
+    n_code_objects = 1
+    offline = not afferent_params["use_poisson"] or \
+        is_offline_afferents(settings_dict)
+    if offline:
+        # the SpikeGeneratorGroup keeps the whole train
+        state_bytes += spikes["afferents"] * (index_bytes + value_bytes)
+    else:
+        per_step += afferent_params["N"]
+        n_code_objects += 1
+    for neuron, vals in settings_dict["neurons"].items():
+        sizes[neuron] = vals["N"]
+        rate = min(afferent_rate, 1 / vals["refract"])
+        spikes[neuron] = rate * vals["N"] * sim_length
+        state_bytes += vals["N"] * value_bytes * \
+            (model_variable_count(vals["eqs"]) + internal_variables)
+        per_step += vals["N"]
+        n_code_objects += 3  # state update, threshold and reset
+
+    # synapses: their state, and the events their pre groups send through
+    n_synapses = {}
+    synaptic_events = 0
+    for (pre, post), variables in settings_dict["synapses"].items():
+        syn_name = "{}_{}_synapse".format(pre, post)
+        n_syn = sizes[pre] * sizes[post] * np.mean(variables["p_connect"])
+        n_synapses[syn_name] = int(n_syn)
+        synaptic_events += spikes[pre] * sizes[post] * \
+            np.mean(variables["p_connect"])
+        n_vars = model_variable_count(variables["eqs"]) + internal_variables
+        state_bytes += n_syn * (n_vars * value_bytes + 4 * index_bytes)
+        n_code_objects += 1
+        if (variables.get("stp_mode") or "clock-driven") == "clock-driven":
+            per_step += n_syn
+            n_code_objects += 1
+
+    # monitors
+    monitor_samples = {}
+    monitor_bytes = {}
+    for neuron_name, spec in settings_dict["monitors"].items():
+        opts = parse_monitor_spec(spec)
+        start = opts["start"] or 0
+        stop = sim_length if opts["stop"] is None else opts["stop"]
+        window = max(min(stop, sim_length) - start, 0)
+        n_rec = sizes[neuron_name] if opts["indices"] is None \
+            else len(opts["indices"])
+        for mon in opts["record"]:
+            mon_name = monitor_name(neuron_name, mon)
+            n_code_objects += 1
+            if mon == "spikes":
+                samples = spikes[neuron_name] * window / sim_length
+                nbytes = samples * (index_bytes + value_bytes)
+            elif mon == "rate":
+                samples = window / dt
+                nbytes = samples * 2 * value_bytes
+            else:
+                n_times = np.ceil(window / (opts["dt"] or dt))
+                samples = n_times * n_rec
+                nbytes = (samples + n_times) * value_bytes
+                per_step += n_rec * dt / (opts["dt"] or dt)
+            monitor_samples[mon_name] = int(samples)
+            monitor_bytes[mon_name] = nbytes
+
+        # online accumulators: constant size
+        for var in opts["fourier"]:
+            mon_name = monitor_name(neuron_name, var + "_fourier")
+            monitor_bytes[mon_name] = sizes[neuron_name] * 9 * value_bytes
+            per_step += sizes[neuron_name]
+            n_code_objects += 1
+        if opts["phase_bins"]:
+            mon_name = monitor_name(neuron_name, "phase")
+            monitor_bytes[mon_name] = (opts["phase_bins"] + 2) * \
+                value_bytes + sizes[neuron_name] * 4 * index_bytes
+            synaptic_events += spikes[neuron_name]
+            n_code_objects += 1
+
+    # monitors in memory: the slack of Brian's growing arrays plus the copy
+    # net.get_states makes. Streamed runs only hold one segment at a time
+    recorded = sum(monitor_bytes.values())
+    in_memory = recorded * monitor_overhead
+    segment_time = get_run_option(settings_dict, "segment_time")
+    if segment_time is not None and \
+            get_run_option(settings_dict, "result_format") == "columnar":
+        in_memory *= min(segment_time / sim_length, 1)
+
+    backend = get_run_option(settings_dict, "backend")
+    costs = runtime_costs.get(backend, runtime_costs["numpy"])
+    runtime = n_steps * (n_code_objects * costs["code_object"] +
+                         per_step * costs["element"]) + \
+        synaptic_events * costs["event"]
+
+    return {"sim_length": sim_length,
+            "n_steps": n_steps,
+            "n_synapses": n_synapses,
+            "synaptic_events": int(synaptic_events),
+            "spikes": {name: int(n) for name, n in spikes.items()},
+            "monitor_samples": monitor_samples,
+            "monitor_bytes": monitor_bytes,
+            "memory": int(state_bytes + in_memory),
+            "disk": int(state_bytes + recorded),
+            "runtime": runtime}
+
+
+def mean_afferent_rate(afferent_params):
+    """Mean firing rate (spk/sec) of one afferent, see create_afferents"""
+
+    if not afferent_params["use_poisson"]:
+        return afferent_params["spikes_per_second"]
+    peak_rate = np.mean(afferent_params["peak_rate"])
+    if np.all(np.asarray(afferent_params["modulation_rate"]) == 0):
+        return peak_rate
+    # the rate follows the positive half of the sine
+    return peak_rate / np.pi
+
+
+def model_variable_count(eqs):
+    """Number of variables an equations string defines"""
+
+    return sum(1 for line in eqs.splitlines() if ":" in line)
+
+
+def estimate_sweep(sim_settings):
+    """
+    Dry run of run_simulations: estimate_resources for every sweep point.
+    Returns a list of (file_num, estimate) and the memory the sweep needs
+    at once (see sweep_memory)
+    """
+
+    (list_path, run_settings) = create_run_settings_no_enforce(sim_settings)
+    sweep_settings = make_sweep_settings(run_settings, list_path)
+    sweep_mode = resolve_sweep_mode(run_settings, list_path)
+    estimates = [(file_num, estimate_resources(loop_settings))
+                 for file_num, loop_settings in sweep_settings]
+    return estimates, sweep_memory(run_settings, estimates, sweep_mode)
+
+
+def print_resource_estimate(sim_settings):
+    """Print the estimate_sweep of a simulation settings dict"""
+
+    estimates, memory = estimate_sweep(sim_settings)
+    print("{:>6s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s} {:>9s}".format(
+        "run", "sim (s)", "synapses", "samples", "memory", "disk",
+        "time (s)"))
+    for file_num, estimate in estimates:
+        print("{:>6} {:>8.1f} {:>10d} {:>10d} {:>10s} {:>10s} {:>9.0f}".format(
+            file_num,
+            estimate["sim_length"],
+            sum(estimate["n_synapses"].values()),
+            sum(estimate["monitor_samples"].values()),
+            format_bytes(estimate["memory"]),
+            format_bytes(estimate["disk"]),
+            estimate["runtime"]))
+    print("Memory at once: {}, disk: {}, runtime: {:.0f} s".format(
+        format_bytes(memory),
+        format_bytes(sum(e["disk"] for _, e in estimates)),
+        sum(e["runtime"] for _, e in estimates)))
+    return
+
+
+def format_bytes(n_bytes):
+    """Human readable size, eg. 1.5 GB"""
+
+    for unit in ("B", "kB", "MB", "GB"):
+        if n_bytes < 1000:
+            return "{:.1f} {}".format(n_bytes, unit)
+        n_bytes /= 1000
+    return "{:.1f} TB".format(n_bytes)
+
+
+def sweep_memory(run_settings, estimates, sweep_mode):
+    """
+    Peak memory (bytes) of a sweep: one point at a time for serial and
+    reused runs, the largest points of a pool running side by side, all
+    the replicas of a packed network at once
+    """
+
+    memory = sorted((estimate["memory"] for _, estimate in estimates),
+                    reverse=True)
+    if sweep_mode == "packed":
+        return sum(memory)
+    if sweep_mode == "process":
+        workers = get_run_option(run_settings, "workers") or os.cpu_count()
+        return sum(memory[:workers])
+    return memory[0]
+
+
+def enforce_memory_budget(run_settings, sweep_settings, sweep_mode):
+    """
+    Check the predicted memory of a sweep against
+    settings["run"]["memory_budget"] (GB) before anything runs.
+
+    Over budget, settings["run"]["budget_action"] either refuses the sweep
+    ("refuse") or makes every state monitor sample at a coarser dt, the
+    same for every sweep point, until the sweep fits ("decimate"). Spike
+    monitors and the network itself are never decimated.
+    """
+
+    budget = get_run_option(run_settings, "memory_budget")
+    if budget is None:
+        return
+    action = get_run_option(run_settings, "budget_action")
+    assert action in ("refuse", "decimate"), \
+        "ERROR: unknown budget_action {}".format(action)
+    budget_bytes = budget * 1e9
+
+    factor = 1
+    last_memory = None
+    while True:
+        estimates = [(file_num, estimate_resources(loop_settings))
+                     for file_num, loop_settings in sweep_settings]
+        memory = sweep_memory(run_settings, estimates, sweep_mode)
+        if memory <= budget_bytes:
+            break
+        # refuse, or decimating further does not help any more
+        if action == "refuse" or memory == last_memory:
+            raise RuntimeError(
+                "The sweep needs about {} of memory, the budget is {} GB. "
+                "Record fewer neurons, a coarser monitor dt or a shorter "
+                "window, stream monitors (segment_time) or use online "
+                "accumulators (fourier/phase_bins)".format(
+                    format_bytes(memory), budget))
+        # try the next coarser dt
+        last_memory = memory
+        factor *= 2
+        for loop_settings in [run_settings] + [s for _, s in sweep_settings]:
+            decimate_state_monitors(loop_settings, 2)
+
+    if factor > 1:
+        print("State monitors decimated {}x to fit the memory budget "
+              "({} at once)".format(factor, format_bytes(memory)))
+    return
+
+
+def decimate_state_monitors(settings_dict, factor):
+    """Make every state monitor of a settings dict sample factor x coarser"""
+
+    # a new dict: run settings share theirs with the sim settings module
+    dt = brian.defaultclock.dt / brian.second
+    monitors = dict(settings_dict["monitors"])
+    for neuron_name, spec in monitors.items():
+        opts = parse_monitor_spec(spec)
+        if all(mon in ("spikes", "rate") for mon in opts["record"]):
+            continue
+        if isinstance(spec, dict):
+            spec = dict(spec)
+        else:
+            spec = {"record": spec}
+        spec["dt"] = (opts["dt"] or dt) * factor
+        monitors[neuron_name] = spec
+    settings_dict["monitors"] = monitors
+    return
+
+
+def save_run(net_states, settings_dict, description, sim_data_path, file_num,
+             streamed=None, profile=None):
 
-    # save the simulation
     data_to_save = {
-        "net": net.get_states(),
+        "net": net_states,
         "settings": settings_dict,
         "description": description
     }
+    if profile is not None:
+        data_to_save["profile"] = profile
+
+    # written under a partial name first, the store only ever has complete
+    # runs (see complete_run)
+    run_path = run_file_path(sim_data_path, file_num)
+    stored_path = result_path(settings_dict, sim_data_path, file_num)
+    fpath = partial_run_path(stored_path)
+    if not streamed:
+        remove_partial_run(fpath)
+    start = time.time()
+    if get_run_option(settings_dict, "result_format") == "pickle":
+        save_simulation_data(data_to_save, fpath)
+    else:
+        save_columnar_data(data_to_save, fpath, streamed)
+    if profile is not None:
+        record_save_time(data_to_save, fpath, time.time() - start)
+
+    complete_run(fpath, stored_path)
+    if stored_path != run_path:
+        link_run(stored_path, run_path)
+    return
+
+
+def run_file_path(sim_data_path, file_num):
+    """Path of the saved data of one run of a sweep."""
+
     fname = "network_data_run_{}".format(file_num)
-    fpath = sim_data_path + os.sep + fname
-    save_simulation_data(data_to_save, fpath)
+    return sim_data_path + os.sep + fname
+
+
+def run_id(settings_dict, run_options=result_run_options):
+    """
+    Content address of a sweep point: a hash of its fully resolved settings
+    (equations included, sim_time as resolve_sim_length sets it). Of the
+    run options only run_options go in, the others do not change what is
+    saved.
+    """
+
+    content = {key: val for key, val in settings_dict.items()
+               if key != "run"}
+    content["afferents"] = dict(content["afferents"],
+                                sim_time=predicted_sim_length(settings_dict))
+    content["run"] = {key: get_run_option(settings_dict, key)
+                      for key in run_options}
+    text = json.dumps(settings_to_json(content), sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def is_stored_run(settings_dict):
+    """
+    Check if a sweep point goes into the result store. Only seeded points
+    do: an unseeded run can not be reproduced, so a stored one could not
+    stand in for running it again.
+    """
+
+    return get_run_option(settings_dict, "seed") is not None
+
+
+def result_path(settings_dict, sim_data_path, file_num):
+    """
+    Where a run is saved: its place in the result store, or straight in
+    the sweep directory for runs that are not stored (see is_stored_run)
+    """
+
+    if is_stored_run(settings_dict):
+        return stored_run_path(settings_dict, sim_data_path)
+    return run_file_path(sim_data_path, file_num)
+
+
+def get_result_store(settings_dict, sim_data_path):
+    """
+    The directory with the completed runs of every sweep, by run_id.
+    Defaults to .result_store next to the sweep directories.
+    """
+
+    store = get_run_option(settings_dict, "result_store")
+    if store is None:
+        store = os.path.join(os.path.dirname(sim_data_path), ".result_store")
+    return store
+
+
+def stored_run_path(settings_dict, sim_data_path):
+    """Path of a sweep point in the result store (no .p for pickles)"""
+
+    return os.path.join(get_result_store(settings_dict, sim_data_path),
+                        run_id(settings_dict))
+
+
+def partial_run_path(stored_path):
+    """
+    Where a run is written before it is complete. Unique per process, so
+    a crashed or concurrent run never shares (or completes) its files.
+    """
+
+    return "{}.partial-{}".format(stored_path, os.getpid())
+
+
+def remove_partial_run(partial_path):
+    """Remove what a crashed run left at a partial path"""
+
+    if os.path.isdir(partial_path):
+        shutil.rmtree(partial_path)
+    elif os.path.isfile(partial_path + ".p"):
+        os.remove(partial_path + ".p")
+    return
+
+
+def remove_stale_partial_runs(store):
+    """
+    Remove the partial runs (see partial_run_path) that crashed or killed
+    processes left in the result store: on POSIX those of processes that
+    are not running any more, elsewhere those untouched for
+    stale_partial_age seconds.
+    """
+
+    if not os.path.isdir(store):
+        return
+    for fname in os.listdir(store):
+        match = re.match(r"(.*\.partial-(\d+))(\.p)?$", fname)
+        if match is None:
+            continue
+        if os.name == "posix":
+            stale = not process_is_running(int(match.group(2)))
+        else:
+            age = time.time() - os.path.getmtime(os.path.join(store, fname))
+            stale = age > stale_partial_age
+        if stale:
+            print("  Removing partial run {}".format(fname))
+            remove_partial_run(os.path.join(store, match.group(1)))
+    return
+
+
+def process_is_running(pid):
+    """Check if a process with this pid is running (POSIX only)"""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # running, as another user
+    return True
+
+
+def is_completed_run(stored_path):
+    """Check if a run is in the result store"""
+
+    return (os.path.isfile(stored_path + ".p") or
+            os.path.isfile(os.path.join(stored_path, "manifest.json")))
+
+
+def complete_run(partial_path, stored_path):
+    """
+    Move a finished run from its partial path into the result store, in a
+    single rename so a run in the store is always complete.
+    """
+
+    if os.path.isfile(partial_path + ".p"):
+        os.replace(partial_path + ".p", stored_path + ".p")
+        return
+    if os.path.exists(stored_path):
+        # rerun of a completed point (skip_completed off)
+        shutil.rmtree(stored_path)
+    os.rename(partial_path, stored_path)
+    return
+
+
+def link_run(stored_path, run_path):
+    """
+    Put a stored run into a sweep directory as run_path, as hard links to
+    the stored files (copies where the file system has no hard links).
+    The description of a linked run is that of the sweep that ran it.
+    """
+
+    if os.path.isfile(stored_path + ".p"):
+        link_file(stored_path + ".p", run_path + ".p")
+        return
+    for root, _, files in os.walk(stored_path):
+        target_dir = os.path.join(run_path,
+                                  os.path.relpath(root, stored_path))
+        os.makedirs(target_dir, exist_ok=True)
+        for fname in files:
+            link_file(os.path.join(root, fname),
+                      os.path.join(target_dir, fname))
+    return
 
+
+def link_file(src, dst):
+    """Hard link src to dst, or copy it"""
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
     return
 
 
+def link_completed_runs(sweep_settings, sim_data_path):
+    """
+    Link the sweep points already in the result store into sim_data_path.
+    Returns the (file_num, settings) of the points that still have to run,
+    all of them with settings["run"]["skip_completed"] off or unseeded
+    (see is_stored_run).
+    """
+
+    pending = []
+    for file_num, loop_settings in sweep_settings:
+        if not (is_stored_run(loop_settings) and
+                get_run_option(loop_settings, "skip_completed")):
+            pending.append((file_num, loop_settings))
+            continue
+        stored_path = stored_run_path(loop_settings, sim_data_path)
+        if is_completed_run(stored_path):
+            print("  Network {} already completed ({})".format(
+                file_num, os.path.basename(stored_path)))
+            link_run(stored_path, run_file_path(sim_data_path, file_num))
+        else:
+            pending.append((file_num, loop_settings))
+    return pending
+
+
+def get_stream_path(settings_dict, sim_data_path, file_num):
+    """
+    Where monitors are streamed to during the run (the partial path of the
+    run, see save_run), or None when the run keeps them in memory.
+    Streaming needs settings["run"]["segment_time"] and the columnar result
+    format.
+    """
+
+    if get_run_option(settings_dict, "segment_time") is None:
+        return None
+    if get_run_option(settings_dict, "result_format") != "columnar":
+        print("segment_time needs the columnar result format. "
+              "Keeping monitors in memory")
+        return None
+    stream_path = partial_run_path(result_path(settings_dict,
+                                               sim_data_path,
+                                               file_num))
+    remove_partial_run(stream_path)
+    return stream_path
+
+
+def can_pack_sweep(run_settings, list_path):
+    """
+    Check that a sweep can be run as replicas of one network. The swept
+    param must be a per-neuron/per-synapse variable (see param_variables)
+    or p_connect, the afferents must be Poisson and population rate monitors
+    can not be split between replicas.
+    """
+
+    if len(list_path) == 0:
+        return False
+
+    section = list_path.strip("/").split("/")[0]
+    key = list_path.strip("/").split("/")[-1]
+    is_p_connect = section == "synapses" and key == "p_connect"
+    if not (key in param_variables.get(section, {}) or is_p_connect):
+        return False
+
+    if not run_settings["afferents"]["use_poisson"]:
+        return False
+
+    for spec in run_settings["monitors"].values():
+        if "rate" in parse_monitor_spec(spec)["record"]:
+            return False
+
+    return not mixes_afferent_models(run_settings, list_path)
+
+
+def mixes_afferent_models(run_settings, list_path):
+    """
+    A modulation_rate of 0 uses a different afferent model (see
+    create_afferents), so it can only share a network with other zeros.
+    """
+
+    if list_path.strip("/") == "afferents/modulation_rate":
+        vals = get_param(run_settings, list_path)
+        return 0 in vals and any(v != 0 for v in vals)
+    return False
+
+
+def can_reuse_network(run_settings, list_path):
+    """
+    Check that one network can be reused for every sweep point, ie. the
+    swept param is a model variable (see param_variables) that can be
+    patched after a restore.
+    """
+
+    if not is_param_variable(list_path, run_settings):
+        return False
+    return not mixes_afferent_models(run_settings, list_path)
+
+
+def run_reused_net_and_save(sweep_settings, list_path, description,
+                            sim_data_path):
+    """
+    Build the network once and reuse it for every sweep point.
+
+    The freshly built network is stored. Each later sweep point restores it,
+    patches only the model variables set by the swept param and reruns, so
+    groups, synapses, connectivity and monitors are created only once.
+    """
+
+    net = None
+    for file_num, loop_settings in sweep_settings:
+        sim_length = resolve_sim_length(loop_settings)
+        wall_clock = {}
+        start = time.time()
+        if net is None:
+            net = create_network(loop_settings)
+            net.store("initial")
+        else:
+            net.restore("initial")
+            for obj, var, value in locate_param_variables(net,
+                                                          loop_settings,
+                                                          list_path):
+                setattr(obj, var, value)
+        wall_clock["build"] = time.time() - start
+
+        print("  Running network {}".format(file_num))
+        print("    Total simulation time: ", sim_length)
+        profile, code_objects = start_profile(net, loop_settings, wall_clock)
+        stream_path = get_stream_path(loop_settings, sim_data_path, file_num)
+        seed_random(derive_seed(loop_settings, "run"))
+        start = time.time()
+        streamed = run_network(net, loop_settings, sim_length, stream_path,
+                               code_objects)
+        wall_clock["run"] = time.time() - start
+
+        save_run(net.get_states(),
+                 loop_settings,
+                 description,
+                 sim_data_path,
+                 file_num,
+                 streamed,
+                 profile
+                 )
+
+    return
+
+
+def run_packed_net_and_save(run_settings, list_path, sweep_settings,
+                            description, sim_data_path):
+    """
+    Run all sweep points as replicas inside a single network.
+
+    Every population (and the afferents) is replicated once per swept value
+    and the swept param is set as a per-replica vector, so code generation
+    and scheduling are paid once for the whole sweep. The recorded states
+    are then split back into one result file per sweep point.
+
+    Only the points of sweep_settings are packed, eg. the ones that are not
+    in the result store yet.
+    """
+
+    n_replicas = len(sweep_settings)
+    sim_lengths = [resolve_sim_length(s) for _, s in sweep_settings]
+
+    packed_settings = copy.deepcopy(run_settings)
+    set_param(packed_settings, list_path,
+              [get_param(s, list_path) for _, s in sweep_settings])
+    for vals in packed_settings["neurons"].values():
+        vals["N"] = vals["N"] * n_replicas
+    packed_settings["afferents"]["N"] *= n_replicas
+    packed_settings["afferents"]["sim_time"] = max(sim_lengths)
+    net = create_network(packed_settings, n_replicas, sim_lengths,
+                         [s for _, s in sweep_settings])
+
+    print("  Running {} packed networks".format(n_replicas))
+    print("    Total simulation time: ", max(sim_lengths))
+    if get_run_option(run_settings, "segment_time") is not None:
+        print("    Packed runs are split per replica after the run. "
+              "Keeping monitors in memory")
+    run_network(net, packed_settings, max(sim_lengths))
+
+    net_states = net.get_states()
+    for replica, (file_num, loop_settings) in enumerate(sweep_settings):
+        replica_states = split_packed_states(net_states,
+                                             n_replicas,
+                                             replica,
+                                             sim_lengths[replica]
+                                             )
+        save_run(replica_states,
+                 loop_settings,
+                 description,
+                 sim_data_path,
+                 file_num
+                 )
+
+    return
+
+
+def split_packed_states(net_states, n_replicas, replica, sim_length):
+    """
+    Pull a single replica out of the states of a packed network.
+
+    Replicas are contiguous blocks of each group, so the block for a replica
+    is located from the group size. Recordings are cut at the sim_length of
+    that replica, and indices are shifted so they start at 0.
+    """
+
+    out = {}
+    for obj_name, states in net_states.items():
+        if "j" in states:
+            # synapses (and their pathways): keep synapses onto this replica
+            n_pre = int(states["N_pre"]) // n_replicas
+            n_post = int(states["N_post"]) // n_replicas
+            keep = states["j"] // n_post == replica
+            split = take_elements(states, keep, len(keep))
+            for var in ("i", "i_pre"):
+                if var in split:
+                    split[var] = split[var] - replica * n_pre
+            for var in ("j", "i_post"):
+                if var in split:
+                    split[var] = split[var] - replica * n_post
+            split["N"] = np.sum(keep)
+            split["N_pre"] = n_pre
+            split["N_post"] = n_post
+
+        elif "neuron_index" in states:
+            # spike generator: keep the spikes of this replica's block
+            n_rep = int(states["N"]) // n_replicas
+            keep = ((states["neuron_index"] // n_rep == replica) &
+                    (states["spike_time"] < sim_length * brian.second))
+            split = take_elements(states, keep, len(keep))
+            split["neuron_index"] = split["neuron_index"] - replica * n_rep
+            split["i"] = states["i"][:n_rep]
+            split["N"] = n_rep
+
+        elif "count" in states:
+            # spike monitor
+            n_rep = len(states["count"]) // n_replicas
+            keep = ((states["i"] // n_rep == replica) &
+                    (states["t"] < sim_length * brian.second))
+            split = dict(states)
+            split["i"] = states["i"][keep] - replica * n_rep
+            split["t"] = states["t"][keep]
+            split["count"] = np.bincount(split["i"], minlength=n_rep)
+            split["N"] = np.sum(keep)
+
+        elif np.ndim(states["t"]) == 1:
+            # state monitor: samples x recorded neurons
+            keep = states["t"] < sim_length * brian.second
+            split = {}
+            for var, val in states.items():
+                if var == "t":
+                    split[var] = val[keep]
+                elif var == "N":
+                    split[var] = np.sum(keep)
+                elif np.ndim(val) == 2:
+                    n_rep = val.shape[1] // n_replicas
+                    cols = slice(replica * n_rep, (replica + 1) * n_rep)
+                    split[var] = val[keep][:, cols]
+                else:
+                    split[var] = val
+
+        else:
+            # neuron group
+            n_rep = int(states["N"]) // n_replicas
+            block = np.zeros(int(states["N"]), dtype=bool)
+            block[replica * n_rep:(replica + 1) * n_rep] = True
+            split = take_elements(states, block, len(block))
+            split["i"] = split["i"] - replica * n_rep
+            split["N"] = n_rep
+
+        out[obj_name] = split
+
+    return out
+
+
+def take_elements(states, keep, n_elements):
+    """Index every per-element array (length n_elements) of a states dict"""
+
+    out = {}
+    for var, val in states.items():
+        if np.ndim(val) >= 1 and len(val) == n_elements:
+            out[var] = val[keep]
+        else:
+            out[var] = val
+    return out
+
+
+def per_replica(value, n_per_replica):
+    """
+    Packed sweeps keep a list with one value per replica in the settings.
+    Expand it to one value per element (replicas are contiguous blocks).
+    Scalars are returned unchanged.
+    """
+
+    if isinstance(value, list):
+        return np.repeat(value, n_per_replica)
+    return value
+
+
 def save_simulation_data(data_to_save, fpath):
 
     with open(fpath + '.p', 'wb') as f:
@@ -92,6 +1558,145 @@ def save_simulation_data(data_to_save, fpath):
     return
 
 
+def save_columnar_data(data_to_save, fpath, streamed=None):
+    """
+    Save a run as a directory of little-endian .npy arrays, one per
+    object/variable (eg. HVA_PY_V_mon/V.npy), plus manifest.json with the
+    settings, description and the units of every array. Scalars are kept
+    in the manifest.
+
+    Variables already streamed to disk during the run (see stream_monitors)
+    are finished in place instead of being taken from data_to_save["net"].
+
+    Monitors can then be loaded independently and memory-mapped, see
+    analysis.load_columnar. The manifest is written last, so a directory
+    without one is an incomplete run.
+    """
+
+    streamed = streamed or {}
+    os.makedirs(fpath, exist_ok=True)
+    manifest = {"format": "hvasim_columnar", "version": 1, "objects": {}}
+    for key, val in data_to_save.items():
+        if key != "net":
+            manifest[key] = settings_to_json(val)
+
+    for obj_name, states in data_to_save["net"].items():
+        os.makedirs(os.path.join(fpath, obj_name), exist_ok=True)
+        manifest["objects"][obj_name] = {}
+        for var, val in states.items():
+            if (obj_name, var) in streamed:
+                continue
+            manifest["objects"][obj_name][var] = save_column(fpath,
+                                                             obj_name,
+                                                             var,
+                                                             val
+                                                             )
+
+    for (obj_name, var), stream in streamed.items():
+        entries = manifest["objects"][obj_name]
+        entries[var] = finish_stream(fpath, stream)
+        # the monitor only holds the last segment, N counts all of them
+        entries["N"] = {"dims": [0] * 7, "value": stream["n_rows"]}
+
+    with open(os.path.join(fpath, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    return
+
+
+def save_column(fpath, obj_name, var, val):
+    """
+    Save one variable of a columnar run. Returns its manifest entry: the
+    unit as SI dimension exponents, and either the .npy file or the value.
+    """
+
+    dims = list(brian.get_dimensions(val)._dims)
+    arr = np.asarray(val)
+    arr = arr.astype(arr.dtype.newbyteorder("<"), copy=False)
+    if arr.ndim == 0:
+        return {"dims": dims, "value": arr.item()}
+
+    rel_path = obj_name + "/" + var + ".npy"
+    np.save(os.path.join(fpath, obj_name, var + ".npy"), arr)
+    return {"dims": dims, "file": rel_path}
+
+
+def stream_monitors(net, fpath, streamed):
+    """
+    Append what the monitors recorded since the last call to the columnar
+    run in fpath, then empty the monitors, so a long run never holds more
+    than one segment in memory. streamed is updated in place, see
+    append_column. Spike counts are not per-spike and stay in the monitor.
+    """
+
+    for obj in net.objects:
+        if isinstance(obj, brian.StateMonitor):
+            variables = ["t"] + list(obj.record_variables)
+        elif isinstance(obj, brian.SpikeMonitor):
+            variables = sorted(obj.record_variables)
+        elif isinstance(obj, brian.PopulationRateMonitor):
+            variables = ["t", "rate"]
+        else:
+            continue
+
+        states = obj.get_states(variables)
+        for var in variables:
+            append_column(fpath, obj.name, var, states[var], streamed)
+
+        obj.resize(0)
+        obj.variables["N"].set_value(0)
+
+    return
+
+
+def append_column(fpath, obj_name, var, val, streamed):
+    """
+    Append rows to the raw .part file of a streamed variable. The .npy
+    header is only written once the number of rows is known, see
+    finish_stream.
+    """
+
+    arr = np.asarray(val)
+    arr = arr.astype(arr.dtype.newbyteorder("<"), copy=False)
+    key = (obj_name, var)
+    if key not in streamed:
+        os.makedirs(os.path.join(fpath, obj_name), exist_ok=True)
+        streamed[key] = {
+            "file": obj_name + "/" + var + ".npy",
+            "dims": list(brian.get_dimensions(val)._dims),
+            "dtype": arr.dtype.str,
+            "row_shape": list(arr.shape[1:]),
+            "n_rows": 0
+        }
+
+    stream = streamed[key]
+    part_path = os.path.join(fpath, stream["file"] + ".part")
+    with open(part_path, "ab") as f:
+        f.write(np.ascontiguousarray(arr).tobytes())
+    stream["n_rows"] += arr.shape[0]
+    return
+
+
+def finish_stream(fpath, stream):
+    """
+    Turn the .part file of a streamed variable into a .npy file. Returns
+    its manifest entry, same as save_column.
+    """
+
+    part_path = os.path.join(fpath, stream["file"] + ".part")
+    header = {
+        "descr": stream["dtype"],
+        "fortran_order": False,
+        "shape": tuple([stream["n_rows"]] + stream["row_shape"])
+    }
+    with open(os.path.join(fpath, stream["file"]), "wb") as out:
+        np.lib.format.write_array_header_1_0(out, header)
+        with open(part_path, "rb") as part:
+            shutil.copyfileobj(part, out)
+    os.remove(part_path)
+
+    return {"dims": stream["dims"], "file": stream["file"]}
+
+
 def make_data_directory(dat_path) -> str:
     """
     Make a new directory for the saved simulation data.
@@ -103,29 +1708,64 @@ def make_data_directory(dat_path) -> str:
     # cd to the dat_path
     os.chdir(dat_path)
 
-    # make a new directory
+    # make a new directory, numbered if a sweep started in the same minute
     tm = time.gmtime()
     fname = "{}_{}_{}_{}".format(tm.tm_year, tm.tm_yday, tm.tm_hour, tm.tm_min)
-    os.mkdir(fname)
+    base_name = fname
+    n_same_minute = 1
+    while True:
+        try:
+            os.mkdir(fname)
+            break
+        except FileExistsError:
+            fname = "{}_{}".format(base_name, n_same_minute)
+            n_same_minute += 1
 
     # return the path to the new directory
     return dat_path + os.sep + fname
 
 
-def create_network(settings_modified):
+def create_network(settings_modified, n_replicas=1, sim_lengths=None,
+                   replica_settings=None):
+    """
+    Build the network. With n_replicas > 1 every group is made of n_replicas
+    independent copies (see run_packed_net_and_save), sim_lengths then has
+    the simulation length and replica_settings the settings of every
+    replica, for their random seeds (see derive_seed)
+    """
 
     net = brian.Network()
+    replica_settings = replica_settings or [settings_modified]
 
-    neuron_list = create_neurons(settings_modified["neurons"])
-    afferents = create_afferents(settings_modified["afferents"])
+    neuron_list = create_neurons(settings_modified["neurons"], n_replicas)
+    afferents = create_afferents(settings_modified["afferents"],
+                                 n_replicas,
+                                 get_train_cache_dir(settings_modified),
+                                 [derive_seed(s, "afferents")
+                                  for s in replica_settings],
+                                 sim_lengths
+                                 )
     neuron_list.append(afferents)
     net.add(neuron_list)
 
     # creating synapses and adding them to the network
-    synapse_list = create_synapses(settings_modified["synapses"], neuron_list)
+    connect_seeds = {syn: [derive_seed(s, "connectivity", str(syn))
+                           for s in replica_settings]
+                     for syn in settings_modified["synapses"]}
+    synapse_list = create_synapses(settings_modified["synapses"],
+                                   neuron_list,
+                                   n_replicas,
+                                   connect_seeds
+                                   )
     net.add(synapse_list)
 
-    monitor_list = create_monitors(settings_modified["monitors"], neuron_list)
+    afferent_params = settings_modified["afferents"]
+    monitor_list = create_monitors(settings_modified["monitors"],
+                                   neuron_list,
+                                   n_replicas,
+                                   afferent_params["modulation_rate"],
+                                   sim_lengths or afferent_params["sim_time"]
+                                   )
     net.add(monitor_list)
     return net
 
@@ -144,11 +1784,13 @@ def find_neuron_with_name(neuron_array, str_name):
     return found_neuron
 
 
-def create_neurons(neuron_params):
+def create_neurons(neuron_params, n_replicas=1):
     """
     Returns a list of neurons initialized with valued specified in params
     settings["neurons"] should be passed in as the argument, with the same
     set up as exemplified in chance_abbott_sim_settings.py
+
+    For packed sweeps a param may be a list with one value per replica
     """
     # fill list of proper size with 0's
     neuron_list = [0] * len(neuron_params)
@@ -159,7 +1801,8 @@ def create_neurons(neuron_params):
         eqs = vals["eqs"]
         t = 'V>=' + str(vals["thresh"]) + '*volt'
         res = 'V=' + str(vals["reset"]) + '*volt'
-        v_init = vals["V_rest"]
+        n_rep = N // n_replicas
+        v_init = per_replica(vals["V_rest"], n_rep)
         refract = vals["refract"] * brian.second
         neuron_list[i] = brian.NeuronGroup(N,
                                            model=eqs,
@@ -169,10 +1812,12 @@ def create_neurons(neuron_params):
                                            refractory=refract,
                                            name=neuron
                                            )
-        neuron_list[i].tau_m = vals["tau_m"] * brian.second
-        neuron_list[i].R_in = vals["R_in"] * brian.Mohm
-        neuron_list[i].tau_e_model = vals["tau_e"] * brian.second
-        neuron_list[i].tau_i_model = vals["tau_i"] * brian.second
+        neuron_list[i].tau_m = per_replica(vals["tau_m"], n_rep) * brian.second
+        neuron_list[i].R_in = per_replica(vals["R_in"], n_rep) * brian.Mohm
+        neuron_list[i].tau_e_model = (per_replica(vals["tau_e"], n_rep) *
+                                      brian.second)
+        neuron_list[i].tau_i_model = (per_replica(vals["tau_i"], n_rep) *
+                                      brian.second)
         neuron_list[i].V = v_init * brian.volt
         neuron_list[i].V0 = v_init * brian.volt
         neuron_list[i].Ve = -0.000 * brian.volt
@@ -182,15 +1827,51 @@ def create_neurons(neuron_params):
     return neuron_list
 
 
-def create_afferents(afferent_params):
+def create_afferents(afferent_params, n_replicas=1, train_cache_dir=None,
+                     seeds=None, sim_lengths=None):
     """
     Returns a neuron group initialized with values specified in params
     settings["afferents"] should be passed in as the argument, with the same
     set up as exemplified in chance_abbott_sim_settings.py
+
+    For packed sweeps modulation_rate/peak_rate may be a list with one value
+    per replica
+
+    Poisson afferents come from one of two engines (afferents["engine"]):
+    "neuron_group" (default) draws spikes every timestep from the rate
+    equations, "offline" generates the whole train up front with numpy
+    (see afferent_trains) and plays it back through a SpikeGeneratorGroup.
+    Offline trains with an afferents["seed"] are cached in train_cache_dir.
+
+    Non-Poisson afferents fire regularly at spikes_per_second, optionally
+    with a "phase_offset" (seconds, or "random" per afferent) and gaussian
+    "jitter" (sd in seconds), see afferent_trains.regular_train
+
+    Trains made up front use afferents["seed"] if set, otherwise seeds (one
+    per replica, see derive_seed). Offline trains of packed replicas are as
+    long as their sim_lengths.
     """
     num = afferent_params["N"]
     use_poisson = afferent_params["use_poisson"]
-    if use_poisson:
+    engine = afferent_params.get("engine") or "neuron_group"
+    seeds = seeds or [None] * n_replicas
+    if afferent_params.get("seed") is not None:
+        seeds = [afferent_params["seed"]] * n_replicas
+    if use_poisson and engine == "offline":
+        dt = brian.defaultclock.dt / brian.second
+        indices, times = poisson_afferent_spikes(afferent_params,
+                                                 dt,
+                                                 n_replicas,
+                                                 seeds,
+                                                 train_cache_dir,
+                                                 sim_lengths
+                                                 )
+        afferents = brian.SpikeGeneratorGroup(num,
+                                              indices,
+                                              times * brian.second,
+                                              name="afferents"
+                                              )
+    elif use_poisson:
         # mod_rate = 0 is degenerate b/c sin(0)=0. This hard codes DC for 0Hz
         if afferent_params["modulation_rate"] == 0:
             afferent_model = '''
@@ -207,29 +1888,41 @@ def create_afferents(afferent_params):
                                       method='euler',
                                       name="afferents"
                                       )
-        afferents.modulation_rate = afferent_params["modulation_rate"]
-        afferents.peak_rate = afferent_params["peak_rate"]
+        n_rep = num // n_replicas
+        afferents.modulation_rate = per_replica(
+            afferent_params["modulation_rate"], n_rep)
+        afferents.peak_rate = per_replica(afferent_params["peak_rate"], n_rep)
     else:
-        sim_length_sec = afferent_params["sim_time"]
-        isi_sec = 1 / afferent_params["spikes_per_second"]
-        spike_arr = brian.arange(0, sim_length_sec, isi_sec)  # numpy
-        spike_list = spike_arr.tolist() * num * brian.second
-        neuron_nums = []
-        for idx in range(num):
-            neuron_nums += [idx] * len(spike_arr)
+        dt = brian.defaultclock.dt / brian.second
+        neuron_nums, spike_times = regular_train(
+            num,
+            afferent_params["spikes_per_second"],
+            afferent_params["sim_time"],
+            dt,
+            jitter=afferent_params.get("jitter") or 0,
+            phase_offset=afferent_params.get("phase_offset"),
+            seed=seeds[0]
+        )
         afferents = brian.SpikeGeneratorGroup(num,
                                               neuron_nums,
-                                              spike_list,
+                                              spike_times * brian.second,
                                               name="afferents"
                                               )
     return afferents
 
 
-def create_synapses(synapse_params, neurons):
+def create_synapses(synapse_params, neurons, n_replicas=1,
+                    connect_seeds=None):
     """
     Returns a list of synapses initialized with values specified in params
     settings["synapses"] should be passed in as the argument, with the same
     set up as exemplified in chance_abbott_sim_settings.py
+
+    With n_replicas > 1 synapses only connect neurons of the same replica and
+    a param may be a list with one value per replica
+
+    connect_seeds has the seeds of the connectivity of every synapse key,
+    one per replica (see derive_seed)
     """
     # initialize an empty list
     created_syns = []
@@ -243,27 +1936,40 @@ def create_synapses(synapse_params, neurons):
         post_neuron_name = syn[1]
         post_neuron = find_neuron_with_name(neurons, post_neuron_name)
         syn_name = "{}_{}_synapse".format(pre_neuron_name, post_neuron_name)
+
+        # "stp_mode" is optional, older settings files integrate every dt
+        stp_mode = variables.get("stp_mode") or "clock-driven"
+        syn_eqs = stp_equations(variables["eqs"], stp_mode)
         created_syns.append(brian.Synapses(pre_neuron,
                                            post_neuron,
-                                           model=variables["eqs"],
+                                           model=syn_eqs,
                                            method='euler',
                                            on_pre=variables["on_spike"],
                                            name=syn_name
                                            ))
 
         # modify the synapse properties
-        created_syns[-1].connect(p=variables["p_connect"])
-        created_syns[-1].d1 = variables["d1"]
-        created_syns[-1].d2 = variables["d2"]
-        created_syns[-1].f1 = variables["f1"]
-        created_syns[-1].f2 = variables["f2"]
-        created_syns[-1].tau_D1 = variables["tau_D1"] * brian.second
-        created_syns[-1].tau_F1 = variables["tau_F1"] * brian.second
-        created_syns[-1].tau_D2 = variables["tau_D2"] * brian.second
-        created_syns[-1].tau_F2 = variables["tau_F2"] * brian.second
-        created_syns[-1].w_e = variables["w_e"] * brian.psiemens
-        created_syns[-1].w_i = variables["w_i"] * brian.psiemens
-        created_syns[-1].delay = variables["delay"] * brian.second
+        seeds = (connect_seeds or {}).get(syn) or [None] * n_replicas
+        if n_replicas == 1:
+            seed_random(seeds[0])
+            created_syns[-1].connect(p=variables["p_connect"])
+        else:
+            connect_replicas(created_syns[-1],
+                             n_replicas,
+                             variables["p_connect"],
+                             seeds
+                             )
+
+        syn_obj = created_syns[-1]
+        for key in ["d1", "d2", "f1", "f2"]:
+            setattr(syn_obj, key, per_synapse(variables[key], syn_obj,
+                                              n_replicas))
+        for key in ["tau_D1", "tau_F1", "tau_D2", "tau_F2", "delay"]:
+            setattr(syn_obj, key, per_synapse(variables[key], syn_obj,
+                                              n_replicas) * brian.second)
+        for key in ["w_e", "w_i"]:
+            setattr(syn_obj, key, per_synapse(variables[key], syn_obj,
+                                              n_replicas) * brian.psiemens)
         created_syns[-1].D1 = 1
         created_syns[-1].D2 = 1
         created_syns[-1].F1 = 1
@@ -272,33 +1978,250 @@ def create_synapses(synapse_params, neurons):
     return created_syns
 
 
-def create_monitors(monitor_params, neuron_list):
+def per_synapse(value, synapses, n_replicas):
+    """
+    Expand a per-replica list of values to one value per synapse, using the
+    replica of the postsynaptic neuron. Scalars are returned unchanged.
+    """
+
+    if isinstance(value, list):
+        n_post = len(synapses.target) // n_replicas
+        return np.asarray(value)[synapses.j[:] // n_post]
+    return value
+
+
+def seed_random(seed):
+    """Seed Brian2's (and NumPy's) random numbers, unless seed is None"""
+
+    if seed is not None:
+        brian.seed(seed)
+    return
+
+
+def connect_replicas(synapses, n_replicas, p_connect, seeds=None):
+    """
+    Connect each replica of the pre group only to the same replica of the
+    post group. p_connect may be a list with one value per replica, seeds
+    has the connectivity seed of every replica.
+
+    The pairs are drawn with numpy, one n_pre x n_post block per replica,
+    and connected in a single call: a condition on the full matrix would
+    be evaluated over all (N_pre*R) x (N_post*R) pairs for every replica.
+    """
+
+    n_pre = len(synapses.source) // n_replicas
+    n_post = len(synapses.target) // n_replicas
+    p_vals = p_connect
+    if not isinstance(p_connect, list):
+        p_vals = [p_connect] * n_replicas
+    seeds = seeds or [None] * n_replicas
+    pre = []
+    post = []
+    for replica, p_rep in enumerate(p_vals):
+        seed_random(seeds[replica])
+        pre_rep, post_rep = np.nonzero(np.random.rand(n_pre, n_post) < p_rep)
+        pre.append(pre_rep + replica * n_pre)
+        post.append(post_rep + replica * n_post)
+    pre = np.concatenate(pre)
+    if len(pre) == 0:
+        synapses.connect(False)  # Brian2 cannot connect empty index arrays
+        return
+    synapses.connect(i=pre, j=np.concatenate(post))
+
+
+def create_monitors(monitor_params, neuron_list, n_replicas=1,
+                    modulation_rate=None, sim_time=None):
     """
     Returns a list of monitors initialized with values specified in params
     settings["monitors"] should be passed in as the argument, with the same
     set up as exemplified in chance_abbott_sim_settings.py
+
+    Each entry is either a string of monitor types or a dict with recording
+    options, see parse_monitor_spec. Recording windows are applied while
+    running, see run_network.
+
+    Online accumulators (the "fourier" and "phase_bins" options) work at the
+    afferent modulation_rate and stop at sim_time. Both may be lists with
+    one value per replica.
     """
 
     monitors = []
-    for neuron_name, mon_string in monitor_params.items():
+    for neuron_name, spec in monitor_params.items():
         neuron = find_neuron_with_name(neuron_list, neuron_name)
+        opts = parse_monitor_spec(spec)
+
+        # state monitors: optionally a subset of neurons and a coarser dt
+        record = True
+        if opts["indices"] is not None:
+            n_rep = len(neuron) // n_replicas
+            record = [idx + replica * n_rep
+                      for replica in range(n_replicas)
+                      for idx in opts["indices"]]
+        state_kwargs = {}
+        if opts["dt"] is not None:
+            state_kwargs["dt"] = opts["dt"] * brian.second
 
-        mon_types = mon_string.split()
-        for mon in mon_types:
+        for mon in opts["record"]:
+            mon_name = monitor_name(neuron_name, mon)
             if mon == "spikes":
-                mon_name = "{}_spike_mon".format(neuron_name)
                 monitors.append(brian.SpikeMonitor(neuron,
                                                    name=mon_name))
             elif mon == "rate":
-                mon_name = "{}_rate_mon".format(neuron_name)
                 monitors.append(brian.PopulationRateMonitor(neuron,
                                                             name=mon_name))
             else:
-                tmp_name = "{}_{}_mon".format(neuron_name, mon)
                 monitors.append(brian.StateMonitor(neuron,
                                                    mon,
-                                                   record=True,
-                                                   name=tmp_name
+                                                   record=record,
+                                                   name=mon_name,
+                                                   **state_kwargs
                                                    ))
 
+        # online accumulators: constant memory, no matter the sim_time
+        if not (opts["fourier"] or opts["phase_bins"]):
+            continue
+        n_rep = len(neuron) // n_replicas
+        f_mod = per_replica(modulation_rate, n_rep) * brian.Hz
+        t_until = per_replica(sim_time, n_rep) * brian.second
+        for var in opts["fourier"]:
+            monitors.append(create_fourier_accumulator(neuron,
+                                                       var,
+                                                       f_mod,
+                                                       t_until,
+                                                       neuron_name
+                                                       ))
+        if opts["phase_bins"]:
+            monitors.extend(create_phase_bins(neuron,
+                                              opts["phase_bins"],
+                                              n_replicas,
+                                              f_mod,
+                                              t_until,
+                                              neuron_name
+                                              ))
+
     return monitors
+
+
+def create_fourier_accumulator(neuron, var, f_mod, t_until, neuron_name):
+    """
+    A group linked to neuron.var that integrates its Fourier coefficient at
+    f_mod during the run (see equations.fourier_accumulator_eqs).
+    """
+
+    dims = brian.get_dimensions(getattr(neuron, var))
+    unit = "1" if dims.is_dimensionless else repr(dims)
+    accumulator = brian.NeuronGroup(len(neuron),
+                                    fourier_accumulator_eqs.format(unit=unit),
+                                    method="euler",
+                                    name=monitor_name(neuron_name,
+                                                      var + "_fourier")
+                                    )
+    accumulator.x = brian.linked_var(neuron, var)
+    accumulator.f_mod = f_mod
+    accumulator.t_until = t_until
+    return accumulator
+
+
+def create_phase_bins(neuron, n_bins, n_replicas, f_mod, t_until,
+                      neuron_name):
+    """
+    Phase-binned spike counts of a population: one counter element per
+    replica with a count_k variable per bin, counted during the run by a
+    single synapse from every neuron onto the counter of its replica (see
+    equations.phase_bin_equations). Returns the counter group and the
+    synapses.
+    """
+
+    n_rep = len(neuron) // n_replicas
+    model, on_pre = phase_bin_equations(n_bins)
+    counts = brian.NeuronGroup(n_replicas,
+                               model,
+                               name=monitor_name(neuron_name, "phase")
+                               )
+    # one value per neuron in, one value per replica out
+    counts.f_mod = f_mod[::n_rep] if np.ndim(f_mod) else f_mod
+    counts.t_until = t_until[::n_rep] if np.ndim(t_until) else t_until
+
+    counter = brian.Synapses(neuron,
+                             counts,
+                             on_pre=on_pre,
+                             name=monitor_name(neuron_name, "phase") +
+                             "_synapse"
+                             )
+    pre = np.arange(len(neuron))
+    counter.connect(i=pre, j=pre // n_rep)
+    return [counts, counter]
+
+
+def monitor_name(neuron_name, mon):
+    """Name of the monitor of type mon (eg. "spikes", "V") on a neuron"""
+
+    if mon == "spikes":
+        return "{}_spike_mon".format(neuron_name)
+    elif mon == "rate":
+        return "{}_rate_mon".format(neuron_name)
+    return "{}_{}_mon".format(neuron_name, mon)
+
+
+def spec_object_names(neuron_name, opts):
+    """Names of all the objects created for the monitor options of a group"""
+
+    names = [monitor_name(neuron_name, mon) for mon in opts["record"]]
+    names += [monitor_name(neuron_name, var + "_fourier")
+              for var in opts["fourier"]]
+    if opts["phase_bins"]:
+        names += [monitor_name(neuron_name, "phase"),
+                  monitor_name(neuron_name, "phase") + "_synapse"]
+    return names
+
+
+def run_network(net, settings_dict, sim_length, stream_path=None,
+                profile=None):
+    """
+    Run the network for sim_length seconds.
+
+    Monitors with a recording window (see parse_monitor_spec) are only
+    active inside it: the run is split at the window edges and monitors are
+    switched on/off between the pieces.
+
+    With a stream_path the run is also split every
+    settings["run"]["segment_time"] seconds and the monitors are flushed
+    to disk after every piece (see stream_monitors). Returns what was
+    streamed, for save_columnar_data.
+
+    With a profile dict, Brian2's profiling is switched on and the time
+    spent in every code object (seconds, summed over the pieces) is added
+    to it.
+    """
+
+    windows = {}
+    for neuron_name, spec in settings_dict["monitors"].items():
+        opts = parse_monitor_spec(spec)
+        if opts["start"] is None and opts["stop"] is None:
+            continue
+        start = opts["start"] or 0
+        stop = sim_length if opts["stop"] is None else opts["stop"]
+        for mon_name in spec_object_names(neuron_name, opts):
+            windows[mon_name] = (start, stop)
+
+    edges = {0, sim_length}
+    for start, stop in windows.values():
+        edges.update(t for t in (start, stop) if 0 < t < sim_length)
+    segment_time = get_run_option(settings_dict, "segment_time")
+    if stream_path is not None:
+        edges.update(np.arange(segment_time, sim_length, segment_time))
+    edges = sorted(edges)
+
+    streamed = {}
+    for t_start, t_stop in zip(edges[:-1], edges[1:]):
+        for mon_name, (start, stop) in windows.items():
+            net[mon_name].active = start <= t_start < stop
+        net.run((t_stop - t_start) * brian.second,
+                profile=profile is not None)
+        if profile is not None:
+            for name, spent in net.profiling_info:
+                profile[name] = profile.get(name, 0) + float(spent)
+        if stream_path is not None:
+            stream_monitors(net, stream_path, streamed)
+
+    return streamed
@@ -27,6 +27,145 @@ process:
 """
 
 import copy
+import numpy as np
+
+
+# Run-level options live in the (optional) "run" section of a settings dict.
+# Anything missing or None falls back to these defaults.
+run_defaults = {
+    "sweep_mode": "serial",  # "serial", "process", "packed" or "reuse"
+    "workers": None,  # process pool size, None means one per core
+    "backend": "auto",  # "auto", "numpy", "cython" or "cpp_standalone"
+    "code_cache_dir": None,  # None means ~/.hvasim_code_cache
+    "train_cache_dir": None,  # None means ~/.hvasim_train_cache
+    "result_format": "columnar",  # "columnar" or "pickle"
+    "segment_time": None,  # seconds, stream monitors to disk (columnar only)
+    "profile": False,  # store code object timings (numpy/cython, unpacked)
+    "memory_budget": None,  # GB, None means no check before the sweep
+    "budget_action": "refuse",  # over budget: "refuse" or "decimate"
+    "result_store": None,  # None means .result_store next to the sweeps
+    "skip_completed": True,  # needs a seed: link stored points, no rerun
+    "seed": None,  # int, every random seed of a sweep is derived from it
+    "common_random_numbers": False,  # same seeds for every swept value
+    "trials": 1,  # runs of every sweep point, each with new noise
+    "trial": 0,  # set for every sweep point by make_sweep_settings
+}
+
+
+def get_run_option(settings, key):
+    """Return a run-level option, falling back to run_defaults."""
+
+    run_opts = settings.get("run") or {}
+    val = run_opts.get(key)
+    if val is None:
+        val = run_defaults[key]
+    return val
+
+
+def param_path_keys(settings, list_path):
+    """
+    Return the dict keys along a "/a/b/c" param path.
+
+    The path is built from str(key), so tuple keys such as the
+    ("afferents", "HVA_PY") synapse keys are matched by their string form.
+    """
+
+    keys = []
+    sub_dict = settings
+    for part in list_path.strip("/").split("/"):
+        matches = [k for k in sub_dict.keys() if str(k) == part]
+        assert len(matches) == 1, "ERROR: param path {} not found".format(
+            list_path)
+        keys.append(matches[0])
+        sub_dict = sub_dict[matches[0]]
+    return keys
+
+
+def get_param(settings, list_path):
+    """Get the value at a param path (see param_path_keys)."""
+
+    val = settings
+    for key in param_path_keys(settings, list_path):
+        val = val[key]
+    return val
+
+
+def set_param(settings, list_path, val):
+    """Set the value at a param path (see param_path_keys)."""
+
+    keys = param_path_keys(settings, list_path)
+    sub_dict = settings
+    for key in keys[:-1]:
+        sub_dict = sub_dict[key]
+    sub_dict[keys[-1]] = val
+
+
+def settings_to_json(settings):
+    """
+    Convert a settings dict into JSON-able values.
+
+    Dicts with tuple keys (the synapses) become {"__tuple_keys__": [[key as
+    list, value], ...]} and numpy values become floats/lists.
+    analysis.settings_from_json reverses this.
+    """
+
+    if isinstance(settings, dict):
+        if any(type(k) is tuple for k in settings.keys()):
+            return {"__tuple_keys__": [[list(k), settings_to_json(v)]
+                                       for k, v in settings.items()]}
+        return {str(k): settings_to_json(v) for k, v in settings.items()}
+    elif isinstance(settings, (list, tuple)):
+        return [settings_to_json(v) for v in settings]
+    elif isinstance(settings, np.ndarray) and settings.ndim > 0:
+        return np.asarray(settings).tolist()
+    elif isinstance(settings, (np.ndarray, np.generic)):
+        return np.asarray(settings).item()
+    return settings
+
+
+def parse_monitor_spec(spec):
+    """
+    Monitor settings for one neuron group are either a string of monitor
+    types, eg. 'V Ge_total spikes', or a dict with recording options:
+
+        {"record": 'V spikes',  # monitor types, as above
+         "dt": 0.001,           # state monitors: sample every dt (sec)
+         "indices": "0:5",      # state monitors: neurons to record, as a
+                                #   "lo:hi" range or "0,4,9" (default: all)
+         "start": 1.0,          # recording window (sec) for all monitors
+         "stop": None,          #   of the group, None means start/end
+         "fourier": 'V',        # online Fourier coefficients at the
+                                #   modulation_rate of these variables
+         "phase_bins": 20}      # online spike counts per phase bin of the
+                                #   modulation cycle
+
+    Returns the dict with every option filled in (record and fourier as
+    lists).
+    """
+
+    if spec is None:
+        spec = ""
+    if isinstance(spec, str):
+        spec = {"record": spec}
+
+    indices = spec.get("indices")
+    if isinstance(indices, str):
+        if ":" in indices:
+            lo, hi = indices.split(":")
+            indices = list(range(int(lo), int(hi)))
+        else:
+            indices = [int(idx) for idx in indices.split(",")]
+    elif indices is not None:
+        indices = [int(indices)]
+
+    return {"record": (spec.get("record") or "").split(),
+            "dt": spec.get("dt"),
+            "indices": indices,
+            "start": spec.get("start"),
+            "stop": spec.get("stop"),
+            "fourier": (spec.get("fourier") or "").split(),
+            "phase_bins": spec.get("phase_bins")
+            }
 
 
 def create_run_settings_no_enforce(settings_sim):
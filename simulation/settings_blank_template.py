@@ -57,13 +57,18 @@ settings = {
         "peak_rate": None,
         "spikes_per_second": None,
         "eqs": None,
-        "sim_time": 2
+        "sim_time": 2,
+        "engine": None,  # "neuron_group" or "offline" (Poisson only)
+        "seed": None,  # offline trains are cached when seeded
+        "jitter": None,  # regular trains: sd of spike time jitter (sec)
+        "phase_offset": None  # regular trains: sec, or "random"
     },
 
     "synapses": {
         ("SOM", "HVA_PY"): {
             "eqs": None,
             "on_spike": None,
+            "stp_mode": None,
             "p_connect": None,
             "d1": None,
             "d2": None,
@@ -81,6 +86,7 @@ settings = {
         ("FS", "HVA_PY"): {
             "eqs": None,
             "on_spike": None,
+            "stp_mode": None,
             "p_connect": None,
             "d1": None,
             "d2": None,
@@ -98,6 +104,7 @@ settings = {
         ("afferents", "HVA_PY"): {
             "eqs": None,
             "on_spike": None,
+            "stp_mode": None,
             "p_connect": None,
             "d1": None,
             "d2": None,
@@ -115,6 +122,7 @@ settings = {
         ("afferents", "FS"): {
             "eqs": None,
             "on_spike": None,
+            "stp_mode": None,
             "p_connect": None,
             "d1": None,
             "d2": None,
@@ -132,6 +140,7 @@ settings = {
         ("afferents", "SOM"): {
             "eqs": None,
             "on_spike": None,
+            "stp_mode": None,
             "p_connect": None,
             "d1": None,
             "d2": None,
@@ -147,6 +156,24 @@ settings = {
         }
     },
 
+    "run": {
+        "sweep_mode": None,  # "serial", "process", "packed", "reuse"
+        "workers": None,
+        "backend": None,  # "auto", "numpy", "cython" or "cpp_standalone"
+        "code_cache_dir": None,
+        "train_cache_dir": None,
+        "result_format": None,  # "columnar" or "pickle"
+        "segment_time": None,  # seconds, None keeps monitors in memory
+        "profile": None,  # store code object timings (numpy/cython, unpacked)
+        "memory_budget": None,  # GB, None means no check before the sweep
+        "budget_action": None,  # over budget: "refuse" or "decimate"
+        "result_store": None,  # None means .result_store next to the sweeps
+        "skip_completed": None,  # needs a seed: link stored points, no rerun
+        "seed": None,  # int, every random seed of a sweep is derived from it
+        "common_random_numbers": None,  # same seeds for every swept value
+        "trials": None  # runs of every sweep point, each with new noise
+    },
+
     "monitors": {
         "HVA_PY": None,
         "FS": None,
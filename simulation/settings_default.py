@@ -60,13 +60,18 @@ settings = {
         "peak_rate": 50,
         "spikes_per_second": None,
         "eqs": sinusoid_rate,
-        "sim_time": 2
+        "sim_time": 2,
+        "engine": "neuron_group",  # "neuron_group" or "offline" (Poisson only)
+        "seed": None,  # offline trains are cached when seeded
+        "jitter": 0,  # regular trains: sd of spike time jitter (sec)
+        "phase_offset": None  # regular trains: sec, or "random"
     },
 
     "synapses": {
         ("SOM", "HVA_PY"): {
             "eqs": synapse_eqs,
             "on_spike": onspike_eqs,
+            "stp_mode": "clock-driven",  # or "event-driven" (see equations)
             "p_connect": 0,
             "d1": 0.5,
             "d2": 1.0,
@@ -84,6 +89,7 @@ settings = {
         ("FS", "HVA_PY"): {
             "eqs": synapse_eqs,
             "on_spike": onspike_eqs,
+            "stp_mode": "clock-driven",
             "p_connect": 0,
             "d1": 0.4,
             "d2": 1.0,
@@ -101,6 +107,7 @@ settings = {
         ("afferents", "HVA_PY"): {
             "eqs": synapse_eqs,
             "on_spike": onspike_eqs,
+            "stp_mode": "clock-driven",
             "p_connect": 0.6,
             "d1": 0.7,
             "d2": 1.0,
@@ -118,6 +125,7 @@ settings = {
         ("afferents", "FS"): {
             "eqs": synapse_eqs,
             "on_spike": onspike_eqs,
+            "stp_mode": "clock-driven",
             "p_connect": 0.6,
             "d1": 0.4,
             "d2": 1.0,
@@ -135,6 +143,7 @@ settings = {
         ("afferents", "SOM"): {
             "eqs": synapse_eqs,
             "on_spike": onspike_eqs,
+            "stp_mode": "clock-driven",
             "p_connect": 0.6,
             "d1": 1.0,
             "d2": 1.0,
@@ -150,6 +159,24 @@ settings = {
         }
     },
 
+    "run": {
+        "sweep_mode": "serial",  # "serial", "process", "packed", "reuse"
+        "workers": None,
+        "backend": "auto",  # "auto", "numpy", "cython" or "cpp_standalone"
+        "code_cache_dir": None,
+        "train_cache_dir": None,
+        "result_format": "columnar",  # "columnar" or "pickle"
+        "segment_time": None,  # seconds, None keeps monitors in memory
+        "profile": False,  # store code object timings (numpy/cython, unpacked)
+        "memory_budget": None,  # GB, None means no check before the sweep
+        "budget_action": "refuse",  # over budget: "refuse" or "decimate"
+        "result_store": None,  # None means .result_store next to the sweeps
+        "skip_completed": True,  # needs a seed: link stored points, no rerun
+        "seed": None,  # int, every random seed of a sweep is derived from it
+        "common_random_numbers": False,  # same seeds for every swept value
+        "trials": 1  # runs of every sweep point, each with new noise
+    },
+
     "monitors": {
         "HVA_PY": 'V Ge_total Gi_total',
         "FS": 'V Ge_total Gi_total',
@@ -0,0 +1,29 @@
+"""
+Wrapper function to pre-build the code cache before a big sweep.
+
+Only useful when settings["run"]["backend"] is "cython" or "cpp_standalone".
+Every distinct network of the sweep gets its code generated and compiled
+into settings["run"]["code_cache_dir"], so the sweep itself (run_simulation.py)
+only pays for running the simulations.
+
+1) Define the settings module (same as in run_simulation.py)
+2) Call "python3 warm_code_cache.py" from terminal
+
+"""
+
+###################################
+# IMPORT THE NECESSARY MODULES    #
+###################################
+from hvasim import warm_code_cache
+
+
+#######################################
+# USER-DEFINE: THE SIMULATION SETTINGS
+# import YYYYYY as sim_settings (YYYYY = sim_settings module name)
+import settings_sim_for_allen as sim_settings
+
+
+###################################
+# DON'T MESS WITH THE STUFF BELOW #
+###################################
+warm_code_cache(sim_settings.settings)
@@ -0,0 +1,263 @@
+"""
+Benchmark suite for the simulation and analysis code.
+
+Times the stages of a run (create_network, net.run, saving, loading) and
+of its analysis (spk_mon_to_psth, calculate_depth_of_mod) on synthetic
+settings derived from settings_default.settings, over a grid of afferent
+counts, population sizes, simulation times and backends. Results are
+written as JSON so runs before and after a change can be compared:
+
+    python3 benchmark.py --out before.json
+    ... change hvasim.py / analysis.py ...
+    python3 benchmark.py --out after.json --compare before.json
+
+cpp_standalone is timed the way hvasim.run_standalone_sweep uses it: the
+project is generated and compiled once ("build_standalone"), then the
+binary is rerun with run_args for a new value of the swept param
+("standalone_run"), which is all the later points of a sweep pay for.
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulation"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "analysis"))
+
+import brian2 as brian
+import numpy as np
+
+import analysis as anly
+import hvasim
+from equations import neuron_eqs_with_Rin
+import settings_default
+
+
+# input resistance (MOhm) for populations that do not set one: the
+# default settings predate the neuron_eqs_with_Rin model hvasim builds
+default_R_in = 100
+
+# the swept param of the run_args reruns of a standalone build
+standalone_sweep_param = "afferents/modulation_rate"
+
+
+def benchmark_settings(n_afferents, n_neurons, sim_time, backend):
+    """
+    settings_default.settings scaled to n_afferents afferents and
+    n_neurons neurons per population, for a single run of sim_time sec.
+    """
+
+    settings = copy.deepcopy(settings_default.settings)
+    for vals in settings["neurons"].values():
+        vals["N"] = n_neurons
+        vals["eqs"] = neuron_eqs_with_Rin
+        vals.setdefault("R_in", default_R_in)
+
+    afferents = settings["afferents"]
+    afferents["N"] = n_afferents
+    afferents["sim_time"] = sim_time
+    if isinstance(afferents["modulation_rate"], list):
+        afferents["modulation_rate"] = afferents["modulation_rate"][0]
+
+    settings["monitors"]["HVA_PY"] = 'V spikes'
+    settings["run"]["backend"] = backend
+    return settings
+
+
+def timed(timings, stage, func, *args, **kwargs):
+    """
+    Call func and record its wall time (sec) under timings[stage]. A failing
+    stage is recorded as its error and returns None, the other stages of
+    the benchmark still run.
+    """
+
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        timings[stage] = {"error": traceback.format_exc(limit=1)}
+        return None
+    timings[stage] = time.perf_counter() - start
+    return result
+
+
+def runtime_states(settings, sim_time, timings):
+    """Build and run the network on a runtime backend, returns its states"""
+
+    net = timed(timings, "create_network", hvasim.create_network, settings)
+    if net is None:
+        return None
+    timed(timings, "net_run", net.run, sim_time * brian.second)
+    return net.get_states()
+
+
+def standalone_states(settings, sim_time, timings, work_dir):
+    """
+    Build the network as a cpp_standalone project, then rerun the binary
+    with run_args (see hvasim.run_standalone_sweep). Returns the states of
+    the rerun, None if a stage failed. Brian2 is back on the runtime
+    device afterwards.
+    """
+
+    directory = tempfile.mkdtemp(dir=work_dir)
+    try:
+        net = timed(timings, "build_standalone", hvasim.build_standalone,
+                    settings, sim_time, directory)
+        if net is None:
+            return None
+        run_kwargs = {}
+        if hvasim.standalone_supports_run_args():
+            run_kwargs["run_args"] = hvasim.make_run_args(
+                net, settings, standalone_sweep_param)
+        timed(timings, "standalone_run", brian.device.run,
+              directory=directory, with_output=False, **run_kwargs)
+        if isinstance(timings["standalone_run"], dict):
+            return None
+        return net.get_states()
+    finally:
+        brian.device.reinit()
+        brian.set_device("runtime")
+
+
+def benchmark_point(n_afferents, n_neurons, sim_time, backend, work_dir):
+    """Time every stage once for one point of the grid"""
+
+    settings = benchmark_settings(n_afferents, n_neurons, sim_time, backend)
+    hvasim.select_backend(settings)
+    timings = {}
+
+    if backend == "cpp_standalone":
+        net_states = standalone_states(settings, sim_time, timings, work_dir)
+    else:
+        net_states = runtime_states(settings, sim_time, timings)
+    if net_states is None:
+        return timings
+    data_to_save = {"net": net_states,
+                    "settings": settings,
+                    "description": "benchmark"}
+
+    # saving and loading, both result formats
+    run_dir = tempfile.mkdtemp(dir=work_dir)
+    timed(timings, "save_simulation_data", hvasim.save_simulation_data,
+          data_to_save, os.path.join(run_dir, "run_pickle"))
+    timed(timings, "save_columnar_data", hvasim.save_columnar_data,
+          data_to_save, os.path.join(run_dir, "run_columnar"))
+    timed(timings, "load_all_files", anly.load_all_files,
+          ["run_pickle.p", "run_columnar"], run_dir)
+    shutil.rmtree(run_dir)
+
+    # analysis
+    spk_mon = net_states["afferents_spike_mon"]
+    timed(timings, "spk_mon_to_psth", anly.spk_mon_to_psth,
+          {"spk_t": spk_mon["t"], "unit_idx": spk_mon["i"]}, 0.001, sim_time)
+    v_mon = net_states["HVA_PY_V_mon"]
+    timed(timings, "calculate_depth_of_mod", anly.calculate_depth_of_mod,
+          v_mon["V"][:, 0],
+          baseline=float(v_mon["V"][0, 0] / brian.volt),
+          freq=settings["afferents"]["modulation_rate"],
+          samp_freq=anly.samp_freq_of(v_mon["t"]))
+
+    return timings
+
+
+def best_of(repeats):
+    """Per stage minimum over repeated timings (errors are kept)"""
+
+    best = {}
+    for timings in repeats:
+        for stage, val in timings.items():
+            if isinstance(val, dict):
+                best.setdefault(stage, val)
+            elif not isinstance(best.get(stage), float) or val < best[stage]:
+                best[stage] = val
+    return best
+
+
+def run_benchmarks(afferent_counts, neuron_counts, sim_times, backends,
+                   repeat=1):
+    """Benchmark every point of the grid, returns the results dict"""
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "brian2": brian.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "node": platform.node(),
+            "repeat": repeat
+        },
+        "points": []
+    }
+
+    work_dir = tempfile.mkdtemp(prefix="hvasim_benchmark_")
+    try:
+        grid = itertools.product(afferent_counts, neuron_counts, sim_times,
+                                 backends)
+        for n_afferents, n_neurons, sim_time, backend in grid:
+            params = {"n_afferents": n_afferents,
+                      "n_neurons": n_neurons,
+                      "sim_time": sim_time,
+                      "backend": backend}
+            print("benchmarking", params)
+            repeats = [benchmark_point(n_afferents, n_neurons, sim_time,
+                                       backend, work_dir)
+                       for _ in range(repeat)]
+            results["points"].append({"params": params,
+                                      "timings": best_of(repeats)})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def compare_results(new, old):
+    """Print the ratio new/old of every stage of the points both have"""
+
+    old_points = {json.dumps(p["params"], sort_keys=True): p["timings"]
+                  for p in old["points"]}
+    for point in new["points"]:
+        key = json.dumps(point["params"], sort_keys=True)
+        if key not in old_points:
+            continue
+        print(point["params"])
+        for stage, val in point["timings"].items():
+            old_val = old_points[key].get(stage)
+            if isinstance(val, float) and isinstance(old_val, float):
+                print("    {:<24s} {:9.4f}s  x{:.2f}".format(stage, val,
+                                                           val / old_val))
+            else:
+                print("    {:<24s} (no comparison)".format(stage))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--afferents", type=int, nargs="+", default=[800])
+    parser.add_argument("--neurons", type=int, nargs="+", default=[1, 100])
+    parser.add_argument("--sim-time", type=float, nargs="+", default=[2.0])
+    parser.add_argument("--backend", nargs="+", default=["numpy"],
+                        choices=["numpy", "cython", "cpp_standalone"])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None,
+                        help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.afferents, args.neurons, args.sim_time,
+                             args.backend, args.repeat)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=1)
+    print("results written to", args.out)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            compare_results(results, json.load(f))
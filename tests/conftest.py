@@ -0,0 +1,80 @@
+"""
+Shared fixtures of the tests: a network small enough to run a sweep of it
+in seconds, and a helper that runs a sweep and loads its runs.
+"""
+
+import copy
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulation"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "analysis"))
+
+import brian2 as brian
+import pytest
+
+import analysis as anly
+import hvasim
+import settings_sim_for_allen
+
+
+@pytest.fixture
+def small_settings(tmp_path):
+    """
+    Factory of settings_sim_for_allen shrunk to 2 neurons per population
+    and 50 afferents, on the numpy backend, with every cache in tmp_path.
+    Keyword arguments are run options.
+    """
+
+    def make(**run_options):
+        settings = copy.deepcopy(settings_sim_for_allen.settings)
+        settings["afferents"]["N"] = 50
+        settings["afferents"]["modulation_rate"] = 4
+        for vals in settings["neurons"].values():
+            vals["N"] = 2
+        settings["monitors"] = {"HVA_PY": "V spikes", "afferents": "spikes"}
+        settings["run"] = dict({"backend": "numpy",
+                                "code_cache_dir": str(tmp_path / "code"),
+                                "train_cache_dir": str(tmp_path / "trains")},
+                               **run_options)
+        return settings
+
+    return make
+
+
+@pytest.fixture
+def coarse_clock():
+    """Run at dt = 1 ms, ten times fewer steps than Brian's default"""
+
+    dt = brian.defaultclock.dt
+    brian.defaultclock.dt = 1 * brian.ms
+    yield
+    brian.defaultclock.dt = dt
+
+
+@pytest.fixture
+def run_sweep(tmp_path, coarse_clock):
+    """
+    Run a sweep into tmp_path/sweeps and return its runs (loaded whole),
+    ordered by file number
+    """
+
+    dat_path = tmp_path / "sweeps"
+    dat_path.mkdir()
+
+    def run(settings):
+        before = set(os.listdir(str(dat_path)))
+        hvasim.run_simulations(settings, "test", str(dat_path))
+        sim_dir, = set(os.listdir(str(dat_path))) - before - {".result_store"}
+        sim_dir = str(dat_path / sim_dir)
+        runs = anly.load_all_files(anly.list_simulation_files(sim_dir),
+                                   sim_dir)
+        return [runs[fname] for fname in sorted(runs, key=file_number)]
+
+    return run
+
+
+def file_number(fname):
+    return int(re.search(r"_(\d+)(\.p)?$", fname).group(1))
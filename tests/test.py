@@ -1,6 +1,9 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulation"))
 
 from brian2 import *
-from modules.equations.chance_abbott_eqs import *
+from equations import *
 
 def find_neuron_with_name(neuron_array, str_name):
     """
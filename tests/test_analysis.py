@@ -0,0 +1,343 @@
+"""
+pytest checks for the analysis code: PSTHs, depth of modulation, the
+stimulus onsets and cycle averages, the columnar result format and the
+analysis cache. Run from the repository root with
+
+    python -m pytest -q tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulation"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "analysis"))
+
+import brian2 as brian
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+import analysis as anly
+import hvasim
+import sinusoid_analysis
+
+
+def random_spikes(n_units, n_spikes, total_time, seed=0):
+    rng = np.random.default_rng(seed)
+    return {"unit_idx": rng.integers(0, n_units, n_spikes),
+            "spk_t": rng.uniform(0, total_time, n_spikes)}
+
+
+def test_psth_matches_histogram_per_unit():
+    spk_dict = random_spikes(n_units=7, n_spikes=2000, total_time=2.0)
+    binsize = 0.05
+    psth = anly.spk_mon_to_psth(spk_dict, binsize, 2.0)
+
+    np.testing.assert_array_equal(psth["unit_idx"],
+                                  np.unique(spk_dict["unit_idx"]))
+    assert psth["rates"].shape == (len(psth["unit_idx"]),
+                                   len(psth["edges"]) - 1)
+    for row, unit in enumerate(psth["unit_idx"]):
+        counts, _ = np.histogram(
+            spk_dict["spk_t"][spk_dict["unit_idx"] == unit], psth["edges"])
+        np.testing.assert_allclose(psth["rates"][row], counts / binsize)
+
+
+def test_psth_keeps_silent_units():
+    spk_dict = {"unit_idx": [0, 3, 3], "spk_t": [0.01, 0.02, 0.5]}
+    psth = anly.spk_mon_to_psth(spk_dict, 0.1, 1.0, n_units=5)
+
+    np.testing.assert_array_equal(psth["unit_idx"], np.arange(5))
+    np.testing.assert_allclose(psth["rates"].sum(axis=1) * 0.1,
+                               [1, 0, 0, 2, 0])
+
+
+def test_psth_rejects_units_outside_n_units():
+    spk_dict = {"unit_idx": [0, 5], "spk_t": [0.01, 0.02]}
+    with pytest.raises(AssertionError):
+        anly.spk_mon_to_psth(spk_dict, 0.1, 1.0, n_units=5)
+
+
+def test_batched_depth_of_mod_matches_single_files():
+    rng = np.random.default_rng(1)
+    samp_freq = 1000.
+    freqs = [2., 5., 0.]
+    traces = []
+    for n_samp, freq in zip([2000, 1500, 800], freqs):
+        tt = np.arange(n_samp) / samp_freq
+        phases = rng.uniform(0, 2 * np.pi, 3)
+        traces.append(1 + np.sin(2 * np.pi * freq * tt[:, None] + phases) +
+                      0.1 * rng.standard_normal((n_samp, 3)))
+    # a file with fewer units, padded with nan in the output
+    traces[1] = traces[1][:, :2]
+
+    out = anly.batched_depth_of_mod(traces, freqs, [samp_freq] * 3)
+    for i_file, (trace, freq) in enumerate(zip(traces, freqs)):
+        for unit in range(trace.shape[1]):
+            expected = anly.calculate_depth_of_mod(trace[:, unit],
+                                                   baseline=trace[0, unit],
+                                                   freq=freq,
+                                                   samp_freq=samp_freq)
+            assert out["amplitude"][i_file, unit] == \
+                pytest.approx(expected, rel=1e-9)
+    assert np.isnan(out["amplitude"][1, 2])
+    np.testing.assert_array_equal(out["n_units"], [3, 2, 3])
+
+
+def test_onset_offset_marks_pulse_edges():
+    dt = 0.001
+    frequency = 2.
+    threshold = 0.5
+    on_off = sinusoid_analysis.onset_offset(frequency, 1.0, threshold, dt)
+
+    tt = np.arange(1000) * dt
+    above = np.sin(2 * np.pi * frequency * tt) >= threshold
+    assert len(on_off) == 1000
+    np.testing.assert_array_equal(np.flatnonzero(on_off == 1),
+                                  np.flatnonzero(~above[:-1] & above[1:]) + 1)
+    np.testing.assert_array_equal(np.flatnonzero(on_off == -1),
+                                  np.flatnonzero(above[:-1] & ~above[1:]) + 1)
+    assert np.count_nonzero(on_off == 1) == 2
+
+
+def test_onset_offset_no_onset_at_the_first_sample():
+    on_off = sinusoid_analysis.onset_offset(1., 1.0, -2., 0.001)
+    assert not np.any(on_off)
+
+
+def test_columnar_round_trip(tmp_path):
+    net_states = {
+        "HVA_PY_V_mon": {
+            "t": np.arange(5) * 0.1 * brian.ms,
+            "V": np.linspace(-70, -50, 10).reshape(5, 2) * brian.mV,
+            "N": 5,
+        },
+        "HVA_PY_spike_mon": {
+            "i": np.array([0, 1, 1], dtype=np.int32),
+            "t": np.array([0.1, 0.2, 0.4]) * brian.ms,
+            "count": np.array([1, 2], dtype=np.int32),
+        },
+    }
+    settings = {"afferents": {"N": 10, "modulation_rate": 4},
+                "synapses": {("afferents", "HVA_PY"): {"p_connect": 0.5}},
+                "run": {"seed": 3}}
+    fpath = str(tmp_path / "network_data_run_0")
+    hvasim.save_columnar_data({"net": net_states,
+                               "settings": settings,
+                               "description": "round trip"}, fpath)
+
+    loaded = anly.load_columnar(fpath)
+    assert loaded["settings"] == settings
+    assert loaded["description"] == "round trip"
+    assert set(loaded["net"]) == set(net_states)
+    for obj_name, states in net_states.items():
+        assert set(loaded["net"][obj_name]) == set(states)
+        for var, val in states.items():
+            got = loaded["net"][obj_name][var]
+            assert brian.get_dimensions(got) == brian.get_dimensions(val)
+            np.testing.assert_array_equal(np.asarray(got), np.asarray(val))
+
+    # monitors load on their own, memory-mapped
+    mon = anly.load_monitor(fpath, "HVA_PY_V_mon")
+    np.testing.assert_array_equal(np.asarray(mon["V"]),
+                                  np.asarray(net_states["HVA_PY_V_mon"]["V"]))
+
+
+@pytest.mark.parametrize("n_spikes, vector_strength, p", [
+    (5, 1.0, 1.633e-3),
+    (9, 0.937, 3.531e-5),
+    # critical value of Zar's Table B.34: n = 10, alpha = 0.05, z = 2.928
+    (10, np.sqrt(2.928 / 10), 0.05),
+])
+def test_rayleigh_p_zar(n_spikes, vector_strength, p):
+    stats = anly.phase_locking_stats(n_spikes, n_spikes * vector_strength, 0)
+    assert stats["rayleigh_p"] == pytest.approx(p, rel=0.01)
+
+
+def test_rayleigh_p_limits():
+    stats = anly.phase_locking_stats([0, 4, 50], [0, 0, 50], [0, 0, 0])
+    assert np.isnan(stats["rayleigh_p"][0])
+    assert stats["rayleigh_p"][1] == pytest.approx(1)
+    # strong locking: tiny, but never 0 or negative
+    assert 0 < stats["rayleigh_p"][2] < 1e-20
+
+
+def test_vector_strength_per_unit():
+    frequency = 4.
+    rng = np.random.default_rng(2)
+    # unit 0 fires at the rate peak of every cycle, unit 2 at random times
+    locked = (np.arange(20) + 0.25) / frequency
+    random_t = rng.uniform(0, 5, 400)
+    spk_dict = {"unit_idx": np.r_[np.zeros(20, int), np.full(400, 2)],
+                "spk_t": np.r_[locked, random_t]}
+    out = anly.spk_mon_phase_locking(spk_dict, frequency, n_units=3)
+
+    np.testing.assert_array_equal(out["n_spikes"], [20, 0, 400])
+    assert out["vector_strength"][0] == pytest.approx(1)
+    assert out["preferred_phase"][0] == pytest.approx(np.pi / 2)
+    assert np.isnan(out["vector_strength"][1])
+    phases = 2 * np.pi * frequency * random_t
+    assert out["vector_strength"][2] == pytest.approx(
+        np.abs(np.mean(np.exp(1j * phases))))
+    assert out["population"]["n_spikes"] == 420
+    assert anly.spk_mon_phase_locking(spk_dict, 0) == {}
+
+
+def test_minmax_decimate_keeps_the_envelope():
+    tt = np.arange(10000) * 1e-4
+    rng = np.random.default_rng(3)
+    yy = np.sin(2 * np.pi * 5 * tt)[:, None] + rng.standard_normal((10000, 2))
+
+    dec_t, dec_y = anly.minmax_decimate(tt, yy, 100)
+    # a min and a max sample per column
+    assert dec_y.shape == (200, 2)
+    assert dec_t.shape == (200, 2)
+    for unit in range(2):
+        assert np.all(np.diff(dec_t[:, unit]) >= 0)
+        for block in range(100):
+            in_block = (dec_t[:, unit] >= tt[block * 100]) & \
+                (dec_t[:, unit] <= tt[block * 100 + 99])
+            samples = yy[block * 100:(block + 1) * 100, unit]
+            assert np.max(dec_y[in_block, unit]) == np.max(samples)
+            assert np.min(dec_y[in_block, unit]) == np.min(samples)
+
+
+def test_minmax_decimate_short_traces_unchanged():
+    tt = np.arange(50) * 1e-3
+    yy = np.arange(50.) * brian.mV
+    dec_t, dec_y = anly.minmax_decimate(tt, yy, 100)
+    assert dec_t is tt and dec_y is yy
+
+    dec_t, dec_y = anly.minmax_decimate(tt, yy, 10)
+    assert len(dec_t) == 20
+    assert brian.get_dimensions(dec_y) == brian.get_dimensions(yy)
+    assert dec_y[0] == yy[0] and dec_y[-1] == yy[-1]
+
+
+def test_raster_image_counts_every_spike():
+    spk_dict = random_spikes(n_units=40, n_spikes=5000, total_time=2.0)
+    image = anly.raster_image(spk_dict["spk_t"], spk_dict["unit_idx"], 2.0,
+                              40, n_time_bins=20, n_unit_bins=10)
+
+    assert image.shape == (10, 20)
+    assert image.sum() == 5000
+    expected, _, _ = np.histogram2d(spk_dict["unit_idx"], spk_dict["spk_t"],
+                                    bins=(10, 20), range=((0, 40), (0, 2)))
+    np.testing.assert_array_equal(image, expected)
+
+
+def test_plot_anlg_summary_decimates_quantities():
+    tt = np.arange(20000) * 1e-4
+    monitors = {"run_0": {"HVA_PY": {"time": tt,
+                                     "dat": np.sin(tt)[:, None] * brian.mV}}}
+    fig, ax = anly.plot_anlg_summary(monitors, ["HVA_PY"])
+
+    line, = ax.get_lines()
+    assert len(line.get_xdata()) < len(tt)
+    assert ax.get_ylabel() == "V"
+    assert np.max(line.get_ydata()) == pytest.approx(np.max(np.sin(tt)) * 1e-3)
+    plt.close(fig)
+
+
+def save_v_run(sim_dir, fname, v_rest):
+    net_states = {"HVA_PY_V_mon": {"t": np.arange(5) * 0.1 * brian.ms,
+                                   "V": np.full((5, 2), v_rest) * brian.mV}}
+    hvasim.save_columnar_data({"net": net_states,
+                               "settings": {"run": {"seed": 3}},
+                               "description": "cache"},
+                              os.path.join(sim_dir, fname))
+
+
+def test_analysis_cache_hits_and_invalidation(tmp_path, monkeypatch):
+    sim_dir = str(tmp_path)
+    save_v_run(sim_dir, "network_data_run_0", -70)
+    calls = []
+
+    def mean_v(run, scale):
+        calls.append(1)
+        return scale * float(np.mean(run["net"]["HVA_PY_V_mon"]["V"]))
+
+    def cached(scale=1):
+        return anly.cached_analysis(sim_dir, "network_data_run_0", mean_v,
+                                    {"scale": scale})
+
+    assert cached() == pytest.approx(-0.07)
+    assert cached() == pytest.approx(-0.07)
+    assert len(calls) == 1
+
+    # new params, a rewritten run and new analysis code all miss
+    assert cached(scale=2) == pytest.approx(-0.14)
+    assert len(calls) == 2
+    save_v_run(sim_dir, "network_data_run_0", -60)
+    assert cached() == pytest.approx(-0.06)
+    assert len(calls) == 3
+    monkeypatch.setattr(anly, "analysis_cache_version",
+                        anly.analysis_cache_version + 1)
+    assert cached() == pytest.approx(-0.06)
+    assert cached() == pytest.approx(-0.06)
+    assert len(calls) == 4
+
+
+def test_analysis_cache_evicts_least_recently_used(tmp_path):
+    sim_dir = str(tmp_path)
+    for file_num in range(3):
+        save_v_run(sim_dir, "network_data_run_{}".format(file_num),
+                   -70 + file_num)
+    fnames = ["network_data_run_{}".format(i) for i in range(3)]
+    result = np.zeros(1000)
+
+    _, keys = anly.load_cached(sim_dir, fnames, "zeros", {})
+    for fname in fnames:
+        anly.store_cached(sim_dir, {fname: result}, keys,
+                          max_bytes=2.5 * result.nbytes)
+    hits, _ = anly.load_cached(sim_dir, fnames, "zeros", {})
+    assert sorted(hits) == fnames[1:]
+
+
+def test_cycle_average_trace_follows_every_cycle():
+    dt = 1e-4
+    frequency = 4.
+    # 10 cycles and a partial one, the amplitude adapts from cycle to cycle
+    tt = np.arange(int(2.6 / dt)) * dt
+    amplitudes = 2 * 0.8 ** np.floor(tt * frequency)
+    trace = np.c_[-0.06 + amplitudes * np.sin(2 * np.pi * frequency * tt),
+                  np.full(len(tt), -0.07)]
+
+    out = sinusoid_analysis.cycle_average_trace(trace, frequency, dt,
+                                                settle_cycles=2)
+    assert out["n_cycles"] == 10
+    per_cycle = trace[:25000].reshape(10, 2500, 2)
+    np.testing.assert_allclose(out["per_cycle"], per_cycle)
+    np.testing.assert_allclose(out["cycle_average"], per_cycle.mean(axis=0))
+    np.testing.assert_allclose(out["steady_state"],
+                               per_cycle[2:].mean(axis=0))
+    np.testing.assert_allclose(out["cycle_amplitude"][:, 0],
+                               2 * 0.8 ** np.arange(10))
+    np.testing.assert_allclose(out["cycle_amplitude"][:, 1], 0, atol=1e-12)
+
+    # coarser phase bins average the samples inside them
+    binned = sinusoid_analysis.cycle_average_trace(trace[:, 0], frequency,
+                                                   dt, n_phase_bins=25)
+    np.testing.assert_allclose(binned["per_cycle"],
+                               per_cycle[..., 0].reshape(10, 25, 100)
+                               .mean(axis=2))
+
+
+def test_cycle_average_spikes_rates_per_phase_bin():
+    frequency = 2.
+    n_units = 2
+    # one spike per unit and cycle at a quarter cycle, and one spike in
+    # the partial cycle after the last complete one
+    spk_t = np.r_[np.repeat((np.arange(5) + 0.26) / frequency, n_units),
+                  2.6]
+    out = sinusoid_analysis.cycle_average_spikes(spk_t, frequency, 2.7,
+                                                 n_phase_bins=20,
+                                                 n_units=n_units)
+
+    assert out["n_cycles"] == 5
+    bin_duration = 1 / (frequency * 20)
+    expected = np.zeros((5, 20))
+    expected[:, 5] = 1 / bin_duration
+    np.testing.assert_allclose(out["per_cycle"], expected)
+    np.testing.assert_allclose(out["cycle_average"], expected[0])
+    np.testing.assert_allclose(out["bin_times"][5], 0.275 / frequency)
@@ -0,0 +1,473 @@
+"""
+pytest checks for the seeding, sweep modes, profiles, result store and
+afferent train helpers of the simulation code. Run from the repository
+root with
+
+    python -m pytest -q tests
+"""
+
+import copy
+import os
+import shutil
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulation"))
+
+import brian2 as brian
+import numpy as np
+import pytest
+
+import analysis as anly
+import hvasim
+from afferent_trains import poisson_afferent_spikes, spikes_on_grid
+from equations import stp_equations
+import settings_default
+
+
+def make_settings(**run_options):
+    """The default settings as a single sweep point"""
+
+    settings = copy.deepcopy(settings_default.settings)
+    settings["afferents"]["modulation_rate"] = 5
+    settings["run"] = dict(settings.get("run") or {}, **run_options)
+    return settings
+
+
+def with_rate(settings, modulation_rate):
+    settings = copy.deepcopy(settings)
+    settings["afferents"]["modulation_rate"] = modulation_rate
+    return settings
+
+
+def test_derive_seed_unseeded():
+    settings = make_settings(seed=None)
+    for stream in ("connectivity", "afferents", "run"):
+        assert hvasim.derive_seed(settings, stream) is None
+
+
+def test_derive_seed_is_deterministic():
+    settings = make_settings(seed=3)
+    seed = hvasim.derive_seed(settings, "run")
+    assert seed == hvasim.derive_seed(copy.deepcopy(settings), "run")
+    assert 0 <= seed < 2 ** 32
+    assert seed != hvasim.derive_seed(make_settings(seed=4), "run")
+
+
+def test_derive_seed_streams_differ():
+    settings = make_settings(seed=3)
+    seeds = {hvasim.derive_seed(settings, "run"),
+             hvasim.derive_seed(settings, "afferents"),
+             hvasim.derive_seed(settings, "connectivity", "a"),
+             hvasim.derive_seed(settings, "connectivity", "b")}
+    assert len(seeds) == 4
+
+
+def test_derive_seed_trials():
+    first = make_settings(seed=3, trial=0)
+    second = make_settings(seed=3, trial=1)
+    # new noise every trial, the same connectivity
+    for stream in ("run", "afferents"):
+        assert hvasim.derive_seed(first, stream) != \
+            hvasim.derive_seed(second, stream)
+    assert hvasim.derive_seed(first, "connectivity", "syn") == \
+        hvasim.derive_seed(second, "connectivity", "syn")
+
+
+def test_derive_seed_common_random_numbers():
+    settings = make_settings(seed=3)
+    assert hvasim.derive_seed(with_rate(settings, 4), "run") != \
+        hvasim.derive_seed(with_rate(settings, 8), "run")
+
+    settings = make_settings(seed=3, common_random_numbers=True)
+    for stream in ("run", "afferents", "connectivity"):
+        assert hvasim.derive_seed(with_rate(settings, 4), stream) == \
+            hvasim.derive_seed(with_rate(settings, 8), stream)
+
+
+def test_derive_seed_ignores_monitors():
+    settings = make_settings(seed=3)
+    recorded = copy.deepcopy(settings)
+    recorded["monitors"]["HVA_PY"] = {"record": "V", "dt": 0.002}
+    for stream in ("run", "afferents", "connectivity"):
+        assert hvasim.derive_seed(recorded, stream) == \
+            hvasim.derive_seed(settings, stream)
+    assert hvasim.run_id(recorded) != hvasim.run_id(settings)
+
+
+def test_run_id_is_stable():
+    settings = make_settings(seed=3)
+    assert hvasim.run_id(settings) == hvasim.run_id(copy.deepcopy(settings))
+    assert len(hvasim.run_id(settings)) == 40
+
+    # resolving the sim_length does not change the point
+    resolved = copy.deepcopy(settings)
+    hvasim.resolve_sim_length(resolved)
+    assert hvasim.run_id(resolved) == hvasim.run_id(settings)
+
+
+def test_run_id_ignores_how_a_point_is_run():
+    settings = make_settings(seed=3)
+    for key, val in (("workers", 2), ("sweep_mode", "process"),
+                     ("skip_completed", False), ("profile", True)):
+        changed = make_settings(seed=3, **{key: val})
+        assert hvasim.run_id(changed) == hvasim.run_id(settings), key
+
+
+def test_run_id_follows_what_a_point_saves():
+    settings = make_settings(seed=3)
+    for key, val in (("seed", 4), ("trial", 1), ("result_format", "pickle"),
+                     ("common_random_numbers", True),
+                     ("backend", "cython")):
+        changed = make_settings(**dict({"seed": 3}, **{key: val}))
+        assert hvasim.run_id(changed) != hvasim.run_id(settings), key
+
+    rate = settings["afferents"]["modulation_rate"]
+    assert hvasim.run_id(with_rate(settings, rate + 1)) != \
+        hvasim.run_id(settings)
+
+
+def test_spikes_on_grid_rounds_to_the_nearest_step():
+    dt = 0.001
+    indices, times = spikes_on_grid([0, 1, 2], [0.0004, 0.0006, 0.0019],
+                                    dt, 0.01)
+    np.testing.assert_array_equal(indices, [0, 1, 2])
+    np.testing.assert_allclose(times, [0.0, 0.001, 0.002])
+
+
+def test_spikes_on_grid_one_spike_per_step():
+    dt = 0.001
+    indices, times = spikes_on_grid([0, 0, 1, 0], [0.0051, 0.0049, 0.005,
+                                                   0.002], dt, 0.01)
+    np.testing.assert_array_equal(indices, [0, 0, 1])
+    np.testing.assert_allclose(times, [0.002, 0.005, 0.005])
+
+
+def test_spikes_on_grid_drops_spikes_outside_the_run():
+    dt = 0.001
+    indices, times = spikes_on_grid([0, 1, 2, 3], [-0.002, 0.003, 0.0099,
+                                                   0.02], dt, 0.01)
+    np.testing.assert_array_equal(indices, [1])
+    np.testing.assert_allclose(times, [0.003])
+
+
+def test_spikes_on_grid_sorted_by_time():
+    rng = np.random.default_rng(0)
+    dt = 0.0001
+    indices, times = spikes_on_grid(rng.integers(0, 20, 500),
+                                    rng.uniform(0, 1, 500), dt, 1)
+    assert np.all(np.diff(times) >= 0)
+    keys = set(zip(indices.tolist(), np.round(times / dt).astype(int)))
+    assert len(keys) == len(indices)
+
+
+def spike_train(run, mon_name="afferents_spike_mon"):
+    states = run["net"][mon_name]
+    return np.asarray(states["i"]), np.asarray(states["t"])
+
+
+def same_spikes(run_a, run_b, mon_name="afferents_spike_mon"):
+    return all(np.array_equal(a, b)
+               for a, b in zip(spike_train(run_a, mon_name),
+                               spike_train(run_b, mon_name)))
+
+
+def test_process_pool_unseeded_points_differ(small_settings, run_sweep):
+    settings = small_settings(sweep_mode="process", workers=2, trials=3)
+    runs = run_sweep(settings)
+
+    assert len(runs) == 3
+    for run_a, run_b in ((runs[0], runs[1]), (runs[0], runs[2]),
+                         (runs[1], runs[2])):
+        assert not same_spikes(run_a, run_b)
+
+
+def test_process_pool_matches_serial_with_a_seed(small_settings, run_sweep):
+    runs = {}
+    for sweep_mode in ("serial", "process"):
+        settings = small_settings(sweep_mode=sweep_mode, workers=2, seed=3,
+                                  skip_completed=False)
+        settings["synapses"][("afferents", "HVA_PY")]["w_e"] = [100., 800.]
+        runs[sweep_mode] = run_sweep(settings)
+
+    for serial, pooled in zip(runs["serial"], runs["process"]):
+        assert same_spikes(serial, pooled)
+        assert same_spikes(serial, pooled, "HVA_PY_spike_mon")
+        np.testing.assert_array_equal(
+            np.asarray(serial["net"]["HVA_PY_V_mon"]["V"]),
+            np.asarray(pooled["net"]["HVA_PY_V_mon"]["V"]))
+
+
+def test_stp_is_clock_driven_by_default():
+    for syn_vals in settings_default.settings["synapses"].values():
+        assert syn_vals["stp_mode"] == "clock-driven"
+        assert "(clock-driven)" in stp_equations(syn_vals["eqs"])
+
+
+def test_stp_equations_switch_mode():
+    eqs = settings_default.settings["synapses"][("SOM", "HVA_PY")]["eqs"]
+    event_driven = stp_equations(eqs, "event-driven")
+    assert "(clock-driven)" not in event_driven
+    assert event_driven.count("(event-driven)") == eqs.count("(clock-driven)")
+    assert stp_equations(event_driven, "clock-driven") == eqs
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def test_stale_partial_runs_are_removed(tmp_path):
+    store = tmp_path / "store"
+    dead = dead_pid()
+    (store / "abc.partial-{}".format(dead)).mkdir(parents=True)
+    (store / "def.partial-{}.p".format(dead)).write_bytes(b"")
+    (store / "ghi.partial-{}".format(os.getpid())).mkdir()
+    (store / "jkl").mkdir()
+
+    hvasim.remove_stale_partial_runs(str(store))
+    assert sorted(os.listdir(str(store))) == \
+        ["ghi.partial-{}".format(os.getpid()), "jkl"]
+
+
+def count_runs(monkeypatch):
+    runs = []
+    run_network = hvasim.run_network
+
+    def counted(*args, **kwargs):
+        runs.append(1)
+        return run_network(*args, **kwargs)
+
+    monkeypatch.setattr(hvasim, "run_network", counted)
+    return runs
+
+
+def test_seeded_sweep_resumes_from_the_store(small_settings, run_sweep,
+                                             monkeypatch):
+    runs = count_runs(monkeypatch)
+    settings = small_settings(seed=3)
+    settings["synapses"][("afferents", "HVA_PY")]["w_e"] = [100., 800.]
+    first = run_sweep(copy.deepcopy(settings))
+    assert len(runs) == 2
+
+    second = run_sweep(copy.deepcopy(settings))
+    assert len(runs) == 2
+    for run_a, run_b in zip(first, second):
+        assert same_spikes(run_a, run_b, "HVA_PY_spike_mon")
+
+
+def test_unseeded_sweep_always_runs(small_settings, run_sweep, monkeypatch,
+                                    tmp_path):
+    runs = count_runs(monkeypatch)
+    settings = small_settings()
+    run_sweep(copy.deepcopy(settings))
+    run_sweep(copy.deepcopy(settings))
+    assert len(runs) == 2
+    assert not (tmp_path / "sweeps" / ".result_store").exists()
+
+
+def test_packed_offline_trains_match_serial(tmp_path):
+    afferents = {"N": 60, "peak_rate": 40, "modulation_rate": [1, 4],
+                 "sim_time": 5}
+    dt = 1e-4
+    packed = poisson_afferent_spikes(afferents, dt, n_replicas=2,
+                                     seed=[11, 12], sim_times=[5, 2],
+                                     cache_dir=str(tmp_path))
+    assert len(os.listdir(str(tmp_path))) == 2
+
+    for replica, (rate, sim_time, seed) in enumerate([(1, 5, 11),
+                                                      (4, 2, 12)]):
+        serial = poisson_afferent_spikes(dict(afferents, N=30,
+                                              modulation_rate=rate,
+                                              sim_time=sim_time),
+                                         dt, seed=seed,
+                                         cache_dir=str(tmp_path))
+        in_replica = packed[0] // 30 == replica
+        np.testing.assert_array_equal(packed[0][in_replica] - replica * 30,
+                                      serial[0])
+        np.testing.assert_array_equal(packed[1][in_replica], serial[1])
+        assert np.max(serial[1]) < sim_time
+    # the serial runs found the trains of the packed one in the cache
+    assert len(os.listdir(str(tmp_path))) == 2
+
+
+def test_packed_sweep_matches_serial(small_settings, run_sweep):
+    # packed replicas draw their connectivity with numpy, serial points
+    # with Brian2: connect everything and fix the trains to compare them
+    runs = {}
+    for sweep_mode in ("serial", "packed"):
+        settings = small_settings(sweep_mode=sweep_mode)
+        settings["afferents"].update(engine="offline", seed=5)
+        for syn_vals in settings["synapses"].values():
+            syn_vals["p_connect"] = 1
+        settings["synapses"][("afferents", "HVA_PY")]["w_e"] = [100., 800.]
+        runs[sweep_mode] = run_sweep(settings)
+
+    assert len(runs["packed"]) == 2
+    for serial, packed in zip(runs["serial"], runs["packed"]):
+        for section in ("neurons", "afferents", "synapses"):
+            assert packed["settings"][section] == serial["settings"][section]
+        assert same_spikes(serial, packed)
+        assert same_spikes(serial, packed, "HVA_PY_spike_mon")
+        np.testing.assert_allclose(
+            np.asarray(packed["net"]["HVA_PY_V_mon"]["V"]),
+            np.asarray(serial["net"]["HVA_PY_V_mon"]["V"]), rtol=1e-9)
+    # and the replicas did run with their own w_e
+    assert not np.array_equal(
+        np.asarray(runs["packed"][0]["net"]["HVA_PY_V_mon"]["V"]),
+        np.asarray(runs["packed"][1]["net"]["HVA_PY_V_mon"]["V"]))
+
+
+def test_reused_network_matches_serial(small_settings, run_sweep):
+    runs = {}
+    for sweep_mode in ("serial", "reuse"):
+        settings = small_settings(sweep_mode=sweep_mode, seed=3,
+                                  common_random_numbers=True,
+                                  skip_completed=False)
+        settings["synapses"][("afferents", "HVA_PY")]["w_e"] = [100., 800.,
+                                                                300.]
+        runs[sweep_mode] = run_sweep(settings)
+
+    assert len(runs["reuse"]) == 3
+    for serial, reused in zip(runs["serial"], runs["reuse"]):
+        assert same_spikes(serial, reused)
+        assert same_spikes(serial, reused, "HVA_PY_spike_mon")
+        np.testing.assert_array_equal(
+            np.asarray(serial["net"]["HVA_PY_V_mon"]["V"]),
+            np.asarray(reused["net"]["HVA_PY_V_mon"]["V"]))
+
+
+def test_segmented_run_matches_unsegmented(small_settings, run_sweep,
+                                           monkeypatch):
+    flushes = []
+    stream_monitors = hvasim.stream_monitors
+
+    def counted(*args, **kwargs):
+        flushes.append(1)
+        return stream_monitors(*args, **kwargs)
+
+    monkeypatch.setattr(hvasim, "stream_monitors", counted)
+    whole, = run_sweep(small_settings(seed=3, skip_completed=False))
+    assert len(flushes) == 0
+    segmented, = run_sweep(small_settings(seed=3, skip_completed=False,
+                                          segment_time=0.5))
+    assert len(flushes) == 4
+
+    assert same_spikes(whole, segmented)
+    assert same_spikes(whole, segmented, "HVA_PY_spike_mon")
+    for var in ("t", "V"):
+        np.testing.assert_array_equal(
+            np.asarray(whole["net"]["HVA_PY_V_mon"][var]),
+            np.asarray(segmented["net"]["HVA_PY_V_mon"][var]))
+
+
+@pytest.mark.parametrize("sweep_mode, result_format", [
+    ("serial", "pickle"),
+    ("reuse", "columnar"),
+])
+def test_profiled_sweep(small_settings, coarse_clock, tmp_path, sweep_mode,
+                        result_format):
+    settings = small_settings(sweep_mode=sweep_mode, profile=True,
+                              result_format=result_format)
+    settings["synapses"][("afferents", "HVA_PY")]["w_e"] = [100., 800.]
+    hvasim.run_simulations(settings, "test", str(tmp_path))
+    sim_dir, = [str(path) for path in tmp_path.glob("20*")]
+
+    profiles = anly.aggregate_profiles(sim_dir)
+    assert len(profiles["runs"]) == 2
+    assert set(profiles["wall_clock"]) == {"build", "compile", "run", "save"}
+    for stage in profiles["wall_clock"].values():
+        assert stage["total"] >= stage["mean"] > 0
+    assert len(profiles["code_objects"]) > 0
+    assert sum(vals["fraction"] for vals in
+               profiles["code_objects"].values()) == pytest.approx(1)
+
+
+@pytest.mark.parametrize("run_options", [
+    {"sweep_mode": "packed"},
+    {"backend": "cpp_standalone"},
+])
+def test_profile_refuses_packed_and_standalone(small_settings, tmp_path,
+                                               run_options):
+    settings = small_settings(profile=True, **run_options)
+    settings["synapses"][("afferents", "HVA_PY")]["w_e"] = [100., 800.]
+    with pytest.raises(RuntimeError):
+        hvasim.run_simulations(settings, "test", str(tmp_path))
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.fixture
+def runtime_device():
+    """Put Brian2 back on the runtime device after a cpp_standalone test"""
+
+    yield
+    brian.device.reinit()
+    brian.set_device("runtime")
+
+
+@pytest.mark.skipif(shutil.which("g++") is None, reason="needs a compiler")
+def test_standalone_sweep_reruns_one_build(small_settings, run_sweep,
+                                           monkeypatch, runtime_device):
+    builds = []
+    build_standalone = hvasim.build_standalone
+
+    def counted(*args, **kwargs):
+        builds.append(1)
+        return build_standalone(*args, **kwargs)
+
+    monkeypatch.setattr(hvasim, "build_standalone", counted)
+    # offline trains and full connectivity do not depend on the backend's
+    # random numbers, so the runs can be compared with numpy's
+    runs = {}
+    for backend in ("numpy", "cpp_standalone"):
+        settings = small_settings(backend=backend, skip_completed=False)
+        settings["afferents"].update(engine="offline", seed=5)
+        for syn_vals in settings["synapses"].values():
+            syn_vals["p_connect"] = 1
+        settings["synapses"][("afferents", "HVA_PY")]["w_e"] = [100., 800.]
+        runs[backend] = run_sweep(settings)
+
+    if hvasim.standalone_supports_run_args():
+        assert len(builds) == 1
+    for numpy_run, standalone in zip(runs["numpy"], runs["cpp_standalone"]):
+        assert same_spikes(numpy_run, standalone)
+        assert same_spikes(numpy_run, standalone, "HVA_PY_spike_mon")
+        np.testing.assert_allclose(
+            np.asarray(standalone["net"]["HVA_PY_V_mon"]["V"]),
+            np.asarray(numpy_run["net"]["HVA_PY_V_mon"]["V"]), rtol=1e-6)
+
+
+def test_memory_budget_decimates_state_monitors(small_settings, run_sweep):
+    whole, = run_sweep(small_settings(seed=3, skip_completed=False))
+    settings = small_settings(seed=3, skip_completed=False,
+                              budget_action="decimate")
+    _, memory = hvasim.estimate_sweep(settings)
+    settings["run"]["memory_budget"] = 0.99 * memory / 1e9
+    decimated, = run_sweep(settings)
+
+    # V sampled at a coarser dt, on the same run
+    n_samples = len(whole["net"]["HVA_PY_V_mon"]["t"])
+    factor = n_samples // len(decimated["net"]["HVA_PY_V_mon"]["t"])
+    assert factor >= 2
+    assert same_spikes(whole, decimated)
+    for var in ("t", "V"):
+        np.testing.assert_array_equal(
+            np.asarray(decimated["net"]["HVA_PY_V_mon"][var]),
+            np.asarray(whole["net"]["HVA_PY_V_mon"][var])[::factor])
+    assert same_spikes(whole, decimated, "HVA_PY_spike_mon")
+
+
+@pytest.mark.parametrize("budget_action, budget_fraction", [
+    ("refuse", 0.99),
+    # smaller than the network itself, decimating does not help
+    ("decimate", 1e-6),
+])
+def test_memory_budget_refuses(small_settings, coarse_clock, tmp_path,
+                               budget_action, budget_fraction):
+    settings = small_settings(budget_action=budget_action)
+    _, memory = hvasim.estimate_sweep(settings)
+    settings["run"]["memory_budget"] = budget_fraction * memory / 1e9
+    with pytest.raises(RuntimeError):
+        hvasim.run_simulations(settings, "test", str(tmp_path))
+    assert os.listdir(str(tmp_path)) == []